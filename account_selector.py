@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Account selection for Gemini CLI Auth Manager.
+
+Ranks pooled accounts by their cached quota (see profile_cache) so rotation
+lands on the healthiest account in one step instead of the alphabetical
+neighbour. Only cached snapshots are used: ranking never touches the network.
+
+Rotation modes (auto_switch.rotation):
+- "quota":      best cached remaining fraction for the strategy's target models,
+                skipping accounts whose buckets are exhausted and not yet reset
+- "sequential": next account in sorted order (classic behaviour)
+- "balanced":   spread the load over the pool instead of draining one account
+                until it fails: the serving account is re-picked per session
+                or per prompt (auto_switch.balance_scope) by smooth weighted
+                round-robin or weighted random (auto_switch.balance_algorithm)
+
+Balancing weights come from the cached snapshots as well: the headroom above
+the threshold divided by the hours until the bucket resets. An account whose
+quota resets soon may spend faster than one that has to last all day, so the
+pool drains evenly and no account reaches the hard limit mid-task.
+
+Exhausted accounts are kept in an exhaustion calendar (a min-heap of bucket
+reset times): rotation skips them until their quota resets and then puts
+them back into the candidate set automatically.
+
+Every fetched snapshot is also kept as a per-model time series (see
+state_store.quota_samples). burn_rate() estimates how fast a bucket drains,
+which the "predictive" strategy uses to switch before the next refresh would
+find the bucket below the threshold.
+
+auto_switch arguments are the normalized section of the config snapshot
+(config_snapshot.load()["auto_switch"]): threshold is a fraction and the
+model patterns come with precompiled matchers.
+"""
+import heapq
+import time
+from datetime import datetime, timezone
+
+import config_snapshot
+import profile_cache
+import state_store
+
+DEFAULT_ROTATION = config_snapshot.DEFAULT_AUTO_SWITCH["rotation"]
+ROTATION_MODES = config_snapshot.ROTATION_MODES
+
+BURN_RATE_WINDOW_MINUTES = 60   # Samples older than this do not affect the estimate
+BURN_RATE_MIN_SPAN_SECONDS = 60  # Need at least this much history for a rate
+
+BALANCE_HORIZON_HOURS = 24.0     # Reset horizon assumed when a bucket has no resetTime
+BALANCE_MIN_RESET_HOURS = 0.25   # Caps the boost of buckets that reset very soon
+BALANCE_STATE_KEY = "balance_state"  # state_store kv: {"current": {account: weight}, "sessions": [id]}
+
+
+def parse_reset_time(reset_time_str):
+    """Parse a bucket resetTime (RFC 3339) into an aware datetime, or None."""
+    if not reset_time_str:
+        return None
+    try:
+        reset_time = datetime.fromisoformat(reset_time_str.replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+    if reset_time.tzinfo is None:
+        reset_time = reset_time.replace(tzinfo=timezone.utc)
+    return reset_time
+
+
+def target_buckets(buckets, auto_switch):
+    """Select the buckets the configured strategy cares about."""
+    buckets = [b for b in buckets if b.get("remainingFraction") is not None]
+
+    if auto_switch["strategy"] == "conservative":
+        return buckets
+
+    match = config_snapshot.strategy_matcher(auto_switch)
+    targets = []
+    if match:
+        targets = [b for b in buckets if b.get("modelId") and match(b["modelId"])]
+
+    # Fallback to models_to_check if the pattern matched nothing
+    if not targets:
+        models_to_check = auto_switch["models_to_check"]
+        targets = [b for b in buckets if b.get("modelId") in models_to_check]
+    return targets
+
+
+def burn_rate(account, model_id, now=None):
+    """
+    Estimate how fast a bucket drains, in remainingFraction per minute.
+    Uses a least-squares fit over the samples since the bucket last went up
+    (a reset or refill) within BURN_RATE_WINDOW_MINUTES.
+    Returns None if there is not enough history, 0.0 if the bucket is not draining.
+    """
+    now = now if now is not None else time.time()
+    samples = state_store.get_quota_samples(account, model_id, now - BURN_RATE_WINDOW_MINUTES * 60)
+
+    # Only the samples after the last increase describe the current drain
+    start = 0
+    for i in range(1, len(samples)):
+        if samples[i][1] > samples[i - 1][1]:
+            start = i
+    samples = samples[start:]
+    if len(samples) < 2 or samples[-1][0] - samples[0][0] < BURN_RATE_MIN_SPAN_SECONDS:
+        return None
+
+    mean_t = sum(ts for ts, _ in samples) / len(samples)
+    mean_f = sum(f for _, f in samples) / len(samples)
+    var_t = sum((ts - mean_t) ** 2 for ts, _ in samples)
+    if var_t == 0:
+        return None
+    slope = sum((ts - mean_t) * (f - mean_f) for ts, f in samples) / var_t
+    return max(0.0, -slope * 60)
+
+
+def projected_fraction(account, bucket, horizon_minutes, now=None):
+    """
+    Project a bucket's remainingFraction `horizon_minutes` ahead using its burn rate.
+    Returns (projected, rate); without a rate estimate the current fraction is returned.
+    """
+    fraction = bucket.get("remainingFraction", 1.0)
+    rate = burn_rate(account, bucket.get("modelId"), now) if account else None
+    if rate is None:
+        return fraction, None
+    return max(0.0, fraction - rate * horizon_minutes), rate
+
+
+def _bucket_states(account, auto_switch, now):
+    """
+    Return [(model, fraction, reset_at)] of an account's cached target buckets
+    (buckets whose resetTime has passed count as full, reset_at None), or None
+    if nothing is cached.
+    """
+    snapshot = profile_cache.load_quota_snapshot(account)
+    if not snapshot:
+        return None
+
+    targets = target_buckets(snapshot.get("buckets", []), auto_switch)
+    if not targets:
+        return None
+
+    states = []
+    for bucket in targets:
+        fraction = bucket.get("remainingFraction", 0.0)
+        reset_at = parse_reset_time(bucket.get("resetTime"))
+        if reset_at and reset_at <= now:
+            fraction, reset_at = 1.0, None
+        states.append((bucket.get("modelId", ""), fraction, reset_at))
+    return states
+
+
+def _evaluate(account, auto_switch, now, states=None):
+    """
+    Evaluate an account's cached snapshot.
+    Returns (score, reset_at, calendar_entries); see account_health().
+    calendar_entries lists [(model, reset_ts, fraction)] of the target buckets
+    of an exhausted account that reset in the future.
+    """
+    if states is None:
+        states = _bucket_states(account, auto_switch, now)
+    if not states:
+        return None, None, []
+
+    best = max(fraction for _, fraction, _ in states)
+    pending = [(model, reset_at, fraction) for model, fraction, reset_at in states if reset_at]
+    if best > auto_switch["threshold"] or not pending:
+        return best, None, []
+    entries = [(model, reset_at.timestamp(), fraction) for model, reset_at, fraction in pending]
+    return best, min(reset_at for _, reset_at, _ in pending), entries
+
+
+def account_health(account, auto_switch, now=None):
+    """
+    Estimate how usable an account is from its cached quota snapshot.
+    Returns (score, reset_at):
+      score    - best remaining fraction among target buckets (buckets whose
+                 resetTime has passed count as full), None if nothing is cached
+      reset_at - when an exhausted account becomes usable again, else None
+    """
+    score, reset_at, _ = _evaluate(account, auto_switch, now or datetime.now(timezone.utc))
+    return score, reset_at
+
+
+class ExhaustionCalendar:
+    """
+    Min-heap of (reset_ts, account, model, fraction) for the target buckets of
+    exhausted accounts, persisted in the state store.
+
+    An exhausted account stays blocked until its earliest bucket reset: it is
+    skipped by rotation without reading its snapshot, and released back into
+    the candidate set (all of its entries dropped) once that time has passed.
+    """
+
+    def __init__(self, entries=()):
+        self._heap = list(entries)
+        heapq.heapify(self._heap)
+
+    @classmethod
+    def load(cls):
+        return cls(state_store.get_exhaustion_entries())
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, account, entries):
+        """Block an account: entries are [(model, reset_ts, fraction)]."""
+        for model, reset_ts, fraction in entries:
+            heapq.heappush(self._heap, (reset_ts, account, model, fraction))
+        state_store.put_exhaustion(account, entries)
+
+    def release_due(self, now_ts):
+        """Release every account whose earliest reset has passed; returns their names."""
+        released = set()
+        while self._heap and self._heap[0][0] <= now_ts:
+            released.add(heapq.heappop(self._heap)[1])
+        if released:
+            self._heap = [entry for entry in self._heap if entry[1] not in released]
+            heapq.heapify(self._heap)
+            state_store.delete_exhaustion(released)
+        return released
+
+    def next_reset(self):
+        """Return (reset_ts, account) of the soonest reset, or None if nothing is blocked."""
+        return (self._heap[0][0], self._heap[0][1]) if self._heap else None
+
+    def blocked(self):
+        """Return {account: (reset_at, score)} for all blocked accounts."""
+        blocked = {}
+        for reset_ts, account, _, fraction in sorted(self._heap):
+            if account not in blocked:
+                reset_at = datetime.fromtimestamp(reset_ts, timezone.utc)
+                blocked[account] = (reset_at, fraction)
+            else:
+                reset_at, score = blocked[account]
+                blocked[account] = (reset_at, max(score, fraction))
+        return blocked
+
+
+def rank_accounts(profiles, current, auto_switch, now=None, calendar=None):
+    """
+    Rank switch candidates (all profiles except `current`).
+    Returns (candidates, exhausted):
+      candidates - [(account, score)] best first: accounts with healthy cached
+                   quota by score, then accounts without data in rotation order
+      exhausted  - [(account, score, reset_at)] known below threshold, soonest reset first
+    Accounts blocked in the exhaustion calendar are skipped without reading
+    their snapshots; newly found exhausted accounts are added to it.
+    """
+    now = now or datetime.now(timezone.utc)
+    threshold = auto_switch["threshold"]
+    calendar = calendar if calendar is not None else ExhaustionCalendar.load()
+    calendar.release_due(now.timestamp())
+    blocked = calendar.blocked()
+
+    # Rotation order starting after the current account
+    if current in profiles:
+        idx = profiles.index(current)
+        ordered = profiles[idx + 1:] + profiles[:idx]
+    else:
+        ordered = list(profiles)
+
+    healthy, unknown, exhausted = [], [], []
+    for account in ordered:
+        if account in blocked:
+            reset_at, score = blocked[account]
+            exhausted.append((account, score, reset_at))
+            continue
+
+        score, reset_at, entries = _evaluate(account, auto_switch, now)
+        if score is None:
+            unknown.append((account, None))
+        elif score <= threshold:
+            exhausted.append((account, score, reset_at))
+            if entries:
+                calendar.add(account, entries)
+        else:
+            healthy.append((account, score))
+
+    # Stable sort keeps rotation order among equal scores
+    healthy.sort(key=lambda item: item[1], reverse=True)
+    far_future = datetime.max.replace(tzinfo=timezone.utc)
+    exhausted.sort(key=lambda item: item[2] or far_future)
+    return healthy + unknown, exhausted
+
+
+def balance_weight(states, threshold, now):
+    """
+    Balancing weight of an account from its bucket states (see _bucket_states):
+    the best target bucket's headroom above `threshold`, per hour left until it
+    resets. 0.0 if no bucket is above the threshold.
+    """
+    best = 0.0
+    for _, fraction, reset_at in states:
+        headroom = fraction - threshold
+        if headroom <= 0:
+            continue
+        hours = (reset_at - now).total_seconds() / 3600 if reset_at else BALANCE_HORIZON_HOURS
+        best = max(best, headroom / max(hours, BALANCE_MIN_RESET_HOURS))
+    return best
+
+
+def balance_weights(profiles, auto_switch, now=None, calendar=None):
+    """
+    Weigh every profile for balancing.
+    Returns (weights, exhausted): weights is {account: weight > 0} in profile
+    order, exhausted as in rank_accounts(). Accounts without cached quota get
+    the weight of a full bucket with no known reset, so they are served (and
+    their quota fetched) instead of being starved.
+    """
+    now = now or datetime.now(timezone.utc)
+    threshold = auto_switch["threshold"]
+    unknown_weight = (1.0 - threshold) / BALANCE_HORIZON_HOURS
+    calendar = calendar if calendar is not None else ExhaustionCalendar.load()
+    calendar.release_due(now.timestamp())
+    blocked = calendar.blocked()
+
+    weights, exhausted = {}, []
+    for account in profiles:
+        if account in blocked:
+            reset_at, score = blocked[account]
+            exhausted.append((account, score, reset_at))
+            continue
+
+        states = _bucket_states(account, auto_switch, now)
+        if not states:
+            weights[account] = unknown_weight
+            continue
+        weight = balance_weight(states, threshold, now)
+        if weight > 0:
+            weights[account] = weight
+            continue
+        score, reset_at, entries = _evaluate(account, auto_switch, now, states)
+        exhausted.append((account, score, reset_at))
+        if entries:
+            calendar.add(account, entries)
+
+    far_future = datetime.max.replace(tzinfo=timezone.utc)
+    exhausted.sort(key=lambda item: item[2] or far_future)
+    return weights, exhausted
+
+
+def smooth_weighted_pick(weights, current_weights):
+    """
+    One step of smooth weighted round-robin (as in nginx): every account's
+    current weight grows by its weight, the largest wins and gives back the
+    total. Picks are spread evenly in proportion to the weights.
+    `current_weights` is updated in place; returns the picked account.
+    """
+    total = 0.0
+    picked = None
+    for account, weight in weights.items():
+        current = current_weights.get(account, 0.0) + weight
+        current_weights[account] = current
+        total += weight
+        if picked is None or current > current_weights[picked]:
+            picked = account
+    current_weights[picked] -= total
+    # Forget accounts that left the pool or are exhausted
+    for account in [a for a in current_weights if a not in weights]:
+        del current_weights[account]
+    return picked
+
+
+def pick_balanced(profiles, auto_switch, exclude=None, now=None, rng=None):
+    """
+    Pick the serving account for balanced rotation (never `exclude`).
+    Returns (account, weight, exhausted); account is None if every candidate
+    is exhausted. The smooth round-robin state is kept in the state store.
+    """
+    weights, exhausted = balance_weights(profiles, auto_switch, now)
+    weights.pop(exclude, None)
+    if not weights:
+        return None, None, exhausted
+
+    if auto_switch["balance_algorithm"] == "random":
+        if rng is None:
+            import random as rng  # Only for weighted random balancing
+        accounts = list(weights)
+        account = rng.choices(accounts, weights=[weights[a] for a in accounts])[0]
+        return account, weights[account], exhausted
+
+    picked = []
+
+    def advance(state):
+        # Under the state store's write lock: concurrent sessions advance the weights in turn
+        state = state or {}
+        current_weights = state.get("current") or {}
+        picked.append(smooth_weighted_pick(weights, current_weights))
+        state["current"] = current_weights
+        return state
+
+    state_store.update(BALANCE_STATE_KEY, advance)
+    account = picked[-1]
+    return account, weights[account], exhausted
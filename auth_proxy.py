@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+Gemini CLI Auth Proxy
+Optional local HTTP proxy in front of the Code Assist API
+(cloudcode-pa.googleapis.com) that signs every request with the account that
+is active *now*: the bearer token the CLI sends is replaced by the access
+token of the selected pool account, and the top-level "project" field of
+JSON bodies by that account's cloudaicompanionProject. A switch (gchange,
+hooks) takes effect on the next request, without restarting the CLI.
+
+The CLI is pointed at the proxy through its CODE_ASSIST_ENDPOINT environment
+variable:
+
+    python auth_proxy.py start
+    export CODE_ASSIST_ENDPOINT=http://127.0.0.1:8790/<secret>
+    gemini
+
+The URL contains a random secret path prefix (kept in ~/.gemini/auth_proxy.json,
+mode 0600, reused across restarts), so other local users and web pages cannot
+borrow the pool's credentials; requests without it get a 404, and requests
+with a Host other than 127.0.0.1/localhost (DNS rebinding) a 403, both before
+any of the body is read. The server only listens on 127.0.0.1.
+
+Per request:
+1. Access token of the active account from its profile copy, refreshed when
+   it is about to expire (oauth_refresh; the profile copy is used because the
+   CLI keeps writing its own login into the live oauth_creds.json).
+2. Project from the profile cache, resolved once via loadCodeAssist if missing.
+3. Upstream request; on 401 the token is refreshed and the request retried
+   once. Responses (including streamGenerateContent's SSE) are streamed back
+   as they arrive.
+
+With tracing on (hook_trace), each request is traced as "proxy" with the
+phases token, project and upstream (time to the response headers).
+The hooks and gchange call the API directly (direct_endpoint()) and skip the
+CLI restart while the CLI is served by the proxy (serving_cli()).
+
+Usage:
+    python auth_proxy.py start [--port N] [--upstream URL]   # Start in background
+    python auth_proxy.py stop                                # Stop running proxy
+    python auth_proxy.py status                              # Show proxy status
+    python auth_proxy.py serve [--port N] [--upstream URL]   # Run in foreground
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+# --- Configuration ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+PROFILES_DIR = GEMINI_DIR / "auth_profiles"
+STATE_FILE = GEMINI_DIR / "auth_proxy.json"
+LOG_FILE = GEMINI_DIR / "auth_proxy.log"
+
+DEFAULT_PORT = 8790
+DEFAULT_UPSTREAM = "https://cloudcode-pa.googleapis.com"
+CONTROL_PREFIX = "/__gchange/"  # Status/shutdown paths below the secret prefix
+
+CONNECT_TIMEOUT = 10    # Seconds to reach the upstream
+READ_TIMEOUT = 600      # Seconds between two chunks of a (streamed) response
+STATUS_TIMEOUT = 2      # Seconds for status/shutdown requests
+START_TIMEOUT = 5       # Seconds to wait for a freshly started proxy
+CHUNK_SIZE = 16384
+MAX_BODY_SIZE = 64 * 1024 * 1024  # Largest request body read (the CLI sends whole conversations)
+
+# Connection-level headers that are never forwarded (RFC 9110 section 7.6.1)
+HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+
+# --- Client (stdlib only, imported by the hooks) ---
+def load_state():
+    """Return the saved proxy state {pid, port, secret, upstream, url, started}, or None."""
+    try:
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) and state.get("url") else None
+
+
+def _is_local(endpoint):
+    return endpoint.startswith(("http://127.0.0.1:", "http://localhost:"))
+
+
+def direct_endpoint(endpoint):
+    """
+    Return the upstream of `endpoint` if it is the proxy's URL, else `endpoint`.
+    The hooks' own API calls carry an explicit per-account token and must not
+    be re-signed with the active account.
+    """
+    if not endpoint or not _is_local(endpoint):
+        return endpoint
+    state = load_state()
+    if state and endpoint.rstrip("/") == state["url"]:
+        return state.get("upstream") or DEFAULT_UPSTREAM
+    return endpoint
+
+
+def serving_cli(endpoint=None):
+    """
+    True if the CLI's CODE_ASSIST_ENDPOINT (`endpoint`, default: this process's
+    environment, inherited from the CLI by the hooks) is the proxy's URL.
+    """
+    if endpoint is None:
+        endpoint = os.environ.get("CODE_ASSIST_ENDPOINT", "")
+    if not endpoint or not _is_local(endpoint):
+        return False
+    state = load_state()
+    return bool(state) and endpoint.rstrip("/") == state["url"]
+
+
+def _control(command, data=None):
+    """Call a control path of the running proxy; returns the JSON reply or None."""
+    from urllib.error import URLError
+    from urllib.request import ProxyHandler, Request, build_opener
+
+    state = load_state()
+    if not state:
+        return None
+    request = Request(f"{state['url']}{CONTROL_PREFIX}{command}", data=data)
+    # Straight to localhost: an HTTP(S)_PROXY must never see the secret URL
+    opener = build_opener(ProxyHandler({}))
+    try:
+        with opener.open(request, timeout=STATUS_TIMEOUT) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except (URLError, OSError, ValueError):
+        return None
+
+
+def status():
+    """Return the running proxy's status dict, or None if not running."""
+    return _control("status")
+
+
+def stop_proxy():
+    """Ask a running proxy to shut down; returns True if one was running."""
+    reply = _control("shutdown", data=b"")
+    return bool(reply and reply.get("ok"))
+
+
+def start_proxy(port=None, upstream=None):
+    """Start the proxy detached; returns the status dict or None on failure."""
+    import subprocess
+
+    current = status()
+    if current:
+        return current
+
+    cmd = [sys.executable, str(Path(__file__).resolve()), "serve"]
+    if port is not None:
+        cmd += ["--port", str(port)]
+    if upstream:
+        cmd += ["--upstream", upstream]
+
+    GEMINI_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LOG_FILE, "a", encoding="utf-8") as log_f:
+        if sys.platform == "win32":
+            # DETACHED_PROCESS: no console window
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log_f, stderr=log_f,
+                             creationflags=0x00000008, close_fds=True)
+        else:
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log_f, stderr=log_f,
+                             start_new_session=True, close_fds=True)
+
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.1)
+        current = status()
+        if current:
+            return current
+    return None
+
+
+# --- Server ---
+def _save_state(state):
+    """Write the state file atomically, readable by the current user only."""
+    import fsutil
+
+    GEMINI_DIR.mkdir(parents=True, exist_ok=True)
+    fsutil.atomic_write(STATE_FILE, json.dumps(state, indent=2).encode("utf-8"), mode=0o600)
+
+
+def _import_modules():
+    """Import the shared modules this one depends on (installed side by side)."""
+    import hook_trace
+    import oauth_refresh
+    import profile_cache
+    return hook_trace, oauth_refresh, profile_cache
+
+
+def serve(port=DEFAULT_PORT, upstream=None):
+    """Run the proxy in the foreground until stopped."""
+    import secrets
+    import signal
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import requests
+
+    hook_trace, oauth_refresh, profile_cache = _import_modules()
+    from quota_api_client import LOAD_CODE_ASSIST_PAYLOAD
+
+    if status():
+        print("[auth-proxy] Already running.", file=sys.stderr)
+        return 0
+
+    # Default upstream: where the CLI would go without the proxy
+    upstream = (upstream or direct_endpoint(os.environ.get("CODE_ASSIST_ENDPOINT", DEFAULT_UPSTREAM))).rstrip("/")
+    previous = load_state() or {}
+    secret = previous.get("secret") or secrets.token_urlsafe(18)
+    prefix = f"/{secret}"
+
+    local = threading.local()  # One requests.Session per handler thread
+
+    def session():
+        if getattr(local, "session", None) is None:
+            local.session = requests.Session()
+            local.session.trust_env = False  # Never route pool tokens through an HTTP(S)_PROXY
+        return local.session
+
+    def creds_file(account):
+        # The profile copy: the live file may hold the CLI's own (other) login
+        profile_creds = PROFILES_DIR / account / "oauth_creds.json"
+        return profile_creds if profile_creds.exists() else profile_cache.credentials_file(account)
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive and chunked streaming to the CLI
+
+        def log_message(self, format, *args):
+            pass
+
+        # --- helpers ---
+        def _reply(self, status_code, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _error(self, status_code, message):
+            self._reply(status_code, {"error": {"code": status_code, "message": f"[auth-proxy] {message}"}})
+
+        def _read_body(self):
+            """
+            Return the request body, or None if it is larger than MAX_BODY_SIZE
+            (nothing beyond the limit is read). Raises ValueError if malformed.
+            """
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                chunks = []
+                total = 0
+                while True:
+                    size = int(self.rfile.readline().split(b";", 1)[0].strip() or b"0", 16)
+                    if not size:
+                        # Skip trailers up to the empty line
+                        while self.rfile.readline().strip():
+                            pass
+                        return b"".join(chunks)
+                    if size < 0:
+                        raise ValueError(f"negative chunk size {size}")
+                    total += size
+                    if total > MAX_BODY_SIZE:
+                        return None
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+            length = int(self.headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError(f"negative Content-Length {length}")
+            if length > MAX_BODY_SIZE:
+                return None
+            return self.rfile.read(length) if length else b""
+
+        def _host_ok(self):
+            # Rejects DNS-rebinding requests that carry a foreign Host header
+            host = (self.headers.get("Host") or "").rsplit(":", 1)[0].strip("[]").lower()
+            return host in ("127.0.0.1", "localhost")
+
+        # --- dispatch ---
+        def do_GET(self):
+            self._handle()
+
+        def do_POST(self):
+            self._handle()
+
+        def do_PUT(self):
+            self._handle()
+
+        def do_PATCH(self):
+            self._handle()
+
+        def do_DELETE(self):
+            self._handle()
+
+        def _handle(self):
+            # Rejected before the body is read; its unread bytes end the connection
+            if not self._host_ok():
+                self.close_connection = True
+                self._error(403, "forbidden")
+                return
+            if not (self.path == prefix or self.path.startswith(prefix + "/")):
+                self.close_connection = True
+                self._error(404, "not found")
+                return
+            try:
+                body = self._read_body()
+            except ValueError:
+                self.close_connection = True
+                self._error(400, "malformed request body")
+                return
+            if body is None:
+                self.close_connection = True
+                self._error(413, f"request body larger than {MAX_BODY_SIZE} bytes")
+                return
+            path = self.path[len(prefix):] or "/"
+
+            if path.startswith(CONTROL_PREFIX):
+                self._control(path[len(CONTROL_PREFIX):])
+                return
+            if not self.headers.get("Authorization"):
+                # The CLI always authenticates; anything else is not ours to sign
+                self._error(401, "missing Authorization header")
+                return
+
+            hook_trace.begin("proxy")
+            try:
+                self._proxy(path, body)
+            except Exception as e:
+                # Client went away or upstream broke mid-stream: the response is unusable
+                print(f"[auth-proxy] {self.command} {path} aborted: {e!r}", file=sys.stderr, flush=True)
+                hook_trace.annotate(error=e.__class__.__name__)
+                self.close_connection = True
+            finally:
+                hook_trace.finish()
+                self.server.served += 1
+
+        def _control(self, command):
+            if command == "status" and self.command == "GET":
+                self._reply(200, {
+                    "ok": True,
+                    "pid": os.getpid(),
+                    "port": self.server.server_address[1],
+                    "upstream": upstream,
+                    "uptime": round(time.time() - self.server.started, 1),
+                    "requests": self.server.served,
+                    "account": self.server.account,
+                })
+            elif command == "shutdown" and self.command == "POST":
+                self._reply(200, {"ok": True})
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                self._error(404, "not found")
+
+        # --- proxying ---
+        def _proxy(self, path, body):
+            account = profile_cache.get_active_account()
+            if not account:
+                self._error(503, "no active account (gchange <account>)")
+                return
+            if account != self.server.account:
+                print(f"[auth-proxy] Serving {account}", file=sys.stderr, flush=True)
+                self.server.account = account
+            hook_trace.annotate(account=account)
+
+            signer = {"account": account, "creds": creds_file(account)}
+            with hook_trace.span("token"):
+                signer["token"] = oauth_refresh.get_access_token(signer["creds"])
+            if not signer["token"]:
+                self._error(503, f"no credentials for {account}")
+                return
+
+            with hook_trace.span("project"):
+                body = self._rewrite_project(body, signer)
+
+            headers = {
+                name: value for name, value in self.headers.items()
+                if name.lower() not in HOP_BY_HOP and name.lower() not in ("host", "authorization", "content-length")
+            }
+            # Without Accept-Encoding, requests would ask for gzip on the client's behalf
+            headers.setdefault("Accept-Encoding", "identity")
+
+            with hook_trace.span("upstream"):
+                response = self._signed(signer, self.command, upstream + path, headers, body,
+                                        stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if response is None:
+                self._error(502, f"upstream {upstream} unreachable")
+                return
+            hook_trace.annotate(status=response.status_code)
+            with response:
+                self._relay(response)
+
+        def _signed(self, signer, method, url, headers, body, **kwargs):
+            """
+            Send a request signed with the signer's token; on 401 refresh the
+            token and retry once. Returns the response, or None if unreachable.
+            """
+            for attempt in range(2):
+                try:
+                    response = session().request(
+                        method, url, data=body or None, allow_redirects=False,
+                        headers=dict(headers, Authorization=f"Bearer {signer['token']}"), **kwargs,
+                    )
+                except requests.exceptions.RequestException as e:
+                    print(f"[auth-proxy] Upstream request failed: {e}", file=sys.stderr, flush=True)
+                    return None
+                if response.status_code != 401 or attempt:
+                    return response
+                try:
+                    creds = oauth_refresh.refresh_credentials(signer["creds"], rejected_token=signer["token"])
+                except oauth_refresh.TokenRefreshError as e:
+                    print(f"[auth-proxy] Token refresh failed for {signer['account']}: {e}", file=sys.stderr, flush=True)
+                    return response
+                response.content  # Drain the error body so the connection is reused
+                signer["token"] = creds["access_token"]
+
+        def _relay(self, response):
+            """Send the upstream response back, chunk by chunk as it arrives."""
+            raw_headers = response.raw.headers
+            length = raw_headers.get("Content-Length")
+            chunked = length is None or "chunked" in raw_headers.get("Transfer-Encoding", "").lower()
+
+            self.send_response(response.status_code, response.reason)
+            for name, value in raw_headers.items():
+                if name.lower() not in HOP_BY_HOP and name.lower() != "content-length":
+                    self.send_header(name, value)
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Content-Length", length)
+            self.end_headers()
+
+            # decode_content=False: compressed bodies are passed through with their Content-Encoding
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                if not chunk:
+                    continue
+                if chunked:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                else:
+                    self.wfile.write(chunk)
+                self.wfile.flush()
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        def _rewrite_project(self, body, signer):
+            """Replace the top-level "project" of a JSON body with the active account's project."""
+            if not body or b'"project"' not in body:
+                return body
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                return body
+            if not isinstance(payload, dict) or not isinstance(payload.get("project"), str):
+                return body
+            project = self._project_of(signer)
+            if not project or payload["project"] == project:
+                return body
+            payload["project"] = project
+            return json.dumps(payload).encode("utf-8")
+
+        def _project_of(self, signer):
+            """The account's cloudaicompanionProject: cached, or resolved once via loadCodeAssist."""
+            account = signer["account"]
+            info = profile_cache.load_project_info(account)
+            if info:
+                return info["project"]
+            response = self._signed(signer, "POST", f"{upstream}/v1internal:loadCodeAssist",
+                                    {"Content-Type": "application/json"},
+                                    json.dumps(LOAD_CODE_ASSIST_PAYLOAD).encode("utf-8"),
+                                    timeout=(CONNECT_TIMEOUT, 30))
+            try:
+                if response is None:
+                    return None
+                response.raise_for_status()
+                result = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"[auth-proxy] loadCodeAssist failed for {account}: {e}", file=sys.stderr, flush=True)
+                return None
+            project = result.get("cloudaicompanionProject")
+            if project:
+                profile_cache.save_project_info(account, project, result.get("currentTier"))
+            return project
+
+    class AuthProxy(ThreadingHTTPServer):
+        daemon_threads = True
+        started = time.time()
+        served = 0
+        account = None
+
+    try:
+        server = AuthProxy(("127.0.0.1", port), ProxyHandler)
+    except OSError as e:
+        print(f"[auth-proxy] Cannot listen on 127.0.0.1:{port}: {e}", file=sys.stderr)
+        return 1
+
+    bound_port = server.server_address[1]
+    _save_state({
+        "pid": os.getpid(),
+        "port": bound_port,
+        "secret": secret,
+        "upstream": upstream,
+        "url": f"http://127.0.0.1:{bound_port}{prefix}",
+        "started": time.time(),
+    })
+
+    def _stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    print(f"[auth-proxy] Listening on 127.0.0.1:{bound_port}, upstream {upstream} (PID {os.getpid()})",
+          file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        print("[auth-proxy] Stopped.", file=sys.stderr, flush=True)
+    return 0
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Gemini CLI auth proxy")
+    parser.add_argument("command", nargs="?", default="status", choices=["start", "stop", "status", "serve"])
+    parser.add_argument("--port", type=int, default=None, help=f"Local port (default {DEFAULT_PORT}, 0 = any)")
+    parser.add_argument("--upstream", default=None, help=f"Code Assist API base URL (default {DEFAULT_UPSTREAM})")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        sys.exit(serve(DEFAULT_PORT if args.port is None else args.port, args.upstream))
+    elif args.command == "start":
+        current = start_proxy(args.port, args.upstream)
+        if current:
+            print(f"[OK] Auth proxy running (PID {current['pid']})")
+            print(f"export CODE_ASSIST_ENDPOINT={load_state()['url']}")
+        else:
+            print(f"[Error] Failed to start auth proxy. See {LOG_FILE}")
+            sys.exit(1)
+    elif args.command == "stop":
+        if stop_proxy():
+            print("[OK] Auth proxy stopped.")
+        else:
+            print("[Info] Auth proxy is not running.")
+    else:
+        current = status()
+        if current:
+            print(f"[OK] Auth proxy running (PID {current['pid']}, uptime {current['uptime']}s, "
+                  f"{current['requests']} requests served, account {current['account'] or '-'})")
+            print(f"export CODE_ASSIST_ENDPOINT={load_state()['url']}")
+        else:
+            print("[Info] Auth proxy is not running.")
+
+
+if __name__ == "__main__":
+    main()
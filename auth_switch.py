@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+In-process account switching API for Gemini CLI Auth Manager.
+
+Used by the gchange CLI and directly by the BeforeAgent/AfterAgent hooks, so
+a switch costs a few file operations instead of a second interpreter start.
+
+Every file is replaced atomically (temp file + os.replace), so a crash leaves
+either the old or the new account in place, never a half-written file. The
+live oauth_creds.json is copied back into the previous account's profile only
+when its content changed since it was installed (the CLI refreshed the
+token): the SHA-256 of each installed file is kept in the state store (key
+"installed_creds"). With auto_switch.switch_mode "symlink", oauth_creds.json
+becomes a symlink to the profile copy and nothing is ever copied back.
+Live credentials that belong to a different login (a CLI kept running behind
+the auth proxy writes its own refreshed token there) are never copied into
+the previous account's profile.
+
+Functions never print; they return a result dict:
+
+    {
+        "ok": bool,            # Target account is now active
+        "account": str|None,   # Active account after the call
+        "previous": str|None,  # Active account before the call
+        "switched": bool,      # False if the target was already active
+        "error": str|None,     # Error code (see below)
+        "detail": str,         # Extra error context (index range, OS error, ...)
+        "token_cache_cleared": bool,
+        "written_back": bool,  # Live credentials were saved to the previous profile
+        "warnings": [str],
+        # switch_next() / switch_balanced() only:
+        "mode": str, "score": float|None, "exhausted": [(account, score, reset_at)],
+        "weight": float|None,  # "balanced" only: balancing weight of the picked account
+    }
+
+Error codes: no_profiles, index_out_of_range, not_found, ambiguous (detail
+lists the candidates), missing_credentials, io_error, single_account,
+all_exhausted.
+"""
+import json
+import os
+from pathlib import Path
+
+import account_selector
+import config_snapshot
+import fsutil
+import profile_cache
+import state_store
+
+# --- Configuration Paths ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+PROFILES_DIR = GEMINI_DIR / "auth_profiles"
+ACCOUNTS_JSON = GEMINI_DIR / "google_accounts.json"
+CREDS_FILE = GEMINI_DIR / "oauth_creds.json"
+ID_FILE = GEMINI_DIR / "google_account_id"
+TOKEN_CACHE_FILE = GEMINI_DIR / "mcp-oauth-tokens-v2.json"
+
+AMBIGUOUS_LIMIT = 5  # Candidates listed when a partial email matches several profiles
+
+SWITCH_MODES = config_snapshot.SWITCH_MODES
+DEFAULT_SWITCH_MODE = config_snapshot.DEFAULT_AUTO_SWITCH["switch_mode"]
+INSTALLED_KEY = "installed_creds"  # state_store kv: {"account", "sha256"} of the live oauth_creds.json
+
+
+def _result(**fields):
+    """Build a result dict with all common keys present."""
+    result = {
+        "ok": False,
+        "account": None,
+        "previous": None,
+        "switched": False,
+        "error": None,
+        "detail": "",
+        "token_cache_cleared": False,
+        "written_back": False,
+        "warnings": [],
+    }
+    result.update(fields)
+    return result
+
+
+def get_account_data():
+    """Get full account data from google_accounts.json."""
+    if ACCOUNTS_JSON.exists():
+        try:
+            with open(ACCOUNTS_JSON, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {"active": None, "old": []}
+
+
+def load_auto_switch_config():
+    """Return the normalized auto_switch section of the config snapshot (defaults filled in)."""
+    return config_snapshot.load()["auto_switch"]
+
+
+def _read_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _digest(data):
+    import hashlib  # Only needed when switching
+    return hashlib.sha256(data).hexdigest()
+
+
+def _atomic_symlink(path, target):
+    """Point `path` at `target` by renaming a fresh symlink over it."""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.link")
+    try:
+        tmp_path.unlink()
+    except OSError:
+        pass
+    os.symlink(str(target), str(tmp_path))
+    try:
+        os.replace(str(tmp_path), str(path))
+    except OSError:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _token_email(creds):
+    """Return the email claim of the credentials' id_token (unverified), or None."""
+    import base64  # Only needed when switching
+    try:
+        payload = creds["id_token"].split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return claims.get("email")
+    except (KeyError, IndexError, AttributeError, TypeError, ValueError):
+        return None
+
+
+def _same_login(live_creds, profile_creds, account):
+    """
+    False if the live credentials provably belong to another login than
+    `account`: a different id_token email, or a different refresh_token than
+    the profile copy.
+    """
+    try:
+        live = json.loads(live_creds)
+        saved = json.loads(profile_creds) if profile_creds else {}
+    except ValueError:
+        return True
+    if not isinstance(live, dict) or not isinstance(saved, dict):
+        return True
+    email = _token_email(live)
+    if email:
+        return email.lower() == account.lower()
+    if live.get("refresh_token") and saved.get("refresh_token"):
+        return live["refresh_token"] == saved["refresh_token"]
+    return True
+
+
+def _write_back(account, warnings):
+    """
+    Save the live credentials and account ID of `account` into its profile if
+    they changed since they were installed. Returns True if anything was written.
+    """
+    profile_dir = PROFILES_DIR / account
+    written = False
+
+    if CREDS_FILE.is_symlink():
+        # The CLI writes through the link straight into a profile copy
+        live_creds = None
+    else:
+        live_creds = _read_bytes(CREDS_FILE)
+    if live_creds is not None:
+        installed = state_store.get(INSTALLED_KEY) or {}
+        digest = _digest(live_creds)
+        # Same content as installed: unchanged. Installed for another account:
+        # a switch was interrupted before google_accounts.json was updated.
+        if digest != installed.get("sha256"):
+            if not _same_login(live_creds, _read_bytes(profile_dir / "oauth_creds.json"), account):
+                warnings.append(f"Live credentials belong to another login, not saved to {account}")
+                return False
+            profile_dir.mkdir(parents=True, exist_ok=True)
+            fsutil.atomic_write(profile_dir / "oauth_creds.json", live_creds)
+            written = True
+
+    live_id = _read_bytes(ID_FILE)
+    if live_id is not None and live_id != _read_bytes(profile_dir / "google_account_id"):
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        fsutil.atomic_write(profile_dir / "google_account_id", live_id)
+        written = True
+    return written
+
+
+def _install(target_dir, switch_mode, result):
+    """Make the target profile's credentials and account ID live."""
+    target_creds = target_dir / "oauth_creds.json"
+    creds = _read_bytes(target_creds)
+    if creds is None:
+        raise OSError(f"cannot read {target_creds}")
+
+    # Recorded first: if we crash after the swap, the next switch knows whose file is live
+    state_store.put(INSTALLED_KEY, {"account": target_dir.name, "sha256": _digest(creds)})
+    if switch_mode == "symlink":
+        try:
+            _atomic_symlink(CREDS_FILE, target_creds.resolve())
+        except (OSError, NotImplementedError) as e:
+            result["warnings"].append(f"Symlink not possible ({e}), copied credentials instead")
+            switch_mode = "copy"
+    if switch_mode != "symlink":
+        fsutil.atomic_write(CREDS_FILE, creds, os.stat(target_creds).st_mode & 0o777)
+
+    target_id = _read_bytes(target_dir / "google_account_id")
+    if target_id is not None:
+        if target_id != _read_bytes(ID_FILE):
+            fsutil.atomic_write(ID_FILE, target_id)
+    elif ID_FILE.exists():
+        ID_FILE.unlink(missing_ok=True)
+
+
+def resolve_target(target_arg, count):
+    """
+    Resolve an index ("1"-based), email or partial email to a profile name
+    through the profile index (`count` profiles). Returns (email, error, detail).
+    """
+    if profile_cache.profile_position(target_arg) is not None:
+        return target_arg, None, ""
+
+    if target_arg.isdigit():
+        email = profile_cache.profile_at(int(target_arg) - 1) if int(target_arg) > 0 else None
+        if email:
+            return email, None, ""
+        return None, "index_out_of_range", f"1-{count}"
+
+    matches = profile_cache.find_profiles(target_arg, limit=AMBIGUOUS_LIMIT)
+    if len(matches) == 1:
+        return matches[0], None, ""
+    if matches:
+        return None, "ambiguous", ", ".join(matches)
+    return None, "not_found", ""
+
+
+def switch_to(target_arg, switch_mode=None):
+    """
+    Switch to the specified account by index or email.
+    switch_mode "copy" installs a copy of the profile's credentials, "symlink"
+    links oauth_creds.json to it (default from auto_switch.switch_mode).
+    """
+    count = profile_cache.profile_count()
+    if not count:
+        return _result(error="no_profiles")
+
+    target_email, error, detail = resolve_target(target_arg, count)
+    if error:
+        return _result(error=error, detail=detail, account=target_arg)
+
+    target_dir = PROFILES_DIR / target_email
+    target_creds = target_dir / "oauth_creds.json"
+    if not target_creds.exists():
+        return _result(error="missing_credentials", account=target_email)
+
+    data = get_account_data()
+    current_active = data.get('active')
+
+    if current_active == target_email:
+        return _result(ok=True, account=target_email, previous=current_active)
+
+    result = _result(previous=current_active)
+    if switch_mode is None:
+        switch_mode = load_auto_switch_config()["switch_mode"]
+
+    try:
+        # Backup current credentials (only if the CLI changed them)
+        if current_active:
+            result["written_back"] = _write_back(current_active, result["warnings"])
+
+        # Perform switch
+        _install(target_dir, switch_mode, result)
+
+        # Gemini CLI caches tokens. We must delete this cache to force it to use our new oauth_creds.json
+        if TOKEN_CACHE_FILE.exists():
+            try:
+                TOKEN_CACHE_FILE.unlink()
+                result["token_cache_cleared"] = True
+            except OSError as e:
+                result["warnings"].append(f"Failed to clear token cache: {e}")
+    except OSError as e:
+        result.update(error="io_error", detail=str(e), account=current_active)
+        return result
+
+    # Update state
+    if current_active and current_active != target_email:
+        if 'old' not in data:
+            data['old'] = []
+        if current_active not in data['old']:
+            data['old'].append(current_active)
+    data['active'] = target_email
+    if 'old' in data and target_email in data['old']:
+        data['old'].remove(target_email)
+
+    try:
+        fsutil.atomic_write(ACCOUNTS_JSON, json.dumps(data, indent=2).encode("utf-8"))
+    except OSError as e:
+        result["warnings"].append(f"Failed to update {ACCOUNTS_JSON.name}: {e}")
+
+    result.update(ok=True, account=target_email, switched=True)
+    return result
+
+
+def switch_balanced(auto_switch=None, exclude=None):
+    """
+    Switch to the account picked by quota-weighted balancing (see
+    account_selector.pick_balanced); `exclude` is never picked. The pick may
+    be the active account, in which case nothing changes (switched False).
+    """
+    if not profile_cache.profile_count():
+        return _result(error="no_profiles")
+    if auto_switch is None:
+        auto_switch = load_auto_switch_config()
+
+    current = profile_cache.get_active_account()
+    account, weight, exhausted = account_selector.pick_balanced(
+        profile_cache.list_profiles(), auto_switch, exclude=exclude)
+    if account is None:
+        return _result(error="all_exhausted", account=current, previous=current,
+                       mode="balanced", score=None, weight=None, exhausted=exhausted)
+
+    result = switch_to(account)
+    score, _ = account_selector.account_health(account, auto_switch)
+    result.update(mode="balanced", score=score, weight=weight, exhausted=exhausted)
+    return result
+
+
+def switch_next(mode=None, auto_switch=None):
+    """
+    Switch to the next account in rotation.
+    mode "quota" picks the healthiest account by cached quota, "sequential"
+    takes the alphabetical neighbour, "balanced" a quota-weighted pick among
+    the other accounts (default from auto_switch.rotation).
+    """
+    if not profile_cache.profile_count():
+        return _result(error="no_profiles")
+
+    current = profile_cache.get_active_account()
+    next_account = profile_cache.next_profile(current)
+    if next_account is None:
+        return _result(error="single_account", account=current, previous=current)
+
+    if auto_switch is None:
+        auto_switch = load_auto_switch_config()
+    mode = mode or auto_switch["rotation"]
+
+    if mode == "balanced":
+        return switch_balanced(auto_switch, exclude=current)
+    if mode != "quota":
+        result = switch_to(next_account)
+        result.update(mode=mode, score=None, exhausted=[])
+        return result
+
+    candidates, exhausted = account_selector.rank_accounts(profile_cache.list_profiles(), current, auto_switch)
+    if not candidates:
+        return _result(error="all_exhausted", account=current, previous=current,
+                       mode=mode, score=None, exhausted=exhausted)
+
+    next_account, score = candidates[0]
+    result = switch_to(next_account)
+    result.update(mode=mode, score=score, exhausted=exhausted)
+    return result
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the hooks and account switching.
+
+Starts a local stand-in for the Code Assist API (loadCodeAssist,
+retrieveUserQuota, streamGenerateContent) and the OAuth token endpoint on
+127.0.0.1, builds a
+throwaway ~/.gemini sandbox with a pool of synthetic profiles (HOME is
+redirected, your real profiles are untouched), and runs the real entry points
+with synthetic stdin contexts. The entry points reach the mock through the
+CODE_ASSIST_ENDPOINT and GOOGLE_TOKEN_URL environment variables.
+
+Tokens and projects are derived from the account index ("bench-<i>-...",
+"bench-project-<i>"), and streamGenerateContent echoes the token and project
+it was called with, so the proxy_switch scenario can check that the auth
+proxy signs each request with the account that was just switched to. A
+scenario may run a "service" (the proxy) in the sandbox for its duration.
+
+Each scenario is run once per pool size; the report lists the wall-clock
+latency of a run (interpreter start included) as p50/p95/p99/max and the
+mock API calls per run.
+
+Usage:
+    python benchmark.py                          # All scenarios, pools of 1, 100, 10000
+    python benchmark.py --pools 1,1000 --runs 50
+    python benchmark.py --scenario pre_check_miss --latency 150
+    python benchmark.py --error-rate 0.05 --401-rate 0.1 --429-rate 0.1
+    python benchmark.py --json results.json      # Also write raw results
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+SOURCE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(SOURCE_DIR))
+
+from hook_trace import percentile  # noqa: E402
+
+DEFAULT_POOLS = [1, 100, 10000]
+DEFAULT_RUNS = 20
+MODELS = ["gemini-3-pro-preview", "gemini-2.5-pro", "gemini-2.5-flash"]
+HEALTHY_FRACTION = 0.9
+LOW_FRACTION = 0.01
+
+# name: entry point, stdin, auth_config auto_switch overrides, mock quota fraction.
+# argv may be a function of the run index (e.g. to alternate switch targets);
+# "service" is started in the sandbox before the runs and stopped afterwards.
+SCENARIOS = {
+    "pre_check_hit": {
+        "argv": ["quota_pre_check.py"],
+        "stdin": json.dumps({"session_id": "bench"}),
+        "auto_switch": {"cache_minutes": 60},
+        "fraction": HEALTHY_FRACTION,
+    },
+    "pre_check_miss": {
+        "argv": ["quota_pre_check.py"],
+        "stdin": json.dumps({"session_id": "bench"}),
+        "auto_switch": {"cache_minutes": 0},
+        "fraction": HEALTHY_FRACTION,
+    },
+    "pre_check_switch": {
+        "argv": ["quota_pre_check.py"],
+        "stdin": json.dumps({"session_id": "bench"}),
+        "auto_switch": {"cache_minutes": 0},
+        "fraction": LOW_FRACTION,
+    },
+    "auto_switch_ok": {
+        "argv": ["quota_auto_switch.py"],
+        "stdin": json.dumps({"session_id": "bench", "prompt_response": "All done. " * 2000}),
+        "auto_switch": {},
+        "fraction": HEALTHY_FRACTION,
+    },
+    # 429 while the quota is fine (rate-limit blip): re-checked, no switch
+    "auto_switch_429": {
+        "argv": ["quota_auto_switch.py"],
+        "stdin": json.dumps({"session_id": "bench",
+                             "prompt_response": "[API Error: 429 RESOURCE_EXHAUSTED] Quota exceeded"}),
+        "auto_switch": {"max_retries": 1000000},
+        "fraction": HEALTHY_FRACTION,
+    },
+    # 429 with the quota really exhausted: re-checked, switch
+    "auto_switch_exhausted": {
+        "argv": ["quota_auto_switch.py"],
+        "stdin": json.dumps({"session_id": "bench",
+                             "prompt_response": "[API Error: 429 RESOURCE_EXHAUSTED] Quota exceeded"}),
+        "auto_switch": {"max_retries": 1000000},
+        "fraction": LOW_FRACTION,
+    },
+    "gchange_next": {
+        "argv": ["gemini_cli_auth_manager.py", "next"],
+        "stdin": "",
+        "auto_switch": {},
+        "fraction": HEALTHY_FRACTION,
+    },
+    "gchange_switch": {
+        "argv": lambda i: ["gemini_cli_auth_manager.py", str(i % 2 + 1)],
+        "stdin": "",
+        "auto_switch": {},
+        "fraction": HEALTHY_FRACTION,
+    },
+    # Switch, then one streamed request through the auth proxy (fails on a wrong token/project)
+    "proxy_switch": {
+        "argv": lambda i: ["benchmark.py", "--proxy-client", str(i % 2 + 1)],
+        "stdin": "",
+        "auto_switch": {},
+        "fraction": HEALTHY_FRACTION,
+        "service": ["auth_proxy.py", "serve", "--port", "0"],
+    },
+}
+
+
+# --- Mock Code Assist / OAuth server ---
+class MockCodeAssist:
+    """
+    Stand-in for the Code Assist API and the token endpoint.
+    Every request is delayed by `latency_ms`, then fails with 500, 401 or 429
+    at the given rates (the token endpoint only with 500). Calls are counted
+    per (endpoint, status).
+    """
+
+    def __init__(self, latency_ms=0.0, error_rate=0.0, rate_401=0.0, rate_429=0.0, seed=0):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rate_401 = rate_401
+        self.rate_429 = rate_429
+        self.fraction = HEALTHY_FRACTION
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.server = None
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            protocol_version = "HTTP/1.1"  # Chunked SSE responses
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, reply = mock.respond(self.path, self.headers, body)
+                if isinstance(reply, list):
+                    # Server-sent events, one chunk per event
+                    self.send_response(status)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for event in reply:
+                        data = f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8")
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                payload = json.dumps(reply).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.handle_error = lambda request, client_address: None  # Clients dropping keep-alive connections
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def reset(self, fraction):
+        with self.lock:
+            self.calls = {}
+            self.fraction = fraction
+
+    def respond(self, path, headers=None, body=b""):
+        """Return (status, JSON body or list of SSE events) for a request."""
+        path = path.split("?", 1)[0]
+        endpoint = path.rsplit(":", 1)[-1] if ":" in path else path.strip("/")
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            roll = self.random.random()
+            if roll < self.error_rate:
+                status = 500
+            elif endpoint != "token" and roll < self.error_rate + self.rate_401:
+                status = 401
+            elif endpoint != "token" and roll < self.error_rate + self.rate_401 + self.rate_429:
+                status = 429
+            else:
+                status = 200
+            key = (endpoint, status)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            fraction = self.fraction
+
+        if status == 500:
+            return status, {"error": {"code": 500, "status": "INTERNAL"}}
+        if status == 401:
+            return status, {"error": {"code": 401, "status": "UNAUTHENTICATED"}}
+        if status == 429:
+            return status, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}
+
+        if endpoint == "token":
+            from urllib.parse import parse_qs
+            refresh_token = parse_qs(body.decode("ascii", "replace")).get("refresh_token", ["bench"])[0]
+            index = refresh_token.rsplit("-", 1)[-1]  # "bench-refresh-<i>"
+            return 200, {"access_token": f"bench-{index}-{time.time_ns()}", "expires_in": 3600, "token_type": "Bearer"}
+
+        token = (headers or {}).get("Authorization", "").replace("Bearer ", "")
+        index = token.split("-")[1] if token.count("-") >= 1 else "0"
+        if endpoint == "loadCodeAssist":
+            return 200, {"cloudaicompanionProject": f"bench-project-{index}",
+                         "currentTier": {"id": "free-tier", "name": "Gemini Code Assist"}}
+        if endpoint == "streamGenerateContent":
+            try:
+                project = json.loads(body).get("project")
+            except (ValueError, AttributeError):
+                project = None
+            return 200, [
+                {"response": {"candidates": [{"content": {"parts": [{"text": "pong"}]}}]}},
+                {"echo": {"token": token, "project": project}},
+            ]
+        if endpoint == "retrieveUserQuota":
+            reset_time = (datetime.now(timezone.utc) + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            return 200, {"buckets": [
+                {"modelId": model, "remainingFraction": fraction, "resetTime": reset_time} for model in MODELS
+            ]}
+        return 404, {"error": {"code": 404, "status": "NOT_FOUND"}}
+
+
+# --- Sandbox ---
+def account_name(index):
+    return f"bench{index:05d}@example.com"
+
+
+def build_sandbox(root, pool_size, auto_switch):
+    """Create a ~/.gemini with `pool_size` accounts, each with a fresh healthy quota cache."""
+    gemini_dir = Path(root) / ".gemini"
+    expiry = int((time.time() + 86400) * 1000)
+    timestamp = datetime.now().isoformat()
+    buckets = [{"modelId": model, "remainingFraction": HEALTHY_FRACTION} for model in MODELS]
+
+    for index in range(pool_size):
+        account = account_name(index)
+        profile = gemini_dir / "auth_profiles" / account
+        profile.mkdir(parents=True)
+        creds = {"access_token": f"bench-{index}", "refresh_token": f"bench-refresh-{index}", "expiry_date": expiry}
+        (profile / "oauth_creds.json").write_text(json.dumps(creds), encoding="utf-8")
+        # Imported into the state store when the first run creates it
+        (profile / "quota_cache.json").write_text(json.dumps({
+            "timestamp": timestamp, "account": account, "buckets": buckets, "cache_minutes": 60,
+        }), encoding="utf-8")
+
+    active = account_name(0)
+    (gemini_dir / "oauth_creds.json").write_bytes(
+        (gemini_dir / "auth_profiles" / active / "oauth_creds.json").read_bytes())
+    (gemini_dir / "google_accounts.json").write_text(
+        json.dumps({"active": active, "old": []}), encoding="utf-8")
+    config = {"enabled": True, "strategy": "gemini3-first", "threshold": 5, "rotation": "quota"}
+    config.update(auto_switch)
+    (gemini_dir / "auth_config.json").write_text(
+        json.dumps({"language": "en", "auto_switch": config}), encoding="utf-8")
+
+
+# --- Runner ---
+def proxy_client(target):
+    """
+    Run inside a sandbox (benchmark.py --proxy-client N): switch to account N,
+    send one streamGenerateContent through the auth proxy with a stale token
+    and project, and check the echoed ones. Returns the process exit code.
+    """
+    import requests
+    import auth_proxy
+    import auth_switch
+    import profile_cache
+
+    count = profile_cache.profile_count()
+    target = (int(target) - 1) % count + 1
+    result = auth_switch.switch_to(str(target))
+    if not result["ok"]:
+        print(f"switch failed: {result['error']}", file=sys.stderr)
+        return 1
+
+    index = str(target - 1)  # Profiles are sorted, so #N is account_name(N - 1)
+    url = auth_proxy.load_state()["url"]
+    response = requests.post(f"{url}/v1internal:streamGenerateContent?alt=sse", stream=True, timeout=30,
+                             headers={"Authorization": "Bearer cli-stale-token"},
+                             json={"model": MODELS[0], "project": "cli-project", "request": {}})
+    echo = None
+    for line in response.iter_lines():
+        if line.startswith(b"data: "):
+            event = json.loads(line[6:])
+            echo = event.get("echo", echo)
+    if response.status_code != 200 or not echo:
+        print(f"proxy request failed: HTTP {response.status_code}", file=sys.stderr)
+        return 1
+    if echo["token"].split("-")[1] != index or echo["project"] != f"bench-project-{index}":
+        print(f"wrong account: expected #{index}, upstream saw {echo}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def start_service(argv, env):
+    """Start a scenario's service in the sandbox and wait until the auth proxy answers."""
+    proc = subprocess.Popen([sys.executable, str(SOURCE_DIR / argv[0])] + argv[1:], env=env,
+                            cwd=str(SOURCE_DIR), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    probe = [sys.executable, "-c", "import auth_proxy, sys; sys.exit(0 if auth_proxy.status() else 1)"]
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if subprocess.run(probe, env=env, cwd=str(SOURCE_DIR)).returncode == 0:
+            return proc
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"service did not start: {' '.join(argv)}")
+
+
+def run_scenario(name, scenario, pool_size, runs, mock):
+    """Run one scenario against a fresh sandbox; returns a result dict."""
+    with tempfile.TemporaryDirectory(prefix="gchange-bench-") as home:
+        build_sandbox(home, pool_size, scenario["auto_switch"])
+        env = dict(os.environ, HOME=home, USERPROFILE=home,
+                   CODE_ASSIST_ENDPOINT=mock.url, GOOGLE_TOKEN_URL=f"{mock.url}/token",
+                   GCHANGE_TRACE="0", NO_PROXY="127.0.0.1", no_proxy="127.0.0.1")
+        service = start_service(scenario["service"], env) if scenario.get("service") else None
+
+        def argv(i):
+            args = scenario["argv"](i) if callable(scenario["argv"]) else scenario["argv"]
+            return [sys.executable, str(SOURCE_DIR / args[0])] + args[1:]
+
+        # Warm-up: writes .pyc and creates the state store (imports the pool's caches)
+        subprocess.run(argv(runs), input=scenario["stdin"], capture_output=True, text=True,
+                       cwd=str(SOURCE_DIR), env=env)
+        mock.reset(scenario["fraction"])
+
+        samples = []
+        failures = 0
+        for i in range(runs):
+            started = time.perf_counter()
+            proc = subprocess.run(argv(i), input=scenario["stdin"], capture_output=True, text=True,
+                                  cwd=str(SOURCE_DIR), env=env)
+            samples.append((time.perf_counter() - started) * 1000)
+            if proc.returncode != 0:
+                failures += 1
+
+        if service:
+            service.terminate()
+            service.wait()
+
+    samples.sort()
+    calls = {}
+    for (endpoint, status), count in mock.calls.items():
+        calls.setdefault(endpoint, {})[str(status)] = count
+    return {
+        "scenario": name,
+        "pool": pool_size,
+        "runs": runs,
+        "failures": failures,
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+        "max": samples[-1],
+        "calls": calls,
+    }
+
+
+def format_calls(calls, runs):
+    """Calls per run by endpoint, with non-200 statuses in brackets."""
+    parts = []
+    for endpoint in sorted(calls):
+        by_status = calls[endpoint]
+        total = sum(by_status.values())
+        errors = ",".join(f"{status}x{count}" for status, count in sorted(by_status.items()) if status != "200")
+        parts.append(f"{endpoint} {total / runs:.2f}" + (f" [{errors}]" if errors else ""))
+    return "; ".join(parts) or "-"
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ["--proxy-client"]:
+        sys.exit(proxy_client(args[1]))
+
+    pools, runs = DEFAULT_POOLS, DEFAULT_RUNS
+    mock_options = {}
+    names = list(SCENARIOS)
+    json_file = None
+    try:
+        if "--pools" in args:
+            pools = [int(p) for p in args[args.index("--pools") + 1].split(",")]
+        if "--runs" in args:
+            runs = max(1, int(args[args.index("--runs") + 1]))
+        if "--latency" in args:
+            mock_options["latency_ms"] = float(args[args.index("--latency") + 1])
+        for flag, option in (("--error-rate", "error_rate"), ("--401-rate", "rate_401"), ("--429-rate", "rate_429")):
+            if flag in args:
+                mock_options[option] = float(args[args.index(flag) + 1])
+        if "--scenario" in args:
+            names = [args[i + 1] for i, arg in enumerate(args) if arg == "--scenario"]
+        if "--json" in args:
+            json_file = args[args.index("--json") + 1]
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(2)
+
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenario: {', '.join(unknown)} (valid: {', '.join(SCENARIOS)})")
+        sys.exit(2)
+
+    mock = MockCodeAssist(**mock_options).start()
+    results = []
+    try:
+        print(f"{'Scenario':<22} {'Pool':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}  API calls per run")
+        print("-" * 104)
+        for name in names:
+            for pool_size in pools:
+                result = run_scenario(name, SCENARIOS[name], pool_size, runs, mock)
+                results.append(result)
+                failed = f"  ({result['failures']} failed)" if result["failures"] else ""
+                print(f"{name:<22} {pool_size:>6} {result['p50']:>8.1f} {result['p95']:>8.1f} "
+                      f"{result['p99']:>8.1f} {result['max']:>8.1f}  {format_calls(result['calls'], runs)}{failed}",
+                      flush=True)
+    finally:
+        mock.stop()
+
+    if json_file:
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump({"options": mock_options, "runs": runs, "results": results}, f, indent=2)
+    sys.exit(1 if any(r["failures"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Shared configuration loader for Gemini CLI Auth Manager.
+
+auth_config.json is read by the CLI, both hooks, the quota daemon and the
+shared modules. load() turns it into one validated, normalized snapshot:
+
+    {
+        "language": "en" | "cn",
+        "oauth_client": {"client_id", "client_secret"} | None,
+        "auto_switch": {
+            # Every key of DEFAULT_AUTO_SWITCH, type-checked, defaults filled in.
+            # threshold is a FRACTION here (auth_config.json stores percent).
+            "model_matcher": spec,   # Matcher for model_pattern
+            "custom_matcher": spec,  # Matcher for custom_model_pattern
+            ...
+        },
+        "warnings": [str],  # Invalid values that were replaced by defaults
+    }
+
+Matchers are stored as specs that need no regex work in the common case:
+("prefix", "gemini-3") for literal patterns such as "gemini-3.*",
+("regex", pattern) otherwise, None for an empty or invalid pattern.
+matcher(spec) turns a spec into a match function with re.match() semantics
+(memoized; regexes are compiled on first use).
+
+The snapshot is cached in ~/.gemini/auth_config.cache (marshal), keyed by
+auth_config.json's mtime and size, and memoized per process: hooks read one
+small binary file instead of parsing JSON, validating and compiling patterns.
+gchange config still edits the raw JSON (percent units) and drops the cache
+file on save.
+"""
+import json
+import marshal
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import fsutil
+
+# --- Configuration Paths ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+CONFIG_FILE = GEMINI_DIR / "auth_config.json"
+CACHE_FILE = GEMINI_DIR / "auth_config.cache"
+
+SNAPSHOT_VERSION = 4  # Bump when the snapshot layout changes
+
+STRATEGIES = ["conservative", "gemini3-first", "custom", "predictive"]
+ROTATION_MODES = ["quota", "sequential", "balanced"]
+BALANCE_ALGORITHMS = ["smooth", "random"]
+BALANCE_SCOPES = ["session", "request"]
+SWITCH_MODES = ["copy", "symlink"]
+LANGUAGES = ["en", "cn"]
+
+# auth_config.json "auto_switch" defaults, in file units (threshold in percent)
+DEFAULT_AUTO_SWITCH = {
+    "enabled": True,
+    "strategy": "gemini3-first",
+    "model_pattern": "gemini-3.*",
+    "custom_model_pattern": "",
+    "threshold": 5,
+    "max_retries": 3,
+    "notify_on_switch": True,
+    "auto_restart": False,
+    "cache_minutes": 3,
+    "models_to_check": ["gemini-3-pro-preview", "gemini-2.5-pro"],
+    "rotation": "quota",
+    "balance_algorithm": "smooth",
+    "balance_scope": "session",
+    "error_scan_window": 4096,
+    "max_stale_minutes": 0,
+    "token_refresh_minutes": 10,
+    "trace": False,
+    "switch_mode": "copy",
+}
+
+BOOL_KEYS = ["enabled", "notify_on_switch", "auto_restart", "trace"]
+INT_KEYS = ["max_retries", "error_scan_window"]
+NUMBER_KEYS = ["threshold", "cache_minutes", "max_stale_minutes", "token_refresh_minutes"]
+CHOICE_KEYS = {
+    "strategy": STRATEGIES,
+    "rotation": ROTATION_MODES,
+    "balance_algorithm": BALANCE_ALGORITHMS,
+    "balance_scope": BALANCE_SCOPES,
+    "switch_mode": SWITCH_MODES,
+}
+PATTERN_KEYS = {"model_pattern": "model_matcher", "custom_model_pattern": "custom_matcher"}
+
+_REGEX_META = set(".^$*+?{}[]\\|()")
+
+# Snapshot of this process, reused while auth_config.json is unchanged (kept warm by the quota daemon)
+_memo = {"stamp": None, "snapshot": None}
+
+
+def compile_spec(pattern):
+    """Turn a model pattern into a matcher spec (None if empty or invalid)."""
+    if not pattern or not isinstance(pattern, str):
+        return None
+    literal = pattern[:-2] if pattern.endswith(".*") else pattern
+    if literal and not _REGEX_META.intersection(literal):
+        # re.match() of a literal (optionally followed by .*) is a prefix test
+        return ("prefix", literal)
+    import re  # Only for patterns that are real regexes
+    try:
+        re.compile(pattern)
+    except re.error:
+        return None
+    return ("regex", pattern)
+
+
+@lru_cache(maxsize=32)
+def matcher(spec):
+    """Return a match function (model_id -> bool) for a spec, or None. Case-sensitive, like re.match()."""
+    if spec is None:
+        return None
+    kind, value = spec
+    if kind == "prefix":
+        return lambda model_id: model_id.startswith(value)
+    import re
+    return re.compile(value).match
+
+
+def strategy_matcher(auto_switch):
+    """
+    Return the match function of the configured strategy's models: the custom
+    pattern for "custom", model_pattern otherwise; None for "conservative" or
+    when the pattern is empty or invalid.
+    """
+    strategy = auto_switch.get("strategy", DEFAULT_AUTO_SWITCH["strategy"])
+    if strategy == "conservative":
+        return None
+    key = "custom_model_pattern" if strategy == "custom" else "model_pattern"
+    spec_key = PATTERN_KEYS[key]
+    spec = auto_switch[spec_key] if spec_key in auto_switch else compile_spec(auto_switch.get(key))
+    return matcher(spec)
+
+
+def _normalize_auto_switch(raw, warnings):
+    """Validate the auto_switch section; returns the normalized dict (threshold as a fraction)."""
+    if not isinstance(raw, dict):
+        if raw is not None:
+            warnings.append("auto_switch is not an object, using defaults")
+        raw = {}
+
+    auto_switch = {key: value for key, value in raw.items() if key not in DEFAULT_AUTO_SWITCH}
+    for key, default in DEFAULT_AUTO_SWITCH.items():
+        value = raw.get(key, default)
+        if key in BOOL_KEYS:
+            valid = isinstance(value, (bool, int))
+            value = bool(value) if valid else value
+        elif key in INT_KEYS:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+            value = int(value) if valid else value
+        elif key in NUMBER_KEYS:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+        elif key in CHOICE_KEYS:
+            valid = value in CHOICE_KEYS[key]
+        elif key == "models_to_check":
+            if isinstance(value, str):
+                value = [m.strip() for m in value.split(",") if m.strip()]
+            valid = isinstance(value, list) and all(isinstance(m, str) for m in value)
+        else:
+            valid = isinstance(value, str)
+        if not valid:
+            warnings.append(f"auto_switch.{key}: invalid value {value!r}, using {default!r}")
+            value = default
+        auto_switch[key] = list(value) if isinstance(value, list) else value
+
+    if auto_switch["threshold"] > 100:
+        warnings.append(f"auto_switch.threshold: {auto_switch['threshold']} is above 100%, using 100")
+        auto_switch["threshold"] = 100
+    auto_switch["threshold"] = auto_switch["threshold"] / 100
+    if 0 < auto_switch["max_stale_minutes"] <= auto_switch["cache_minutes"]:
+        # A stale snapshot is one older than cache_minutes: nothing would ever be served stale
+        warnings.append(f"auto_switch.max_stale_minutes: {auto_switch['max_stale_minutes']} is not above "
+                        f"cache_minutes ({auto_switch['cache_minutes']}), using 0 (off)")
+        auto_switch["max_stale_minutes"] = 0
+
+    for key, spec_key in PATTERN_KEYS.items():
+        auto_switch[spec_key] = compile_spec(auto_switch[key])
+        if auto_switch[key] and auto_switch[spec_key] is None:
+            warnings.append(f"auto_switch.{key}: invalid regex {auto_switch[key]!r}")
+    return auto_switch
+
+
+def build(raw):
+    """Build a snapshot from the parsed auth_config.json (any JSON value)."""
+    warnings = []
+    if not isinstance(raw, dict):
+        if raw is not None:
+            warnings.append("auth_config.json is not an object, using defaults")
+        raw = {}
+
+    language = raw.get("language", "en")
+    if language not in LANGUAGES:
+        warnings.append(f"language: invalid value {language!r}, using 'en'")
+        language = "en"
+
+    oauth = raw.get("oauth_client")
+    oauth_client = None
+    if isinstance(oauth, dict) and oauth.get("client_id") and oauth.get("client_secret"):
+        oauth_client = {"client_id": oauth["client_id"], "client_secret": oauth["client_secret"]}
+
+    return {
+        "language": language,
+        "oauth_client": oauth_client,
+        "auto_switch": _normalize_auto_switch(raw.get("auto_switch"), warnings),
+        "warnings": warnings,
+    }
+
+
+def _cache_key(stamp):
+    return [SNAPSHOT_VERSION, marshal.version, list(stamp)]
+
+
+def _read_cache(stamp):
+    """Return the cached snapshot if it was built from the file with `stamp`."""
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            cached = marshal.load(f)
+        if cached["key"] == _cache_key(stamp):
+            return cached["snapshot"]
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        pass
+    return None
+
+
+def _write_cache(stamp, snapshot):
+    """Store the snapshot atomically (best effort)."""
+    try:
+        data = marshal.dumps({"key": _cache_key(stamp), "snapshot": snapshot})
+        fsutil.atomic_write(CACHE_FILE, data, fsync=False)  # Rebuilt from auth_config.json if lost
+    except (OSError, ValueError):
+        pass
+
+
+def load():
+    """Return the snapshot of auth_config.json (defaults if the file is missing or invalid)."""
+    stamp = fsutil.file_stamp(CONFIG_FILE)
+    if _memo["snapshot"] is not None and _memo["stamp"] == stamp:
+        return _memo["snapshot"]
+
+    snapshot = _read_cache(stamp) if stamp else None
+    if snapshot is None:
+        raw = None
+        if stamp:
+            try:
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    raw = json.load(f)
+            except (OSError, ValueError):
+                raw = None
+        snapshot = build(raw)
+        if stamp and raw is not None:
+            _write_cache(stamp, snapshot)
+
+    _memo["stamp"] = stamp
+    _memo["snapshot"] = snapshot
+    return snapshot
+
+
+def invalidate():
+    """Drop the cached snapshot (called after auth_config.json is rewritten)."""
+    _memo["snapshot"] = None
+    try:
+        CACHE_FILE.unlink()
+    except OSError:
+        pass
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+File helpers shared by Gemini CLI Auth Manager's modules.
+
+file_stamp() is the change-detection key of every memoized file read;
+atomic_write() is how every file other programs or sessions read is replaced:
+readers see the old or the new content, never a partial file.
+"""
+import os
+
+
+def file_stamp(path):
+    """Return (mtime_ns, size) of a file for change detection, or None if missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def atomic_write(path, data, mode=None, follow_symlinks=False, fsync=True):
+    """
+    Write bytes via a temp file in the same directory and os.replace.
+    mode defaults to the existing file's, else 0600. A symlink at `path` is
+    replaced itself, or with follow_symlinks the file it points to is updated.
+    fsync=False skips the flush to disk (for caches that can be rebuilt).
+    """
+    import tempfile  # Only needed when writing
+
+    path = os.path.realpath(path) if follow_symlinks else os.fspath(path)
+    if mode is None:
+        try:
+            mode = 0o600 if os.path.islink(path) else os.stat(path).st_mode & 0o777
+        except OSError:
+            mode = 0o600
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -2,19 +2,26 @@
 """
 Gemini CLI Auth Manager v2.2
 Fast account switching with auto-rotation support for Gemini CLI.
+
+Startup cost matters: "gchange next" and the hooks sit on the prompt path,
+so heavy modules (requests, webbrowser, http.server, subprocess) are imported
+inside the commands that need them. Check with: python startup_budget.py
 """
+import time
+
+_STARTED = time.perf_counter()  # Start of the script, for the "import" trace phase
+
 import json
 import os
-import re
 import shutil
-import subprocess
 import sys
-import time
-import webbrowser
-import requests
 from pathlib import Path
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+
+import auth_switch
+import config_snapshot
+import hook_trace
+import profile_cache
+import state_store
 
 # --- OAuth Constants ---
 # Client credentials are loaded from ~/.gemini/auth_config.json (written by install.py)
@@ -38,6 +45,8 @@ ID_FILE = GEMINI_DIR / "google_account_id"
 CONFIG_FILE = GEMINI_DIR / "auth_config.json"
 
 # --- Default Configuration ---
+# Written when auth_config.json does not exist yet. Readers go through
+# config_snapshot, which fills in every missing key from DEFAULT_AUTO_SWITCH.
 DEFAULT_CONFIG = {
     "language": "en",
     "oauth_client": {
@@ -53,23 +62,16 @@ DEFAULT_CONFIG = {
         "max_retries": 3,
         "notify_on_switch": True,
         "auto_restart": False,
-        "cache_minutes": 3
+        "cache_minutes": 3,
+        "rotation": "quota"
     }
 }
 
 def _init_oauth_credentials():
     """Load OAuth client credentials from ~/.gemini/auth_config.json at startup."""
-    if CONFIG_FILE.exists():
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                cfg = json.load(f)
-            oauth = cfg.get("oauth_client", {})
-            cid = oauth.get("client_id", "")
-            cs = oauth.get("client_secret", "")
-            if cid and cs:
-                return cid, cs
-        except Exception:
-            pass
+    oauth = config_snapshot.load()["oauth_client"]
+    if oauth:
+        return oauth["client_id"], oauth["client_secret"]
     return DEFAULT_CONFIG["oauth_client"]["client_id"], DEFAULT_CONFIG["oauth_client"]["client_secret"]
 
 GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET = _init_oauth_credentials()
@@ -109,6 +111,7 @@ LANG = {
         "conservative_desc": "Switch when ALL models exhausted",
         "gemini3_desc": "Switch when Gemini 3.x exhausted",
         "custom_desc": "Switch when CUSTOM model exhausted",
+        "predictive_desc": "Switch when Gemini 3.x will run out before the next quota refresh",
         "enter_custom_pattern": "Enter model regex (e.g. gemini-2.5-pro.*): ",
         "auto_config": "Auto-Switch Configuration",
         "set_threshold": "Set Threshold",
@@ -154,7 +157,10 @@ LANG = {
         "login_success": "Login successful. Account captured:",
         "login_failed": "Login failed or credentials not found.",
         "backup_restored": "Original credentials restored.",
-        "pool_login": "Login to new account (Auto-Capture)"
+        "pool_login": "Login to new account (Auto-Capture)",
+        "pool_refresh": "Refresh expiring tokens",
+        "tokens_refreshed": "tokens refreshed",
+        "tokens_fresh": "still fresh"
     },
     "cn": {
         "title": "GEMINI-CLI 账号管理器 v2.2",
@@ -189,6 +195,7 @@ LANG = {
         "conservative_desc": "所有模型耗尽时切换",
         "gemini3_desc": "Gemini 3.x 耗尽时切换",
         "custom_desc": "自定义模型耗尽时切换",
+        "predictive_desc": "按消耗速度预测，Gemini 3.x 在下次刷新前耗尽时切换",
         "enter_custom_pattern": "请输入模型匹配正则 (例: gemini-2.5-pro.*): ",
         "auto_config": "自动切换配置",
         "set_threshold": "设置阈值",
@@ -234,7 +241,10 @@ LANG = {
         "login_success": "登录成功，账号已捕获：",
         "login_failed": "登录失败或未找到凭证。",
         "backup_restored": "原始凭证已恢复。",
-        "pool_login": "登录新账号 (自动捕获)"
+        "pool_login": "登录新账号 (自动捕获)",
+        "pool_refresh": "刷新即将过期的 Token",
+        "tokens_refreshed": "个 Token 已刷新",
+        "tokens_fresh": "个仍有效"
     }
 }
 
@@ -263,7 +273,11 @@ class UI:
 
 # --- Configuration Management ---
 def load_config():
-    """Load configuration from file, return defaults if not exists."""
+    """
+    Load the raw configuration for editing (percent threshold, only the keys
+    in the file); return defaults if not exists. Use config_snapshot.load()
+    for the effective, validated values.
+    """
     if CONFIG_FILE.exists():
         try:
             with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
@@ -275,8 +289,7 @@ def load_config():
 
 def get_lang():
     """Get current language from config."""
-    config = load_config()
-    return config.get("language", "en")
+    return config_snapshot.load()["language"]
 
 
 def t(key):
@@ -290,6 +303,9 @@ def save_config(config):
     try:
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(config, f, indent=2, ensure_ascii=False)
+        config_snapshot.invalidate()
+        # Strategy/threshold decide which accounts count as exhausted: rebuild the calendar
+        state_store.delete_exhaustion()
         return True
     except Exception as e:
         print(f"{UI.RED}[Error] Failed to save config: {e}{UI.RESET}")
@@ -298,9 +314,7 @@ def save_config(config):
 
 def get_profiles():
     """Get sorted list of profile names."""
-    if not PROFILES_DIR.exists():
-        return []
-    return sorted([d.name for d in PROFILES_DIR.iterdir() if d.is_dir()])
+    return profile_cache.list_profiles()
 
 
 def get_active_account():
@@ -316,137 +330,83 @@ def get_active_account():
 
 def get_account_data():
     """Get full account data."""
-    if ACCOUNTS_JSON.exists():
-        try:
-            with open(ACCOUNTS_JSON, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    return {"active": None, "old": []}
+    return auth_switch.get_account_data()
 
 
 # --- Core Functions ---
-def fast_switch(target_arg, silent=False):
-    """Switch to specified account by index or email."""
-    profiles = get_profiles()
-    if not profiles:
-        if not silent:
-            print(f"{UI.RED}[Error] No profiles found.{UI.RESET}")
-        return None
-
-    target_dir = PROFILES_DIR / target_arg
-    target_email = target_arg
-
-    # Handle numeric index
-    if not target_dir.exists():
-        if target_arg.isdigit():
-            idx = int(target_arg) - 1
-            if 0 <= idx < len(profiles):
-                target_email = profiles[idx]
-                target_dir = PROFILES_DIR / target_email
-            else:
-                if not silent:
-                    print(f"{UI.RED}[Error] Index {target_arg} out of range (1-{len(profiles)}).{UI.RESET}")
-                return None
-        else:
-            if not silent:
-                print(f"{UI.RED}[Error] Account not found: {target_arg}{UI.RESET}")
-            return None
-
-    target_creds = target_dir / "oauth_creds.json"
-    if not target_creds.exists():
-        if not silent:
-            print(f"{UI.RED}[Error] Missing credentials for: {target_email}{UI.RESET}")
-        return None
-
-    data = get_account_data()
-    current_active = data.get('active')
-
-    if current_active == target_email:
-        if not silent:
-            print(f"{UI.GREEN}[OK] Already using {target_email}{UI.RESET}")
-        return target_email
-
-    # Backup current credentials
-    if current_active:
-        curr_dir = PROFILES_DIR / current_active
-        curr_dir.mkdir(parents=True, exist_ok=True)
-        if CREDS_FILE.exists():
-            shutil.copy2(CREDS_FILE, curr_dir / "oauth_creds.json")
-        if ID_FILE.exists():
-            shutil.copy2(ID_FILE, curr_dir / "google_account_id")
-
-    # Perform switch
-    try:
-        shutil.copy2(target_creds, CREDS_FILE)
-        t_id = target_dir / "google_account_id"
-        if t_id.exists():
-            shutil.copy2(t_id, ID_FILE)
-        elif ID_FILE.exists():
-            ID_FILE.unlink(missing_ok=True)
-            
-        # --- NEW: Clear Token Cache ---
-        # Gemini CLI caches tokens. We must delete this cache to force it to use our new oauth_creds.json
-        cache_file = GEMINI_DIR / "mcp-oauth-tokens-v2.json"
-        if cache_file.exists():
-            try:
-                cache_file.unlink()
-                if not silent:
-                    print(f"{UI.DIM}  [Cache] Cleared token cache to force reload.{UI.RESET}")
-            except OSError as e:
-                if not silent:
-                    print(f"{UI.YELLOW}[Warning] Failed to clear token cache: {e}{UI.RESET}")
-        # ------------------------------
-    except OSError as e:
-        if not silent:
-            print(f"{UI.RED}[Error] Switch failed: {e}{UI.RESET}")
-        return None
-
-    # Update state
-    if current_active and current_active != target_email:
-        if 'old' not in data:
-            data['old'] = []
-        if current_active not in data['old']:
-            data['old'].append(current_active)
-    data['active'] = target_email
-    if 'old' in data and target_email in data['old']:
-        data['old'].remove(target_email)
-
-    try:
-        with open(ACCOUNTS_JSON, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
-    except:
-        pass
-
-    if not silent:
-        print(f"{UI.GREEN}[OK] Switched to {target_email}{UI.RESET}")
-    return target_email
-
-
-def switch_next(silent=False):
-    """Switch to the next account in rotation."""
-    profiles = get_profiles()
-    if not profiles:
-        if not silent:
-            print(f"{UI.RED}[Error] No profiles found.{UI.RESET}")
+def _print_switch_result(result, silent=False):
+    """Print the outcome of an auth_switch call; returns the active email or None."""
+    if silent:
+        return result["account"] if result["ok"] else None
+
+    error = result["error"]
+    if error == "no_profiles":
+        print(f"{UI.RED}[Error] No profiles found.{UI.RESET}")
+    elif error == "index_out_of_range":
+        print(f"{UI.RED}[Error] Index {result['account']} out of range ({result['detail']}).{UI.RESET}")
+    elif error == "not_found":
+        print(f"{UI.RED}[Error] Account not found: {result['account']}{UI.RESET}")
+    elif error == "ambiguous":
+        print(f"{UI.YELLOW}[Warning] '{result['account']}' matches several accounts: {result['detail']}{UI.RESET}")
+    elif error == "missing_credentials":
+        print(f"{UI.RED}[Error] Missing credentials for: {result['account']}{UI.RESET}")
+    elif error == "io_error":
+        print(f"{UI.RED}[Error] Switch failed: {result['detail']}{UI.RESET}")
+    elif error == "single_account":
+        print(f"{UI.YELLOW}[Warning] Only one account available.{UI.RESET}")
+    elif error == "all_exhausted":
+        exhausted = result.get("exhausted") or []
+        reset_at = exhausted[0][2] if exhausted else None
+        when = f" (next reset: {reset_at.astimezone().strftime('%H:%M')})" if reset_at else ""
+        print(f"{UI.YELLOW}[Warning] All other accounts are exhausted{when}.{UI.RESET}")
+
+    for warning in result["warnings"]:
+        print(f"{UI.YELLOW}[Warning] {warning}{UI.RESET}")
+
+    if not result["ok"]:
         return None
 
-    current = get_active_account()
-    if current and current in profiles:
-        current_idx = profiles.index(current)
-        next_idx = (current_idx + 1) % len(profiles)
+    if not result["switched"]:
+        print(f"{UI.GREEN}[OK] Already using {result['account']}{UI.RESET}")
     else:
-        next_idx = 0
-
-    next_account = profiles[next_idx]
-    
-    # Check if we've cycled through all accounts
-    if next_account == current:
-        if not silent:
-            print(f"{UI.YELLOW}[Warning] Only one account available.{UI.RESET}")
-        return None
-
-    return fast_switch(next_account, silent=silent)
+        if result["token_cache_cleared"]:
+            print(f"{UI.DIM}  [Cache] Cleared token cache to force reload.{UI.RESET}")
+        print(f"{UI.GREEN}[OK] Switched to {result['account']}{UI.RESET}")
+    return result["account"]
+
+
+def fast_switch(target_arg, silent=False, started=None):
+    """
+    Switch to specified account by index or email.
+    `started` (the command line passes _STARTED) adds the script's import time to the trace.
+    """
+    hook_trace.begin("fast_switch", started=started)
+    with hook_trace.span("switch"):
+        result = auth_switch.switch_to(target_arg)
+    hook_trace.finish(switched=result["switched"], account=result["account"], error=result["error"])
+    return _print_switch_result(result, silent=silent)
+
+
+def switch_next(silent=False, mode=None, started=None):
+    """
+    Switch to the next account in rotation.
+    mode "quota" picks the healthiest account by cached quota, "sequential"
+    takes the alphabetical neighbour (default from auto_switch.rotation).
+    `started`: see fast_switch().
+    """
+    hook_trace.begin("switch_next", started=started)
+    with hook_trace.span("config"):
+        auto_switch = config_snapshot.load()["auto_switch"]
+    with hook_trace.span("switch"):
+        result = auth_switch.switch_next(mode=mode, auto_switch=auto_switch)
+    hook_trace.finish(switched=result["switched"], account=result["account"], error=result["error"])
+
+    if not silent and result.get("exhausted"):
+        print(f"{UI.DIM}  Skipping {len(result['exhausted'])} exhausted account(s): "
+              f"{', '.join(a for a, _, _ in result['exhausted'])}{UI.RESET}")
+    if not silent and result["ok"] and result.get("score") is not None:
+        print(f"{UI.DIM}  Picked {result['account']} (cached quota {result['score'] * 100:.0f}%){UI.RESET}")
+    return _print_switch_result(result, silent=silent)
 
 
 def list_status():
@@ -454,8 +414,7 @@ def list_status():
     UI.header()
     
     active = get_active_account()
-    config = load_config()
-    auto_switch = config.get("auto_switch", {})
+    auto_switch = config_snapshot.load()["auto_switch"]
 
     # Status Section
     print(f"\n  {UI.BOLD}STATUS:{UI.RESET}")
@@ -465,10 +424,10 @@ def list_status():
         print(f"  [ ACTIVE ] {UI.YELLOW}None{UI.RESET}")
     
     # Auto-switch status
-    if auto_switch.get("enabled", False):
-        strategy = auto_switch.get("strategy", "gemini3-first")
-        threshold = auto_switch.get("threshold", 5)
-        print(f"  [ AUTO   ] {UI.CYAN}Enabled{UI.RESET} | Strategy: {strategy} | Threshold: {threshold}%")
+    if auto_switch["enabled"]:
+        strategy = auto_switch["strategy"]
+        threshold = auto_switch["threshold"] * 100
+        print(f"  [ AUTO   ] {UI.CYAN}Enabled{UI.RESET} | Strategy: {strategy} | Threshold: {threshold:g}%")
     else:
         print(f"  [ AUTO   ] {UI.DIM}Disabled{UI.RESET}")
     
@@ -494,12 +453,16 @@ def list_status():
     # Usage
     print(f"\n  {UI.BOLD}USAGE:{UI.RESET}")
     print(f"  gchange                    List accounts")
-    print(f"  gchange <number|email>     Switch account")
-    print(f"  gchange next               Switch to next account")
+    print(f"  gchange <number|email>     Switch account (partial email works)")
+    print(f"  gchange next [sequential]  Switch to healthiest (or next) account")
     print(f"  gchange menu               Interactive menu")
     print(f"  gchange pool               Manage account pool")
+    print(f"  gchange quota [--all]      Show quota (active / all accounts)")
     print(f"  gchange strategy [name]    View/set strategy")
     print(f"  gchange config [key] [val] View/set config")
+    print(f"  gchange daemon [start|stop] Manage quota daemon")
+    print(f"  gchange proxy [start|stop]  Switch without restart (auth proxy)")
+    print(f"  gchange stats [--hours N]  Hook latency per phase (needs config trace true)")
     print(f"\n{UI.CYAN}{UI.line('=')}{UI.RESET}\n")
 
 
@@ -518,11 +481,12 @@ def handle_strategy(args):
         print(f"  1. {UI.CYAN}conservative{UI.RESET}  - {t('conservative_desc')}")
         print(f"  2. {UI.CYAN}gemini3-first{UI.RESET} - {t('gemini3_desc')}")
         print(f"  3. {UI.CYAN}custom{UI.RESET}         - {t('custom_desc')}")
-        print(f"\n{UI.BOLD}Usage:{UI.RESET} gchange strategy <conservative|gemini3-first|custom>")
+        print(f"  4. {UI.CYAN}predictive{UI.RESET}     - {t('predictive_desc')}")
+        print(f"\n{UI.BOLD}Usage:{UI.RESET} gchange strategy <conservative|gemini3-first|custom|predictive>")
         return
     
     strategy = args[0].lower()
-    valid_strategies = ["conservative", "gemini3-first", "custom"]
+    valid_strategies = config_snapshot.STRATEGIES
     
     if strategy not in valid_strategies:
         print(f"{UI.RED}[Error] Invalid strategy: {strategy}{UI.RESET}")
@@ -565,21 +529,29 @@ def handle_config(args):
     """Handle config command."""
     config = load_config()
     auto_switch = config.get("auto_switch", DEFAULT_CONFIG["auto_switch"])
+    snapshot = config_snapshot.load()
+    effective = snapshot["auto_switch"]
     
     if not args:
-        # Show full config
+        # Show the effective config (defaults filled in)
         print(f"\n{UI.BOLD}Auto-Switch Configuration:{UI.RESET}")
-        print(f"  enabled        : {UI.GREEN if auto_switch.get('enabled') else UI.RED}{auto_switch.get('enabled', True)}{UI.RESET}")
-        print(f"  strategy       : {UI.CYAN}{auto_switch.get('strategy', 'gemini3-first')}{UI.RESET}")
-        print(f"  model_pattern  : {auto_switch.get('model_pattern', 'gemini-3.*')}")
-        print(f"  threshold      : {auto_switch.get('threshold', 5)}%")
-        print(f"  cache_minutes  : {auto_switch.get('cache_minutes', 5)}")
-        print(f"  models_to_check: {auto_switch.get('models_to_check', [])}")
+        print(f"  enabled        : {UI.GREEN if effective['enabled'] else UI.RED}{effective['enabled']}{UI.RESET}")
+        print(f"  strategy       : {UI.CYAN}{effective['strategy']}{UI.RESET}")
+        print(f"  model_pattern  : {effective['model_pattern']}")
+        print(f"  threshold      : {effective['threshold'] * 100:g}%")
+        print(f"  cache_minutes  : {effective['cache_minutes']}")
+        print(f"  models_to_check: {effective['models_to_check']}")
+        balance = (f" ({effective['balance_algorithm']}, per {effective['balance_scope']})"
+                   if effective["rotation"] == "balanced" else "")
+        print(f"  rotation       : {effective['rotation']}{balance}")
+        print(f"  switch_mode    : {effective['switch_mode']}")
+        for warning in snapshot["warnings"]:
+            print(f"  {UI.YELLOW}[Warning] {warning}{UI.RESET}")
         print(f"\n{UI.BOLD}Usage:{UI.RESET} gchange config <key> <value>")
         return
     
     key = args[0].lower()
-    valid_keys = ["enabled", "strategy", "model_pattern", "threshold", "max_retries", "notify_on_switch", "cache_minutes", "models_to_check"]
+    valid_keys = list(config_snapshot.DEFAULT_AUTO_SWITCH)
     
     if key not in valid_keys:
         print(f"{UI.RED}[Error] Invalid config key: {key}{UI.RESET}")
@@ -587,24 +559,41 @@ def handle_config(args):
         return
     
     if len(args) < 2:
-        # Show specific key value
-        print(f"{key} = {auto_switch.get(key, 'not set')}")
+        # Show specific key value (threshold in percent, as stored in the file)
+        value = effective[key]
+        if key == "threshold":
+            value = f"{value * 100:g}"
+        print(f"{key} = {value}")
         return
     
     value = args[1]
     
     # Type conversion
-    if key in ["enabled", "notify_on_switch"]:
+    if key in config_snapshot.BOOL_KEYS:
         value = value.lower() in ["true", "1", "yes", "on"]
-    elif key in ["threshold", "max_retries", "cache_minutes"]:
+    elif key in config_snapshot.INT_KEYS or key in config_snapshot.NUMBER_KEYS:
         try:
-            value = int(value)
+            value = float(value) if key in config_snapshot.NUMBER_KEYS else int(value)
         except ValueError:
             print(f"{UI.RED}[Error] {key} must be a number.{UI.RESET}")
             return
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if value < 0 or (key == "threshold" and value > 100):
+            print(f"{UI.RED}[Error] {key} is out of range.{UI.RESET}")
+            return
     elif key == "models_to_check":
         # Parse comma-separated list
         value = [x.strip() for x in value.split(",") if x.strip()]
+    elif key in config_snapshot.CHOICE_KEYS:
+        value = value.lower()
+        choices = config_snapshot.CHOICE_KEYS[key]
+        if value not in choices:
+            print(f"{UI.RED}[Error] {key} must be one of: {', '.join(choices)}{UI.RESET}")
+            return
+    elif key in config_snapshot.PATTERN_KEYS and value and config_snapshot.compile_spec(value) is None:
+        print(f"{UI.RED}[Error] Invalid regex: {value}{UI.RESET}")
+        return
     
     auto_switch[key] = value
     config["auto_switch"] = auto_switch
@@ -640,6 +629,7 @@ def handle_pool(args):
         print(f"  gchange pool login <email>    {t('pool_login')}")
         print(f"  gchange pool remove <n>       {t('remove_account')}")
         print(f"  gchange pool import <path>    {t('import_creds')}")
+        print(f"  gchange pool refresh [--force] {t('pool_refresh')}")
         return
     
     subcmd = args[0].lower()
@@ -651,14 +641,198 @@ def handle_pool(args):
         remove_account(subargs)
     elif subcmd == "import":
         import_account(subargs)
+    elif subcmd == "refresh":
+        refresh_pool_tokens(subargs)
     else:
         print(f"{UI.RED}[Error] Unknown pool command: {subcmd}{UI.RESET}")
-        print("Valid commands: add, remove, import")
+        print("Valid commands: login, remove, import, refresh")
+
+
+def handle_quota(args):
+    """Handle quota command - show quota of the active account or the whole pool."""
+    import quota_api_client
+    
+    if "--all" in args or "all" in args:
+        quota_api_client.main_all(args)
+    else:
+        quota_api_client.main()
+
+
+def handle_daemon(args):
+    """Handle daemon command - manage the background quota daemon used by hooks."""
+    import quota_daemon
+    
+    subcmd = args[0].lower() if args else "status"
+    
+    if subcmd == "start":
+        status = quota_daemon.start_daemon()
+        if status:
+            print(f"{UI.GREEN}[OK] Quota daemon running (PID {status['pid']}){UI.RESET}")
+        else:
+            print(f"{UI.RED}[Error] Failed to start quota daemon. See {quota_daemon.LOG_FILE}{UI.RESET}")
+    elif subcmd == "stop":
+        if quota_daemon.stop_daemon():
+            print(f"{UI.GREEN}[OK] Quota daemon stopped.{UI.RESET}")
+        else:
+            print(f"{UI.DIM}Quota daemon is not running.{UI.RESET}")
+    elif subcmd == "restart":
+        quota_daemon.stop_daemon()
+        time.sleep(0.5)
+        handle_daemon(["start"])
+    elif subcmd == "status":
+        status = quota_daemon.ping()
+        if status:
+            print(f"{UI.GREEN}[OK] Quota daemon running{UI.RESET} "
+                  f"(PID {status['pid']}, uptime {status['uptime']}s, {status['requests']} requests served)")
+        else:
+            print(f"{UI.DIM}Quota daemon is not running. Hooks run in-process.{UI.RESET}")
+    else:
+        print(f"{UI.RED}[Error] Unknown daemon command: {subcmd}{UI.RESET}")
+        print("Valid commands: start, stop, restart, status")
+
+
+def _print_proxy_endpoint(url):
+    """Show how to point Gemini CLI at the auth proxy."""
+    print(f"  Start Gemini CLI with:")
+    if os.name == 'nt':
+        print(f"    {UI.BOLD}$env:CODE_ASSIST_ENDPOINT=\"{url}\"{UI.RESET}   (PowerShell)")
+        print(f"    {UI.BOLD}set CODE_ASSIST_ENDPOINT={url}{UI.RESET}   (cmd)")
+    else:
+        print(f"    {UI.BOLD}export CODE_ASSIST_ENDPOINT={url}{UI.RESET}")
+    print(f"  {UI.DIM}Keep the URL private: it lets local programs use your pooled accounts.{UI.RESET}")
+
+
+def handle_proxy(args):
+    """Handle proxy command - manage the local auth proxy (account switches without CLI restart)."""
+    import auth_proxy
+    
+    subcmd = args[0].lower() if args else "status"
+    
+    if subcmd == "start":
+        port = None
+        try:
+            if "--port" in args:
+                port = int(args[args.index("--port") + 1])
+        except (IndexError, ValueError):
+            print(f"{UI.RED}[Error] Usage: gchange proxy start [--port N]{UI.RESET}")
+            return
+        status = auth_proxy.start_proxy(port)
+        if status:
+            print(f"{UI.GREEN}[OK] Auth proxy running (PID {status['pid']}, port {status['port']}){UI.RESET}")
+            _print_proxy_endpoint(auth_proxy.load_state()["url"])
+        else:
+            print(f"{UI.RED}[Error] Failed to start auth proxy. See {auth_proxy.LOG_FILE}{UI.RESET}")
+    elif subcmd == "stop":
+        if auth_proxy.stop_proxy():
+            print(f"{UI.GREEN}[OK] Auth proxy stopped.{UI.RESET}")
+        else:
+            print(f"{UI.DIM}Auth proxy is not running.{UI.RESET}")
+    elif subcmd == "restart":
+        auth_proxy.stop_proxy()
+        time.sleep(0.5)
+        handle_proxy(["start"] + args[1:])
+    elif subcmd == "status":
+        status = auth_proxy.status()
+        if status:
+            print(f"{UI.GREEN}[OK] Auth proxy running{UI.RESET} "
+                  f"(PID {status['pid']}, uptime {status['uptime']}s, {status['requests']} requests served, "
+                  f"serving {status['account'] or '-'})")
+            _print_proxy_endpoint(auth_proxy.load_state()["url"])
+        else:
+            print(f"{UI.DIM}Auth proxy is not running. Switches need a CLI restart.{UI.RESET}")
+    else:
+        print(f"{UI.RED}[Error] Unknown proxy command: {subcmd}{UI.RESET}")
+        print("Valid commands: start, stop, restart, status")
+
+
+def handle_stats(args):
+    """
+    Handle stats command - summarize the hook trace:
+    gchange stats [--hours N]   (default: last 24 hours)
+    """
+    hours = 24.0
+    try:
+        if "--hours" in args:
+            hours = float(args[args.index("--hours") + 1])
+    except (IndexError, ValueError):
+        print(f"{UI.RED}[Error] Usage: gchange stats [--hours N]{UI.RESET}")
+        return
+    
+    restart = state_store.get("last_restart")
+    if isinstance(restart, dict) and restart.get("total_ms") is not None:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(restart.get("ts", 0)))
+        print(f"\n{UI.BOLD}Last auto-restart:{UI.RESET} {when}, {restart['total_ms']:.0f} ms "
+              f"{UI.DIM}(hook exit {restart.get('hook_wait_ms', 0):.0f} ms, "
+              f"shutdown {restart.get('shutdown_ms', 0):.0f} ms [{restart.get('shutdown')}], "
+              f"launch {restart.get('launch_ms', 0):.0f} ms){UI.RESET}")
+    
+    summary = hook_trace.summarize(hook_trace.load_records(since=time.time() - hours * 3600))
+    if not summary:
+        print(f"{UI.DIM}No trace records in the last {hours:g}h.{UI.RESET}")
+        if not hook_trace.enabled():
+            print(f"{UI.DIM}Tracing is off. Enable it with: gchange config trace true{UI.RESET}")
+        return
+    
+    def row(label, latency):
+        values = "".join(f"{latency[f'p{pct}']:>9.1f}" for pct in hook_trace.PERCENTILES)
+        print(f"    {label:<22}{latency['count']:>7}{values}")
+    
+    print(f"\n{UI.BOLD}Hook latency, last {hours:g}h (ms):{UI.RESET}")
+    for hook, stats in summary.items():
+        print(f"\n  {UI.CYAN}{hook}{UI.RESET}  {stats['runs']} runs, {stats['switched']} switches")
+        print(f"    {UI.DIM}{'phase':<22}{'count':>7}" +
+              "".join(f"{'p' + str(pct):>9}" for pct in hook_trace.PERCENTILES) + UI.RESET)
+        row("total", stats["total"])
+        for phase, latency in sorted(stats["phases"].items(), key=lambda item: -item[1]["p50"]):
+            row(phase, latency)
+        if stats["cache"]:
+            lookups = sum(stats["cache"].values())
+            served = stats["cache"].get("hit", 0) + stats["cache"].get("stale", 0)
+            breakdown = ", ".join(f"{name} {count}" for name, count in sorted(stats["cache"].items()))
+            print(f"    cache hit ratio: {served / lookups * 100:.0f}% ({breakdown})")
+    print()
+
+
+def refresh_pool_tokens(args):
+    """
+    Refresh the access tokens of pooled accounts that expire soon:
+    gchange pool refresh [--force] [--lead MIN] [--workers N] [--rate PER_SEC]
+    """
+    import token_scheduler
+    
+    lead = config_snapshot.load()["auto_switch"]["token_refresh_minutes"] or token_scheduler.DEFAULT_LEAD_MINUTES
+    workers = token_scheduler.DEFAULT_WORKERS
+    rate = token_scheduler.DEFAULT_RATE
+    try:
+        if "--lead" in args:
+            lead = float(args[args.index("--lead") + 1])
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+        if "--rate" in args:
+            rate = float(args[args.index("--rate") + 1])
+    except (IndexError, ValueError):
+        print(f"{UI.RED}[Error] Usage: gchange pool refresh [--force] [--lead MIN] [--workers N] [--rate PER_SEC]{UI.RESET}")
+        return
+    
+    started = time.monotonic()
+    results, skipped = token_scheduler.refresh_pool(
+        lead_minutes=lead, workers=workers, rate=rate, force="--force" in args)
+    
+    for r in results:
+        if r["ok"]:
+            print(f"  {UI.GREEN}[OK]{UI.RESET} {r['account']:40s} {UI.DIM}valid {int(r['expires_in'] // 60)} min{UI.RESET}")
+        else:
+            print(f"  {UI.RED}[{t('error')}]{UI.RESET} {r['account']:40s} {r['error']}")
+    for account, wait in skipped:
+        print(f"  {UI.DIM}[--] {account:40s} refresh due in {int(wait // 60)} min{UI.RESET}")
+    
+    ok_count = sum(1 for r in results if r["ok"])
+    print(f"\n{ok_count}/{len(results)} {t('tokens_refreshed')}, {len(skipped)} {t('tokens_fresh')} "
+          f"({time.monotonic() - started:.1f}s)")
 
 
 def remove_account(args):
     """Remove an account from the pool."""
-    profiles = get_profiles()
     active = get_active_account()
     
     if not args:
@@ -671,14 +845,12 @@ def remove_account(args):
     
     # Find target
     if target.isdigit():
-        idx = int(target) - 1
-        if 0 <= idx < len(profiles):
-            target_email = profiles[idx]
-        else:
+        target_email = profile_cache.profile_at(int(target) - 1) if int(target) > 0 else None
+        if not target_email:
             print(f"{UI.RED}[Error] Invalid index: {target}{UI.RESET}")
             return
     else:
-        if target in profiles:
+        if profile_cache.profile_position(target) is not None:
             target_email = target
         else:
             print(f"{UI.RED}[Error] Account not found: {target}{UI.RESET}")
@@ -703,6 +875,7 @@ def remove_account(args):
     profile_dir = PROFILES_DIR / target_email
     try:
         shutil.rmtree(profile_dir)
+        profile_cache.forget_account(target_email)
         print(f"{UI.GREEN}[OK] Removed: {target_email}{UI.RESET}")
         
         # Update accounts.json
@@ -765,36 +938,47 @@ def import_account(args):
     print(f"{UI.GREEN}[OK] Imported: {email}{UI.RESET}")
 
 
-class OAuthCallbackHandler(BaseHTTPRequestHandler):
-    """Handles Google OAuth callback on localhost."""
-    def log_message(self, format, *args):
-        pass # Silent logging
+def _make_oauth_callback_handler():
+    """Build the OAuth callback handler class (http.server is imported on demand)."""
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
 
-    def do_GET(self):
-        query = urlparse(self.path).query
-        params = parse_qs(query)
-        self.server.auth_code = params.get('code', [None])[0]
-        
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        
-        success_msg = """
-        <html>
-        <body style='font-family: sans-serif; text-align: center; padding: 50px;'>
-            <h1 style='color: #4CAF50;'>Authentication Successful!</h1>
-            <p>You can close this window and return to the application.</p>
-            <script>setTimeout(function() { window.close(); }, 2000);</script>
-        </body>
-        </html>
-        """
-        self.wfile.write(success_msg.encode('utf-8'))
+    class OAuthCallbackHandler(BaseHTTPRequestHandler):
+        """Handles Google OAuth callback on localhost."""
+        def log_message(self, format, *args):
+            pass # Silent logging
+
+        def do_GET(self):
+            query = urlparse(self.path).query
+            params = parse_qs(query)
+            self.server.auth_code = params.get('code', [None])[0]
+            
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html; charset=utf-8')
+            self.end_headers()
+            
+            success_msg = """
+            <html>
+            <body style='font-family: sans-serif; text-align: center; padding: 50px;'>
+                <h1 style='color: #4CAF50;'>Authentication Successful!</h1>
+                <p>You can close this window and return to the application.</p>
+                <script>setTimeout(function() { window.close(); }, 2000);</script>
+            </body>
+            </html>
+            """
+            self.wfile.write(success_msg.encode('utf-8'))
+
+    return OAuthCallbackHandler
 
 
 def login_account(args):
     """Native Python OAuth flow to login and capture credentials to pool."""
-    # Find a free port
     import socket
+    import webbrowser
+    from http.server import HTTPServer
+    import requests
+    
+    # Find a free port
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind(('127.0.0.1', 0))
         port = s.getsockname()[1]
@@ -822,7 +1006,7 @@ def login_account(args):
     print(f"  {UI.CYAN}{auth_url}{UI.RESET}\n")
     
     # Start local server
-    server = HTTPServer(('127.0.0.1', port), OAuthCallbackHandler)
+    server = HTTPServer(('127.0.0.1', port), _make_oauth_callback_handler())
     server.auth_code = None
     
     # Open browser
@@ -966,14 +1150,17 @@ def interactive_menu():
             print(f"  1. {UI.CYAN}conservative{UI.RESET}  - {t('conservative_desc')}")
             print(f"  2. {UI.CYAN}gemini3-first{UI.RESET} - {t('gemini3_desc')}")
             print(f"  3. {UI.CYAN}custom{UI.RESET}         - {t('custom_desc')}")
+            print(f"  4. {UI.CYAN}predictive{UI.RESET}     - {t('predictive_desc')}")
             try:
-                strat_choice = input(f"\n  {t('enter_choice')} (1-3): ").strip()
+                strat_choice = input(f"\n  {t('enter_choice')} (1-4): ").strip()
                 if strat_choice == "1":
                     handle_strategy(["conservative"])
                 elif strat_choice == "2":
                     handle_strategy(["gemini3-first"])
                 elif strat_choice == "3":
                     handle_strategy(["custom"])
+                elif strat_choice == "4":
+                    handle_strategy(["predictive"])
                 input(f"\n  {t('press_enter')}")
             except (EOFError, KeyboardInterrupt):
                 pass
@@ -982,6 +1169,7 @@ def interactive_menu():
             # View current quota
             try:
                 # Use subprocess to run independent script to avoid scope pollution
+                import subprocess
                 subprocess.run(
                     ["python", str(GEMINI_DIR / "quota_api_client.py")], 
                     check=False
@@ -1085,7 +1273,12 @@ def main():
     
     # Command routing
     if command == "next":
-        switch_next()
+        mode = args[0].lower() if args else None
+        if mode and mode not in config_snapshot.ROTATION_MODES:
+            print(f"{UI.RED}[Error] Unknown rotation mode: {mode}{UI.RESET}")
+            print(f"Valid modes: {', '.join(config_snapshot.ROTATION_MODES)}")
+            return
+        switch_next(mode=mode, started=_STARTED)
     elif command == "menu":
         interactive_menu()
     elif command == "pool":
@@ -1094,13 +1287,21 @@ def main():
         handle_strategy(args)
     elif command == "config":
         handle_config(args)
+    elif command == "quota":
+        handle_quota(args)
+    elif command == "daemon":
+        handle_daemon(args)
+    elif command == "proxy":
+        handle_proxy(args)
+    elif command == "stats":
+        handle_stats(args)
     elif command in ["list", "-l"]:
         list_status()
     elif command in ["help", "-h", "--help"]:
         list_status()
     else:
         # Treat as account identifier
-        fast_switch(command)
+        fast_switch(command, started=_STARTED)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Streaming reader for hook contexts on stdin.
+
+Gemini CLI passes the whole turn to AfterAgent hooks as one JSON object, and
+prompt_response can be several megabytes. read_context() scans the stream
+incrementally and materializes only the requested top-level fields:
+
+- other values are skipped without building Python objects for them
+- long string values keep only their first and last `max_chars` characters,
+  joined by a newline (enough for banner-style error detection)
+- once every requested field is found, the rest of the input is drained
+  without parsing
+
+Memory stays bounded by the chunk size plus the kept text, whatever the
+size of the turn.
+"""
+import codecs
+import json
+import re
+from json.decoder import scanstring
+
+CHUNK_SIZE = 64 * 1024
+
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_SCALAR_END = re.compile(r'[,}\]\s]')
+_WHITESPACE = re.compile(r'[^ \t\r\n]')
+
+# Longest escaped form of one character: a \uXXXX\uXXXX surrogate pair
+_MAX_ESCAPE_LEN = 12
+
+
+class ContextParseError(ValueError):
+    """Raised when the hook input is not a JSON object."""
+
+
+class _Scanner:
+    """Character scanner over a binary stream with a sliding text buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read one more chunk, dropping consumed text; returns False at EOF."""
+        if self.eof:
+            return False
+        data = self.stream.read(CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            self.buf = self.buf[self.pos:] + self.decoder.decode(b"", final=True)
+            self.pos = 0
+            return False
+        if isinstance(data, str):
+            text = data
+        else:
+            text = self.decoder.decode(data)
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it ('' at EOF)."""
+        while True:
+            match = _WHITESPACE.search(self.buf, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ContextParseError(f"expected {char!r}")
+        self.pos += 1
+
+    def search(self, pattern, collect=None):
+        """
+        Advance to the next match of `pattern`; returns the matched character ('' at EOF).
+        Skipped text is passed to `collect` (if given) before the buffer moves on.
+        """
+        while True:
+            match = pattern.search(self.buf, self.pos)
+            end = match.start() if match else len(self.buf)
+            if collect is not None and end > self.pos:
+                collect(self.buf[self.pos:end])
+            self.pos = end
+            if match:
+                return self.buf[end]
+            if not self.fill():
+                return ""
+
+    def drain(self):
+        """Read the rest of the stream without decoding it."""
+        self.buf, self.pos = "", 0
+        while self.stream.read(CHUNK_SIZE):
+            pass
+        self.eof = True
+
+
+class _CappedText:
+    """Accumulates decoded string pieces, keeping only the head and tail."""
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.head = []
+        self.head_len = 0
+        self.tail = []
+        self.tail_len = 0
+        self.dropped = False
+
+    def add(self, text):
+        if not text:
+            return
+        if self.max_chars is None:
+            self.head.append(text)
+            return
+
+        if self.head_len < self.max_chars:
+            room = self.max_chars - self.head_len
+            self.head.append(text[:room])
+            self.head_len += min(len(text), room)
+            text = text[room:]
+            if not text:
+                return
+
+        self.tail.append(text)
+        self.tail_len += len(text)
+        while self.tail_len > self.max_chars:
+            excess = self.tail_len - self.max_chars
+            if len(self.tail[0]) <= excess:
+                self.tail_len -= len(self.tail.pop(0))
+            else:
+                self.tail[0] = self.tail[0][excess:]
+                self.tail_len -= excess
+            self.dropped = True
+
+    def value(self):
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        return head + "\n" + tail if self.dropped else head + tail
+
+
+def _decode_prefix(buf, pos):
+    """
+    Decode buf[pos:] as the inside of a string that continues past the buffer.
+    An escape cut off at the end is left for the next chunk.
+    Returns (text, end).
+    """
+    for cut in range(_MAX_ESCAPE_LEN + 1):
+        end = len(buf) - cut
+        if end < pos:
+            break
+        try:
+            text, _ = scanstring(buf[pos:end] + '"', 0, False)
+        except ValueError:
+            continue
+        # A lone high surrogate means the pair's second half is in the next chunk
+        if text and "\ud800" <= text[-1] <= "\udbff":
+            continue
+        return text, end
+    raise ContextParseError("invalid string escape")
+
+
+def _read_string(scanner, collect=None):
+    """
+    Consume a JSON string (opening quote already consumed).
+    The decoded text is passed to `collect` (if given), possibly in pieces.
+    """
+    while True:
+        buf, pos = scanner.buf, scanner.pos
+        if buf.find('"', pos) >= 0:
+            try:
+                text, end = scanstring(buf, pos, False)
+            except ValueError:
+                pass  # Only escaped quotes in this chunk
+            else:
+                if collect is not None:
+                    collect(text)
+                scanner.pos = end
+                return
+
+        text, end = _decode_prefix(buf, pos)
+        if collect is not None:
+            collect(text)
+        scanner.pos = end
+        if not scanner.fill():
+            raise ContextParseError("unterminated string")
+
+
+def _skip_value(scanner):
+    """Skip one JSON value without decoding it."""
+    char = scanner.peek()
+    if char == '"':
+        scanner.pos += 1
+        _read_string(scanner)
+    elif char in ('{', '['):
+        depth = 0
+        while True:
+            char = scanner.search(_STRUCTURE)
+            if char == '':
+                raise ContextParseError("unexpected end of input")
+            scanner.pos += 1
+            if char == '"':
+                _read_string(scanner)
+            elif char in ('{', '['):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+    elif char:
+        _read_scalar(scanner)
+    else:
+        raise ContextParseError("unexpected end of input")
+
+
+def _read_scalar(scanner):
+    """Read a number / true / false / null."""
+    parts = []
+    scanner.search(_SCALAR_END, parts.append)
+    try:
+        return json.loads("".join(parts))
+    except ValueError:
+        raise ContextParseError("invalid literal")
+
+
+def _read_value(scanner, max_chars):
+    """Read one JSON value; long strings are capped, containers are fully decoded."""
+    char = scanner.peek()
+    if char == '"':
+        scanner.pos += 1
+        text = _CappedText(max_chars)
+        _read_string(scanner, text.add)
+        return text.value()
+    if char in ('{', '['):
+        # Rare for the fields hooks need; decode with the stdlib parser
+        parts = []
+        depth = 0
+        while True:
+            char = scanner.search(_STRUCTURE, parts.append)
+            if char == '':
+                raise ContextParseError("unexpected end of input")
+            scanner.pos += 1
+            parts.append(char)
+            if char == '"':
+                pieces = []
+                _read_string(scanner, pieces.append)
+                parts[-1] = json.dumps("".join(pieces))
+            elif char in ('{', '['):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return json.loads("".join(parts))
+    return _read_scalar(scanner)
+
+
+def read_context(stream, fields, max_chars=None):
+    """
+    Extract top-level `fields` from a JSON object on `stream` (binary or text).
+    String values longer than 2 * max_chars keep their first and last
+    max_chars characters (None = no cap).
+    Returns a dict with the fields that were present, or None if the input is
+    empty or not a JSON object. The stream is always read to the end.
+    """
+    scanner = _Scanner(stream)
+    wanted = set(fields)
+    context = {}
+    try:
+        if scanner.peek() == '':
+            return None
+        scanner.expect('{')
+        if scanner.peek() == '}':
+            scanner.pos += 1
+        else:
+            while True:
+                scanner.expect('"')
+                pieces = []
+                _read_string(scanner, pieces.append)
+                key = "".join(pieces)
+                scanner.expect(':')
+
+                if key in wanted:
+                    context[key] = _read_value(scanner, max_chars)
+                    wanted.discard(key)
+                    if not wanted:
+                        break
+                else:
+                    _skip_value(scanner)
+
+                char = scanner.peek()
+                scanner.pos += 1
+                if char == '}':
+                    break
+                if char != ',':
+                    raise ContextParseError("expected ',' or '}'")
+    except (ContextParseError, ValueError):
+        context = None
+    finally:
+        scanner.drain()
+    return context
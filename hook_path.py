@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+Import path of the hook scripts.
+
+The hooks run from ~/.gemini/hooks, while the shared modules they import are
+installed one level up, next to gemini_cli_auth_manager.py. Those modules are
+imported by every hook run, so they stick to the standard library and defer
+anything heavy to the functions that need it.
+
+add_shared_modules() appends ~/.gemini to sys.path. In the source tree the
+modules sit next to the hooks, in the script's own directory that Python
+searches first, so the appended entry is never used there.
+"""
+import os
+import sys
+
+GEMINI_DIR = os.path.expanduser("~/.gemini")
+
+
+def add_shared_modules():
+    """Make the shared modules importable (idempotent)."""
+    if GEMINI_DIR not in sys.path:
+        sys.path.append(GEMINI_DIR)
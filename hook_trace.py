@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Opt-in latency tracing for the hooks and the switch commands.
+
+When enabled (auto_switch.trace in auth_config.json, or GCHANGE_TRACE=1 in
+the environment), every hook run appends one JSON line to
+~/.gemini/hook_trace.jsonl:
+
+    {"ts": 1760000000.0, "hook": "pre_check", "pid": 123, "daemon": false,
+     "total_ms": 41.2, "phases": {"import": 18.0, "config": 0.3, ...},
+     "cache": "hit", "switched": false}
+
+Phases are timed with span() around the interesting steps (config load,
+cache read, loadCodeAssist, retrieveUserQuota, switch, ...); a phase entered
+several times accumulates. Fields set with annotate() (cache result, switch
+outcome) are stored next to the phases. The file is rotated to
+hook_trace.jsonl.1 once it exceeds MAX_TRACE_BYTES.
+
+The trace of the current run is kept per thread, so the hooks only mark
+spans and never pass a trace object around. When tracing is disabled, span()
+returns a shared no-op context manager.
+
+`gchange stats` reads both files back through load_records() and
+summarize(): p50/p95/p99 per hook and phase, cache hit ratio, switch counts.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import config_snapshot
+
+# --- Configuration Paths ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+TRACE_FILE = GEMINI_DIR / "hook_trace.jsonl"
+ROTATED_TRACE_FILE = GEMINI_DIR / "hook_trace.jsonl.1"
+
+ENV_VAR = "GCHANGE_TRACE"
+MAX_TRACE_BYTES = 1024 * 1024  # Rotate after ~1 MiB (a few thousand records)
+PERCENTILES = (50, 95, 99)
+
+_local = threading.local()
+
+
+class _NullSpan:
+    """Context manager used when no trace is active."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Adds the time spent inside the block to one phase of a trace."""
+
+    def __init__(self, trace, phase):
+        self.trace = trace
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        phases = self.trace["phases"]
+        phases[self.phase] = phases.get(self.phase, 0.0) + elapsed
+        return False
+
+
+def enabled():
+    """Return True if tracing is switched on (environment or auto_switch.trace)."""
+    env = os.environ.get(ENV_VAR)
+    if env is not None:
+        return env.strip().lower() in ("1", "true", "yes", "on")
+    return config_snapshot.load()["auto_switch"]["trace"]
+
+
+def begin(hook, started=None, daemon=False, phases=None):
+    """
+    Start tracing one run of `hook` on this thread (no-op when tracing is off).
+    `started` is a time.perf_counter() value taken when the script started;
+    the time until now is recorded as the "import" phase. `phases` are
+    {phase: ms} the caller timed before tracing could start; they are
+    recorded as such and not counted as import time.
+    """
+    if not enabled():
+        _local.trace = None
+        return
+    now = time.perf_counter()
+    trace = {
+        "hook": hook,
+        "daemon": daemon,
+        "start": started if started is not None else now,
+        "phases": dict(phases or {}),
+        "fields": {},
+    }
+    if started is not None:
+        trace["phases"]["import"] = (now - started) * 1000 - sum(trace["phases"].values())
+    _local.trace = trace
+
+
+def span(phase):
+    """Context manager timing a phase of the current trace."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, phase)
+
+
+def annotate(**fields):
+    """Attach fields (cache result, switch outcome, ...) to the current trace."""
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace["fields"].update(fields)
+
+
+def finish(**fields):
+    """End the current trace and append it to the trace file (never raises)."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return
+    _local.trace = None
+    trace["fields"].update(fields)
+    total_ms = (time.perf_counter() - trace["start"]) * 1000
+    _write(trace["hook"], trace["daemon"], total_ms, trace["phases"], trace["fields"])
+
+
+def record(hook, total_ms, phases, **fields):
+    """
+    Append a record for a run the caller timed itself (e.g. restart_helper,
+    whose phases are spent waiting on other processes). No-op when tracing is off.
+    """
+    if enabled():
+        _write(hook, False, total_ms, phases, fields)
+
+
+def _write(hook, daemon, total_ms, phases, fields):
+    record = {
+        "ts": round(time.time(), 3),
+        "hook": hook,
+        "pid": os.getpid(),
+        "daemon": daemon,
+        "total_ms": round(total_ms, 3),
+        "phases": {name: round(ms, 3) for name, ms in phases.items()},
+    }
+    record.update(fields)
+    _append(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _append(line):
+    """Append one line, rotating the file first if it is too large."""
+    try:
+        try:
+            if TRACE_FILE.stat().st_size > MAX_TRACE_BYTES:
+                os.replace(TRACE_FILE, ROTATED_TRACE_FILE)
+        except OSError:
+            pass
+        # One write() per record: concurrent hooks append whole lines (O_APPEND)
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError:
+        pass
+
+
+# --- Reporting (gchange stats) ---
+def load_records(since=0.0):
+    """Return the trace records newer than a Unix time, oldest first."""
+    records = []
+    for path in (ROTATED_TRACE_FILE, TRACE_FILE):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn line from a crashed writer
+                    if isinstance(record, dict) and record.get("ts", 0) >= since:
+                        records.append(record)
+        except OSError:
+            continue
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list (None if empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-pct * len(sorted_values) // 100))  # ceil(pct/100 * n)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _latency(values):
+    values = sorted(values)
+    summary = {"count": len(values)}
+    for pct in PERCENTILES:
+        summary[f"p{pct}"] = percentile(values, pct)
+    return summary
+
+
+def summarize(records):
+    """
+    Aggregate trace records per hook ("<hook> (daemon)" for runs inside the
+    quota daemon). Returns {hook: {runs, total, phases, cache, switched}}:
+    total and each phase are {count, p50, p95, p99} in milliseconds, cache
+    counts the pre-check cache results, switched counts successful switches.
+    """
+    groups = {}
+    for record in records:
+        name = record.get("hook", "unknown") + (" (daemon)" if record.get("daemon") else "")
+        group = groups.setdefault(name, {"totals": [], "phases": {}, "cache": {}, "switched": 0})
+        group["totals"].append(record.get("total_ms", 0.0))
+        for phase, ms in record.get("phases", {}).items():
+            group["phases"].setdefault(phase, []).append(ms)
+        if record.get("cache"):
+            group["cache"][record["cache"]] = group["cache"].get(record["cache"], 0) + 1
+        if record.get("switched"):
+            group["switched"] += 1
+
+    return {
+        name: {
+            "runs": len(group["totals"]),
+            "total": _latency(group["totals"]),
+            "phases": {phase: _latency(values) for phase, values in group["phases"].items()},
+            "cache": group["cache"],
+            "switched": group["switched"],
+        }
+        for name, group in sorted(groups.items())
+    }
@@ -10,6 +10,24 @@ import subprocess
 import sys
 from pathlib import Path
 
+# Shared modules imported by the core script and hooks, installed next to the core script
+# (the hooks find them through hook_path). Every hook run imports them: stdlib only.
+SHARED_MODULES = [
+    "fsutil.py",
+    "config_snapshot.py",
+    "state_store.py",
+    "oauth_refresh.py",
+    "token_scheduler.py",
+    "profile_cache.py",
+    "account_selector.py",
+    "auth_switch.py",
+    "quota_daemon.py",
+    "auth_proxy.py",
+    "hook_input.py",
+    "hook_trace.py",
+    "quota_api_client.py",  # Used by "View Current Quota" in the menu
+]
+
 # --- Configuration Dictionary ---
 CONFIG = {
     'en': {
@@ -189,6 +207,7 @@ def install():
     target_script = gemini_dir / "gemini_cli_auth_manager.py"
     target_hook = hooks_dir / "quota_auto_switch.py"
     target_pre_check = hooks_dir / "quota_pre_check.py"
+    hook_path_script = source_dir / "hook_path.py"  # Puts the shared modules on the hooks' sys.path
     target_config = gemini_dir / "auth_config.json"
     target_bat = gemini_dir / "gchange.bat"
     target_toml = commands_dir / "change.toml"
@@ -207,6 +226,15 @@ def install():
     else:
         print(f"[Error] Source file not found: {core_script}")
         return
+    
+    for module_name in SHARED_MODULES:
+        module_script = source_dir / module_name
+        if module_script.exists():
+            shutil.copy2(module_script, gemini_dir / module_name)
+            print(f"[OK] Shared module installed: {module_name}")
+        else:
+            print(f"[Error] Source file not found: {module_script}")
+            return
 
     # 5. Create Batch Launcher
     bat_content = '@echo off\r\npython "%USERPROFILE%\\.gemini\\gemini_cli_auth_manager.py" %*'
@@ -258,6 +286,11 @@ def install():
         }
     if enable_auto:
         # Copy hook scripts
+        if hook_path_script.exists():
+            shutil.copy2(hook_path_script, hooks_dir / hook_path_script.name)
+        else:
+            print(f"[Warning] Hook helper not found: {hook_path_script}")
+
         if hook_script.exists():
             shutil.copy2(hook_script, target_hook)
             print(f"[OK] AfterAgent hook installed: {target_hook.name}")
@@ -289,7 +322,8 @@ def install():
                 "max_retries": 3,
                 "notify_on_switch": True,
                 "auto_restart": False,
-                "cache_minutes": 3
+                "cache_minutes": 3,
+                "rotation": "quota"
             }
         
         # --- NEW: Add Default OAuth Client Info ---
@@ -341,6 +375,7 @@ def install():
     print("  gchange next         - Switch to next account")
     print("  gchange strategy     - View/change rotation strategy")
     print("  gchange config       - View/change auto-switch config")
+    print("  gchange daemon start - Keep hooks warm in a background daemon")
 
 
 if __name__ == "__main__":
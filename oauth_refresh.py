@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+In-process OAuth token refresh for Gemini CLI Auth Manager.
+
+Access tokens in oauth_creds.json expire after about an hour. Instead of
+running a Gemini CLI prompt and waiting for it to rewrite the file, the
+refresh token is exchanged directly at GOOGLE_TOKEN_URL
+(grant_type=refresh_token) with the OAuth client from auth_config.json:
+
+- get_access_token() refreshes proactively when expiry_date is within
+  REFRESH_SKEW_SECONDS, before any API call is made
+- refresh_credentials(rejected_token=...) is the retry path after a 401
+- the updated credentials are written atomically (temp file + os.replace),
+  keeping every other field of the file
+- one refresh per credentials file at a time across processes (state_store
+  lease); other callers wait for its result instead of refreshing again
+
+urllib is imported only when a refresh actually happens.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+import config_snapshot
+import fsutil
+import state_store
+
+# --- Configuration ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+
+GOOGLE_TOKEN_URL = os.environ.get("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")  # Env override for benchmark.py
+DEFAULT_OAUTH_CLIENT = {
+    "client_id": "681255809395-" + "oo8ft2oprdrnp9e3aqf6av3hmdib135j.apps.googleusercontent.com",
+    "client_secret": "GOCSPX" + "-4uHgMPm-1o7Sk-geV6Cu5clXFsxl",
+}
+
+REFRESH_SKEW_SECONDS = 300   # Refresh when the token expires within 5 minutes
+REFRESH_TIMEOUT = 10         # Seconds for the token endpoint
+REFRESH_LEASE_SECONDS = 20   # Upper bound of one refresh
+REFRESH_WAIT_SECONDS = 5     # How long other callers wait for a refresh in progress
+REFRESH_POLL_SECONDS = 0.1
+
+
+class TokenRefreshError(Exception):
+    """Raised when the credentials cannot be refreshed."""
+
+
+def load_oauth_client():
+    """Return (client_id, client_secret) from auth_config.json, or the defaults."""
+    oauth = config_snapshot.load()["oauth_client"]
+    if oauth:
+        return oauth["client_id"], oauth["client_secret"]
+    return DEFAULT_OAUTH_CLIENT["client_id"], DEFAULT_OAUTH_CLIENT["client_secret"]
+
+
+def load_credentials(creds_file):
+    """Read an oauth_creds.json; returns a dict or None if missing/invalid."""
+    try:
+        with open(creds_file, 'r', encoding='utf-8') as f:
+            creds = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return creds if isinstance(creds, dict) else None
+
+
+def expires_in(creds, now=None):
+    """Seconds until the access token expires (None if expiry_date is unknown)."""
+    expiry_date = creds.get("expiry_date")
+    if not expiry_date:
+        return None
+    return expiry_date / 1000 - (now if now is not None else time.time())
+
+
+def needs_refresh(creds, skew=REFRESH_SKEW_SECONDS, now=None):
+    """True if the credentials have no access token or it expires within `skew` seconds."""
+    if not creds.get("access_token"):
+        return True
+    remaining = expires_in(creds, now)
+    return remaining is not None and remaining < skew
+
+
+def write_credentials(creds_file, creds):
+    """Write credentials atomically: readers see the old or the new file, never a partial one."""
+    # A symlinked oauth_creds.json (switch_mode "symlink") is updated in the profile it points to
+    fsutil.atomic_write(creds_file, json.dumps(creds, indent=2).encode("utf-8"), follow_symlinks=True)
+
+
+def _request_token(refresh_token, timeout):
+    """POST a refresh_token grant; returns the token endpoint's JSON reply."""
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+
+    client_id, client_secret = load_oauth_client()
+    data = urlencode({
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "refresh_token": refresh_token,
+        "grant_type": "refresh_token",
+    }).encode("ascii")
+    request = Request(GOOGLE_TOKEN_URL, data=data, headers={
+        "Content-Type": "application/x-www-form-urlencoded",
+    })
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except HTTPError as e:
+        try:
+            reason = json.loads(e.read().decode("utf-8")).get("error", "")
+        except (OSError, ValueError, AttributeError):
+            reason = ""
+        raise TokenRefreshError(f"HTTP {e.code}" + (f" ({reason})" if reason else ""))
+    except (URLError, OSError, ValueError) as e:
+        raise TokenRefreshError(str(e) or e.__class__.__name__)
+
+
+def _refreshed(creds, rejected_token, skew):
+    """True if another process already replaced the rejected (or expiring) token."""
+    if rejected_token is not None:
+        return bool(creds.get("access_token")) and creds["access_token"] != rejected_token
+    return not needs_refresh(creds, skew)
+
+
+def refresh_credentials(creds_file, rejected_token=None, skew=REFRESH_SKEW_SECONDS, timeout=REFRESH_TIMEOUT):
+    """
+    Exchange the refresh token of `creds_file` for a new access token and
+    write it back, unless the token does not expire within `skew` seconds.
+    After a 401, pass the rejected token as `rejected_token` instead: the
+    exchange then happens unless the file already holds a different token.
+    Returns the updated credentials dict; raises TokenRefreshError.
+    """
+    creds = load_credentials(creds_file)
+    if creds is None:
+        raise TokenRefreshError(f"cannot read {creds_file}")
+    if _refreshed(creds, rejected_token, skew):
+        return creds
+
+    lease = f"token_refresh:{creds_file}"
+    leased = state_store.acquire_lease(lease, REFRESH_LEASE_SECONDS)
+    if leased is False:
+        # Another session is refreshing this file: wait for its result
+        # (None means the state store is unavailable: refresh without the lease).
+        # Any new token counts, even under a skew it cannot satisfy (forced refresh).
+        started = rejected_token if rejected_token is not None else creds.get("access_token")
+        deadline = time.monotonic() + REFRESH_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(REFRESH_POLL_SECONDS)
+            creds = load_credentials(creds_file)
+            if creds and (_refreshed(creds, rejected_token, skew) or _refreshed(creds, started, skew)):
+                return creds
+        raise TokenRefreshError("timed out waiting for a refresh in progress")
+
+    try:
+        # Re-read under the lease: the previous holder may have just finished
+        creds = load_credentials(creds_file)
+        if creds is None:
+            raise TokenRefreshError(f"cannot read {creds_file}")
+        if _refreshed(creds, rejected_token, skew):
+            return creds
+        if not creds.get("refresh_token"):
+            raise TokenRefreshError("no refresh_token in credentials")
+
+        tokens = _request_token(creds["refresh_token"], timeout)
+        if not tokens.get("access_token"):
+            raise TokenRefreshError("no access_token in token response")
+
+        creds["access_token"] = tokens["access_token"]
+        creds["expiry_date"] = int((time.time() + tokens.get("expires_in", 3600)) * 1000)
+        for field in ("refresh_token", "scope", "token_type", "id_token"):
+            if tokens.get(field):
+                creds[field] = tokens[field]
+        try:
+            write_credentials(creds_file, creds)
+        except OSError as e:
+            raise TokenRefreshError(f"cannot write {creds_file}: {e}")
+        return creds
+    finally:
+        if leased:
+            state_store.release_lease(lease)
+
+
+def get_access_token(creds_file, skew=REFRESH_SKEW_SECONDS, timeout=REFRESH_TIMEOUT):
+    """
+    Return a usable access token from `creds_file`, refreshing it first when
+    it expires within `skew` seconds. If the refresh fails, the current token
+    is returned (the API's 401 then takes the retry path). None if the file
+    has no token at all.
+    """
+    creds = load_credentials(creds_file)
+    if creds is None:
+        return None
+    if needs_refresh(creds, skew):
+        try:
+            creds = refresh_credentials(creds_file, skew=skew, timeout=timeout)
+        except TokenRefreshError:
+            pass
+    return creds.get("access_token")
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Per-account quota cache for Gemini CLI Auth Manager.
+
+Quota snapshots and the Code Assist project of each account are kept per
+account in the state store (see state_store), so they survive account
+switches and new CLI sessions:
+
+    quota_snapshots  # retrieveUserQuota buckets
+    project_info     # loadCodeAssist project + tier
+
+When the active account is unknown (no google_accounts.json yet), a single
+shared snapshot is used and the project is not cached.
+
+The pool itself (the directories in auth_profiles/) is mirrored into a sorted
+index in the state store, rebuilt only when the directory's mtime changes
+(adding, removing or renaming a profile). Lookups by email, by position and
+of the next neighbour then cost one stat plus an indexed query instead of a
+listing of the whole directory, and find_profiles() resolves partial emails.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import fsutil
+import state_store
+
+# --- Configuration Paths ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+PROFILES_DIR = GEMINI_DIR / "auth_profiles"
+ACCOUNTS_JSON = GEMINI_DIR / "google_accounts.json"
+CREDS_FILE = GEMINI_DIR / "oauth_creds.json"
+
+DEFAULT_CACHE_MINUTES = 3
+FUZZY_CUTOFF = 0.8  # difflib similarity for typo matches in find_profiles()
+
+# Parsed files, reused while unchanged on disk: {path: (stamp, data)}
+_memo = {}
+
+
+def _read_json(path):
+    """Read a JSON file through the memo; returns None if missing or invalid."""
+    stamp = fsutil.file_stamp(path)
+    if stamp is None:
+        _memo.pop(path, None)
+        return None
+
+    cached = _memo.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    _memo[path] = (stamp, data)
+    return data
+
+
+def get_active_account():
+    """Get currently active account email from google_accounts.json."""
+    data = _read_json(ACCOUNTS_JSON)
+    if isinstance(data, dict):
+        return data.get("active")
+    return None
+
+
+def _profiles_stamp():
+    """Return the mtime of auth_profiles/ (changes when an entry is added, removed or renamed)."""
+    try:
+        return PROFILES_DIR.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _scan_profiles():
+    """List the profile directories (sorted); scandir avoids a stat per entry on most platforms."""
+    try:
+        with os.scandir(PROFILES_DIR) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+    except OSError:
+        return []
+
+
+def refresh_profile_index(force=False):
+    """
+    Rebuild the profile index if auth_profiles/ changed since it was built.
+    Returns None when the index is current, or the scanned list if the state
+    store could not be updated (callers then work on that list).
+    """
+    stamp = _profiles_stamp()
+    if not force and stamp == state_store.get_profile_index_stamp():
+        return None
+    # The stamp is taken before scanning: a change during the scan triggers another rebuild
+    names = _scan_profiles()
+    return None if state_store.replace_profiles(names, stamp) else names
+
+
+def list_profiles():
+    """Get sorted list of profile names (account emails)."""
+    scanned = refresh_profile_index()
+    return scanned if scanned is not None else state_store.get_profiles()
+
+
+def profile_count():
+    """Return the number of profiles in the pool."""
+    scanned = refresh_profile_index()
+    return len(scanned) if scanned is not None else state_store.get_profile_count()
+
+
+def profile_at(index):
+    """Return the profile at a 0-based position in sorted order, or None."""
+    scanned = refresh_profile_index()
+    if scanned is not None:
+        return scanned[index] if 0 <= index < len(scanned) else None
+    return state_store.get_profile_at(index) if index >= 0 else None
+
+
+def profile_position(email):
+    """Return the 0-based position of a profile, or None if it is not in the pool."""
+    scanned = refresh_profile_index()
+    if scanned is not None:
+        return scanned.index(email) if email in scanned else None
+    return state_store.get_profile_position(email)
+
+
+def next_profile(current):
+    """Return the sorted-order neighbour of `current` (None if it is the only profile)."""
+    scanned = refresh_profile_index()
+    if scanned is not None:
+        if not scanned:
+            return None
+        candidate = scanned[(scanned.index(current) + 1) % len(scanned)] if current in scanned else scanned[0]
+    else:
+        count = state_store.get_profile_count()
+        if not count:
+            return None
+        position = state_store.get_profile_position(current) if current else None
+        candidate = state_store.get_profile_at((position + 1) % count if position is not None else 0)
+    return None if candidate == current else candidate
+
+
+def find_profiles(query, limit=10):
+    """
+    Resolve a partial email: the exact profile if it exists, else profiles
+    starting with `query`, else profiles containing it, else close matches
+    (difflib). Returns up to `limit` names.
+    """
+    if not query:
+        return []
+    scanned = refresh_profile_index()
+    if scanned is not None:
+        if query in scanned:
+            return [query]
+        matches = [p for p in scanned if p.startswith(query)] or [p for p in scanned if query in p]
+        profiles = scanned
+    else:
+        if state_store.get_profile_position(query) is not None:
+            return [query]
+        matches = state_store.find_profiles(prefix=query, limit=limit) or \
+            state_store.find_profiles(contains=query, limit=limit)
+        profiles = None
+    if matches:
+        return matches[:limit]
+
+    import difflib  # Only for typos, after the indexed lookups found nothing
+    return difflib.get_close_matches(query, profiles or state_store.get_profiles(), n=limit, cutoff=FUZZY_CUTOFF)
+
+
+def credentials_file(email):
+    """
+    Return the oauth_creds.json holding the freshest credentials of an account:
+    the live file for the active account, the profile copy otherwise.
+    """
+    if email and email == get_active_account() and CREDS_FILE.exists():
+        return CREDS_FILE
+    return PROFILES_DIR / email / "oauth_creds.json"
+
+
+def load_quota_snapshot(email, max_age_minutes=None):
+    """
+    Load the cached quota snapshot for an account.
+    Returns dict {timestamp, account, buckets, cache_minutes}, or None if missing
+    or older than max_age_minutes (None accepts any age).
+    """
+    cache = state_store.get_quota_snapshot(email)
+    if not cache:
+        return None
+
+    if max_age_minutes is not None and snapshot_age(cache) > timedelta(minutes=max_age_minutes):
+        return None
+    return cache
+
+
+def save_quota_snapshot(email, buckets, cache_minutes=DEFAULT_CACHE_MINUTES):
+    """Store a quota snapshot for an account."""
+    cache = {
+        "timestamp": datetime.now().isoformat(),
+        "account": email,
+        "buckets": buckets,
+        "cache_minutes": cache_minutes,
+    }
+    state_store.put_quota_snapshot(email, cache["timestamp"], buckets, cache_minutes)
+    return cache
+
+
+def snapshot_age(cache):
+    """Return the age of a snapshot as a timedelta (very large if unparseable)."""
+    try:
+        cache_time = datetime.fromisoformat(cache.get("timestamp", ""))
+    except (TypeError, ValueError):
+        return timedelta.max
+    return datetime.now() - cache_time
+
+
+def load_project_info(email):
+    """
+    Load the cached loadCodeAssist result for an account.
+    Returns dict {project, tier, timestamp} or None.
+    """
+    if not email:
+        return None
+    return state_store.get_project_info(email)
+
+
+def save_project_info(email, project, tier=None):
+    """Store the cloudaicompanionProject (and tier) of an account."""
+    if not email or not project:
+        return None
+    info = {
+        "timestamp": datetime.now().isoformat(),
+        "project": project,
+        "tier": {
+            "id": (tier or {}).get("id", "unknown"),
+            "name": (tier or {}).get("name", "unknown"),
+        },
+    }
+    state_store.put_project_info(email, project, info["tier"]["id"], info["tier"]["name"], info["timestamp"])
+    return info
+
+
+def invalidate_project_info(email):
+    """Drop the cached project of an account (e.g. after a 403/404 from the API)."""
+    if email:
+        state_store.delete_project_info(email)
+
+
+def forget_account(email):
+    """Drop all cached data of an account that was removed from the pool."""
+    if email:
+        state_store.forget_account(email)
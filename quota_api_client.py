@@ -2,42 +2,92 @@
 """
 Gemini CLI 配额查询 API 客户端
 直接调用 Google Code Assist API 获取配额信息
+
+用法:
+    python quota_api_client.py                 # 查询当前账号
+    python quota_api_client.py --all           # 并发查询号池中所有账号
+    python quota_api_client.py --all --workers 8 --timeout 15
 """
 import json
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 import requests
 
-# Fix Windows console encoding
-if sys.platform == 'win32':
-    sys.stdout.reconfigure(encoding='utf-8', errors='replace')
-
-# API Endpoints (from Gemini CLI source code)
-CODE_ASSIST_ENDPOINT = "https://cloudcode-pa.googleapis.com"
+# API Endpoints (from Gemini CLI source code; CODE_ASSIST_ENDPOINT env redirects, e.g. to benchmark.py's mock)
+CODE_ASSIST_ENDPOINT = os.environ.get("CODE_ASSIST_ENDPOINT", "https://cloudcode-pa.googleapis.com")
 CODE_ASSIST_API_VERSION = "v1internal"
 
 GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
 OAUTH_CREDS_FILE = GEMINI_DIR / "oauth_creds.json"
 
+# Pool sweep defaults
+DEFAULT_SWEEP_WORKERS = 8      # Concurrent accounts
+DEFAULT_SWEEP_TIMEOUT = 15     # Seconds per account (all API calls included)
+
+LOAD_CODE_ASSIST_PAYLOAD = {
+    "metadata": {
+        "ideType": "GEMINI_CLI",
+        "platform": "WINDOWS_AMD64",
+        "pluginType": "GEMINI",
+    }
+}
+
+import auth_proxy
+import oauth_refresh
+import profile_cache
+
+# The CLI may be pointed at the auth proxy; our per-account calls go straight upstream
+CODE_ASSIST_ENDPOINT = auth_proxy.direct_endpoint(CODE_ASSIST_ENDPOINT)
+
 
 def load_oauth_token():
-    """Load OAuth access token from credentials file."""
+    """Load OAuth access token from credentials file, refreshing it first if it is about to expire."""
     if not OAUTH_CREDS_FILE.exists():
         raise FileNotFoundError(f"OAuth credentials not found: {OAUTH_CREDS_FILE}")
     
-    with open(OAUTH_CREDS_FILE, 'r', encoding='utf-8') as f:
-        creds = json.load(f)
-    
-    access_token = creds.get("access_token")
-    expiry_date = creds.get("expiry_date", 0)
+    creds = oauth_refresh.load_credentials(OAUTH_CREDS_FILE) or {}
+    if oauth_refresh.needs_refresh(creds):
+        try:
+            creds = oauth_refresh.refresh_credentials(OAUTH_CREDS_FILE)
+            print("   🔄 OAuth token 即将过期，已自动刷新")
+        except oauth_refresh.TokenRefreshError as e:
+            print(f"⚠️  Warning: OAuth token may be expired (refresh failed: {e})")
     
-    # Check if token is expired
-    if expiry_date and datetime.now().timestamp() * 1000 > expiry_date:
-        print("⚠️  Warning: OAuth token may be expired")
+    return creds.get("access_token")
+
+
+def refresh_oauth_token(rejected_token):
+    """Refresh the live token after a 401; returns the new access token or None."""
+    print("⚠️  Token expired (401). Refreshing...")
+    try:
+        creds = oauth_refresh.refresh_credentials(OAUTH_CREDS_FILE, rejected_token=rejected_token)
+    except oauth_refresh.TokenRefreshError as e:
+        print(f"❌ Failed to auto-refresh token: {e}")
+        return None
+    print("✅ Token refreshed. Retrying...")
+    return creds.get("access_token")
+
+
+def _post_with_refresh(endpoint, access_token, payload):
+    """POST to a Code Assist endpoint; on a 401 the token is refreshed and the call retried once."""
+    url = f"{CODE_ASSIST_ENDPOINT}/{CODE_ASSIST_API_VERSION}:{endpoint}"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
     
-    return access_token
+    response = requests.post(url, headers=headers, json=payload, timeout=30)
+    if response.status_code == 401:
+        new_token = refresh_oauth_token(access_token)
+        if new_token:
+            headers["Authorization"] = f"Bearer {new_token}"
+            response = requests.post(url, headers=headers, json=payload, timeout=30)
+    response.raise_for_status()
+    return response.json()
 
 
 def call_load_code_assist(access_token):
@@ -45,91 +95,63 @@ def call_load_code_assist(access_token):
     Call loadCodeAssist API to get cloudaicompanionProject.
     This is how Gemini CLI gets the project ID on auth.
     """
-    url = f"{CODE_ASSIST_ENDPOINT}/{CODE_ASSIST_API_VERSION}:loadCodeAssist"
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    
-    payload = {
-        "metadata": {
-            "ideType": "GEMINI_CLI",
-            "platform": "WINDOWS_AMD64",
-            "pluginType": "GEMINI",
-        }
-    }
-    
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as e:
-        # Debugging: Print status code
-        # print(f"DEBUG: HTTPError caught, status: {e.response.status_code}", file=sys.stderr)
-        
-        if e.response.status_code == 401:
-            print(f"⚠️  Token expired (401). Attempting to refresh via Gemini CLI...")
-            try:
-                # Run a cheap command to force CLI to refresh token
-                # On Windows, shell=True is needed to resolve npm scripts (.cmd)
-                import subprocess
-                is_windows = sys.platform == 'win32'
-                
-                subprocess.run(
-                    ["gemini", "-p", "/model list"], 
-                    check=True, 
-                    stdout=subprocess.DEVNULL, 
-                    stderr=subprocess.DEVNULL,
-                    shell=is_windows
-                )
-                
-                # Reload token
-                new_token = load_oauth_token()
-                if new_token != access_token:
-                    print("✅ Token refreshed. Retrying...")
-                    headers["Authorization"] = f"Bearer {new_token}"
-                    response = requests.post(url, headers=headers, json=payload, timeout=30)
-                    response.raise_for_status()
-                    return response.json()
-                else:
-                    print("❌ Token refresh failed (file not updated).")
-            except Exception as refresh_err:
-                print(f"❌ Failed to auto-refresh token: {refresh_err}")
-
+        return _post_with_refresh("loadCodeAssist", access_token, LOAD_CODE_ASSIST_PAYLOAD)
+    except requests.exceptions.RequestException as e:
         print(f"❌ Error calling loadCodeAssist: {e}")
         if hasattr(e, 'response') and e.response is not None:
             print(f"   Response: {e.response.text}")
         return None
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Error calling loadCodeAssist: {e}")
-        return None
 
 
-def call_retrieve_user_quota(access_token, project_id):
+def resolve_project(access_token, account):
     """
-    Call retrieveUserQuota API to get quota information.
-    This is the API that powers /stats.
+    Get the cloudaicompanionProject of an account, from the profile cache or
+    via loadCodeAssist (result is cached for next time).
+    Returns (project_id, tier, from_cache); project_id is None on failure.
     """
-    url = f"{CODE_ASSIST_ENDPOINT}/{CODE_ASSIST_API_VERSION}:retrieveUserQuota"
+    info = profile_cache.load_project_info(account)
+    if info:
+        return info["project"], info.get("tier", {}), True
     
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
+    load_result = call_load_code_assist(access_token)
+    if not load_result:
+        return None, {}, False
+    
+    project_id = load_result.get("cloudaicompanionProject")
+    current_tier = load_result.get("currentTier", {})
+    
+    if not project_id:
+        print("   ❌ 未找到 cloudaicompanionProject")
+        print(f"   可能原因: 账户未正确 onboard 或使用的是 API Key 认证")
+        print(f"   Load result: {json.dumps(load_result, indent=2)}")
+        return None, current_tier, False
     
+    try:
+        profile_cache.save_project_info(account, project_id, current_tier)
+    except OSError:
+        pass
+    return project_id, current_tier, False
+
+
+def call_retrieve_user_quota(access_token, project_id, account=None):
+    """
+    Call retrieveUserQuota API to get quota information.
+    This is the API that powers /stats.
+    A 403/404 invalidates the account's cached project ID.
+    """
     payload = {
         "project": project_id
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        return _post_with_refresh("retrieveUserQuota", access_token, payload)
     except requests.exceptions.RequestException as e:
         print(f"❌ Error calling retrieveUserQuota: {e}")
         if hasattr(e, 'response') and e.response is not None:
             print(f"   Response: {e.response.text}")
+            if e.response.status_code in (403, 404):
+                profile_cache.invalidate_project_info(account)
         return None
 
 
@@ -209,7 +231,197 @@ def display_quota_info(quota_response):
     return buckets
 
 
+def make_pooled_session(workers):
+    """Create a requests.Session whose keep-alive pool fits `workers` concurrent requests."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _post_quiet(session, endpoint, access_token, payload, deadline):
+    """POST to a Code Assist endpoint without printing; raises on HTTP errors or timeout."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise requests.exceptions.Timeout("per-account timeout exceeded")
+    
+    url = f"{CODE_ASSIST_ENDPOINT}/{CODE_ASSIST_API_VERSION}:{endpoint}"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+    response = session.post(url, headers=headers, json=payload, timeout=remaining)
+    response.raise_for_status()
+    return response.json()
+
+
+def _query_account_quota(session, account, access_token, result, deadline):
+    """Resolve the project of an account (cached if possible) and query its quota."""
+    quota_result = None
+    info = profile_cache.load_project_info(account)
+    if info:
+        result["tier"] = info.get("tier", {})
+        try:
+            quota_result = _post_quiet(session, "retrieveUserQuota", access_token,
+                                       {"project": info["project"]}, deadline)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code not in (403, 404):
+                raise
+            # Cached project rejected: resolve again below
+            profile_cache.invalidate_project_info(account)
+    
+    if quota_result is None:
+        load_result = _post_quiet(session, "loadCodeAssist", access_token,
+                                  LOAD_CODE_ASSIST_PAYLOAD, deadline)
+        project_id = load_result.get("cloudaicompanionProject")
+        if not project_id:
+            raise ValueError("no cloudaicompanionProject")
+        result["tier"] = load_result.get("currentTier", {})
+        profile_cache.save_project_info(account, project_id, result["tier"])
+        quota_result = _post_quiet(session, "retrieveUserQuota", access_token,
+                                   {"project": project_id}, deadline)
+    return quota_result
+
+
+def fetch_account_quota(session, account, timeout=DEFAULT_SWEEP_TIMEOUT,
+                        cache_minutes=profile_cache.DEFAULT_CACHE_MINUTES):
+    """
+    Query the quota of one pooled account from its own credentials file,
+    without switching to it (the token is refreshed in-process when it is about
+    to expire or rejected). Updates the account's project and quota caches
+    (the snapshot stays fresh for cache_minutes).
+    Returns dict {account, ok, buckets, tier, error, elapsed}.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    result = {"account": account, "ok": False, "buckets": [], "tier": {}, "error": None, "elapsed": 0.0}
+    
+    try:
+        creds_file = profile_cache.credentials_file(account)
+        if not creds_file.exists():
+            raise FileNotFoundError(creds_file)
+        access_token = oauth_refresh.get_access_token(creds_file, timeout=min(oauth_refresh.REFRESH_TIMEOUT, timeout))
+        if not access_token:
+            raise ValueError("no access_token in credentials")
+        
+        try:
+            quota_result = _query_account_quota(session, account, access_token, result, deadline)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+            # Token rejected: refresh it in-process and retry once
+            try:
+                creds = oauth_refresh.refresh_credentials(creds_file, rejected_token=access_token)
+            except oauth_refresh.TokenRefreshError:
+                raise e
+            quota_result = _query_account_quota(session, account, creds["access_token"], result, deadline)
+        
+        result["buckets"] = quota_result.get("buckets", [])
+        result["ok"] = True
+        profile_cache.save_quota_snapshot(account, result["buckets"], cache_minutes)
+    except requests.exceptions.HTTPError as e:
+        status = e.response.status_code if e.response is not None else "?"
+        result["error"] = "token expired (401)" if status == 401 else f"HTTP {status}"
+    except requests.exceptions.Timeout:
+        result["error"] = "timeout"
+    except FileNotFoundError:
+        result["error"] = "missing oauth_creds.json"
+    except (OSError, ValueError, requests.exceptions.RequestException) as e:
+        result["error"] = str(e) or e.__class__.__name__
+    
+    result["elapsed"] = time.monotonic() - started
+    return result
+
+
+def sweep_pool(accounts=None, workers=DEFAULT_SWEEP_WORKERS, timeout=DEFAULT_SWEEP_TIMEOUT,
+               cache_minutes=profile_cache.DEFAULT_CACHE_MINUTES):
+    """
+    Query every pooled account concurrently with a bounded thread pool sharing
+    one keep-alive session. Returns results in pool order.
+    """
+    if accounts is None:
+        accounts = profile_cache.list_profiles()
+    if not accounts:
+        return []
+    
+    workers = max(1, min(workers, len(accounts)))
+    session = make_pooled_session(workers)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(fetch_account_quota, session, account, timeout, cache_minutes)
+                       for account in accounts]
+            for future in as_completed(futures):
+                r = future.result()
+                results[r["account"]] = r
+    finally:
+        session.close()
+    
+    return [results[account] for account in accounts]
+
+
+def _short_model(model_id):
+    """Shorten a model ID for table columns."""
+    return model_id[len("gemini-"):] if model_id.startswith("gemini-") else model_id
+
+
+def display_pool_quota(results, elapsed=None):
+    """Display a combined quota table for the whole pool."""
+    if not results:
+        print("❌ 号池中没有账号")
+        return
+    
+    active = profile_cache.get_active_account()
+    models = sorted({
+        b["modelId"] for r in results for b in r["buckets"]
+        if b.get("modelId") and b.get("remainingFraction") is not None
+    })
+    account_width = max(len("账号"), max(len(r["account"]) for r in results)) + 2
+    col_width = max([12] + [len(_short_model(m)) + 2 for m in models])
+    width = account_width + 2 + col_width * len(models) + 12
+    
+    print("\n" + "=" * width)
+    print("📊 号池配额状态")
+    print("=" * width)
+    # CJK header occupies two columns per character
+    print(f"  {'账号':<{account_width - 2}}" + "".join(f"{_short_model(m):<{col_width}}" for m in models) + "耗时")
+    print("-" * width)
+    
+    for r in results:
+        marker = "*" if r["account"] == active else " "
+        row = f"{marker} {r['account']:<{account_width}}"
+        if r["ok"]:
+            fractions = {b.get("modelId"): b.get("remainingFraction") for b in r["buckets"]}
+            for m in models:
+                fraction = fractions.get(m)
+                if fraction is None:
+                    row += f"{'N/A':<{col_width}}"
+                    continue
+                status = "🔴" if fraction < 0.1 else "🟡" if fraction < 0.3 else "🟢"
+                # Emoji occupies two columns
+                row += f"{status}{fraction * 100:>5.1f}%".ljust(col_width - 1)
+        else:
+            error_width = max(col_width * len(models), 24) - 3
+            row += f"❌ {r['error'][:error_width - 1]}".ljust(error_width) + "  "
+        print(f"{row}{r['elapsed']:.1f}s")
+    
+    print("=" * width)
+    ok_count = sum(1 for r in results if r["ok"])
+    summary = f"✅ {ok_count}/{len(results)} 个账号查询成功，配额缓存已更新"
+    if elapsed is not None:
+        summary += f"（总耗时 {elapsed:.1f}s）"
+    print(summary)
+
+
+def _fix_console_encoding():
+    """Windows consoles default to a legacy code page that cannot print the emoji below."""
+    if sys.platform == 'win32':
+        sys.stdout.reconfigure(encoding='utf-8', errors='replace')
+
+
 def main():
+    _fix_console_encoding()
     print("🔍 Gemini CLI 配额查询工具\n")
     
     # Step 1: Load OAuth token
@@ -221,31 +433,33 @@ def main():
         print(f"   ❌ 失败: {e}")
         return None
     
-    # Step 2: Get project ID via loadCodeAssist
+    account = profile_cache.get_active_account()
+    
+    # Step 2: Get project ID (profile cache, or loadCodeAssist)
     print("\n2. 获取 cloudaicompanionProject ID...")
-    load_result = call_load_code_assist(access_token)
+    project_id, current_tier, from_cache = resolve_project(access_token, account)
     
-    if not load_result:
+    if not project_id:
         print("   ❌ 无法获取项目信息")
         return None
     
-    project_id = load_result.get("cloudaicompanionProject")
-    current_tier = load_result.get("currentTier", {})
     tier_name = current_tier.get("name", "unknown")
     tier_id = current_tier.get("id", "unknown")
     
-    if not project_id:
-        print("   ❌ 未找到 cloudaicompanionProject")
-        print(f"   可能原因: 账户未正确 onboard 或使用的是 API Key 认证")
-        print(f"   Load result: {json.dumps(load_result, indent=2)}")
-        return None
-    
-    print(f"   ✅ Project ID: {project_id}")
+    print(f"   ✅ Project ID: {project_id}{' (缓存)' if from_cache else ''}")
     print(f"   ✅ Tier: {tier_name} ({tier_id})")
     
     # Step 3: Get quota information
     print("\n3. 查询配额状态...")
-    quota_result = call_retrieve_user_quota(access_token, project_id)
+    access_token = load_oauth_token()  # May have been refreshed in step 2
+    quota_result = call_retrieve_user_quota(access_token, project_id, account)
+    
+    if not quota_result and from_cache and not profile_cache.load_project_info(account):
+        # Cached project was rejected and invalidated: resolve again and retry once
+        print("   ⚠️  缓存的 Project ID 已失效，重新获取...")
+        project_id, current_tier, _ = resolve_project(access_token, account)
+        if project_id:
+            quota_result = call_retrieve_user_quota(access_token, project_id, account)
     
     if not quota_result:
         print("   ❌ 无法获取配额信息")
@@ -257,7 +471,36 @@ def main():
     return buckets
 
 
+def main_all(args):
+    """Query the whole account pool: quota_api_client.py --all [--workers N] [--timeout S]"""
+    import config_snapshot
+
+    _fix_console_encoding()
+    workers = DEFAULT_SWEEP_WORKERS
+    timeout = DEFAULT_SWEEP_TIMEOUT
+    try:
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+        if "--timeout" in args:
+            timeout = float(args[args.index("--timeout") + 1])
+    except (IndexError, ValueError):
+        print("❌ 用法: quota_api_client.py --all [--workers N] [--timeout 秒]")
+        return None
+    
+    accounts = profile_cache.list_profiles()
+    print(f"🔍 并发查询 {len(accounts)} 个账号 (并发数 {min(workers, len(accounts) or 1)}, 单账号超时 {timeout:g}s)...")
+    started = time.monotonic()
+    results = sweep_pool(accounts, workers=workers, timeout=timeout,
+                         cache_minutes=config_snapshot.load()["auto_switch"]["cache_minutes"])
+    display_pool_quota(results, time.monotonic() - started)
+    return results
+
+
 if __name__ == "__main__":
+    if "--all" in sys.argv[1:]:
+        main_all(sys.argv[1:])
+        sys.exit(0)
+    
     result = main()
     
     if result:
@@ -2,30 +2,41 @@
 """
 Gemini CLI Quota Auto-Switch Hook
 AfterAgent hook script for automatic account switching when quota is exhausted.
+
+A quota error in the response only triggers a switch if the active account's
+quota confirms it under the configured strategy (load_model_usage()): a 429
+from a rate-limit blip, or on a model outside the strategy's pattern, leaves
+the account in place instead of costing a switch and a restart.
 """
+import time
+
+_STARTED = time.perf_counter()  # Start of the hook script, for the "import" trace phase
+
 import json
 import os
 import re
-import subprocess
 import sys
+from functools import lru_cache
 from pathlib import Path
 
 # --- Configuration ---
 GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
-CONFIG_FILE = GEMINI_DIR / "auth_config.json"
-RETRY_FILE = GEMINI_DIR / ".auto_switch_retry_count"
-ERROR_STATE_FILE = GEMINI_DIR / ".last_quota_error"  # For BeforeAgent pre-check
-
-DEFAULT_CONFIG = {
-    "auto_switch": {
-        "enabled": True,
-        "strategy": "gemini3-first",
-        "model_pattern": "gemini-3.*",
-        "threshold": 5,
-        "max_retries": 3,
-        "notify_on_switch": True
-    }
-}
+
+import hook_path
+hook_path.add_shared_modules()
+
+
+def _import_in_process():
+    """
+    Import the modules of the in-process path. Deferred so that a turn the
+    quota daemon answers loads none of them (see main()); importing this
+    module from elsewhere (the daemon) loads them right away.
+    """
+    global config_snapshot, hook_trace, state_store
+    import config_snapshot  # Validated auth_config.json (defaults, fractional threshold, matchers)
+    import hook_trace  # Opt-in phase timings (auto_switch.trace)
+    import state_store  # Retry count and last quota error (keys "retry_count", "last_quota_error")
+
 
 # Quota error patterns (case-insensitive matching)
 QUOTA_ERROR_PATTERNS = [
@@ -50,6 +61,15 @@ QUOTA_ERROR_PATTERNS = [
     r"Please verify your account",
 ]
 
+# Only the head and tail of prompt_response are read and scanned: CLI error
+# banners appear there, and long agent responses would otherwise dominate hook
+# time and memory (see hook_input.read_context).
+DEFAULT_ERROR_SCAN_WINDOW = 4096  # Characters at each end; 0 scans everything (auto_switch.error_scan_window)
+
+# After a quota error the active account's quota is re-checked within this many
+# seconds (token refresh and API calls included) before deciding to switch
+QUOTA_REFRESH_TIMEOUT = 3
+
 
 def log(message):
     """Log message to stderr (visible to user but not parsed by CLI)."""
@@ -57,70 +77,65 @@ def log(message):
 
 
 def load_config():
-    """Load configuration from file."""
-    if CONFIG_FILE.exists():
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    return DEFAULT_CONFIG.copy()
+    """Return the config snapshot (config_snapshot.load(); memoized and cached on disk)."""
+    return config_snapshot.load()
 
 
 def get_retry_count():
     """Get current retry count for this session."""
-    if RETRY_FILE.exists():
-        try:
-            with open(RETRY_FILE, 'r') as f:
-                return int(f.read().strip())
-        except:
-            pass
-    return 0
+    try:
+        return int(state_store.get("retry_count", 0))
+    except (TypeError, ValueError):
+        return 0
 
 
 def set_retry_count(count):
     """Set retry count."""
-    try:
-        with open(RETRY_FILE, 'w') as f:
-            f.write(str(count))
-    except:
-        pass
+    state_store.put("retry_count", count)
 
 
 def reset_retry_count():
     """Reset retry count after successful response."""
-    if RETRY_FILE.exists():
-        try:
-            RETRY_FILE.unlink()
-        except:
-            pass
+    state_store.delete("retry_count")
 
 
-def set_error_state(retry_count):
+def set_error_state(retry_count, pattern=None):
     """Set error state for BeforeAgent pre-check (persists even if CLI crashes)."""
-    try:
-        with open(ERROR_STATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump({"quota_error": True, "retry_count": retry_count}, f)
-    except:
-        pass
+    state_store.put("last_quota_error", {"quota_error": True, "retry_count": retry_count, "pattern": pattern})
 
 
 def clear_error_state():
-    """Clear the error state file after successful request."""
-    if ERROR_STATE_FILE.exists():
-        try:
-            ERROR_STATE_FILE.unlink()
-        except:
-            pass
+    """Clear the error state after successful request."""
+    state_store.delete("last_quota_error")
+
 
+@lru_cache(maxsize=1)
+def _quota_error_matcher():
+    """Compile QUOTA_ERROR_PATTERNS once into a single alternation with one named group per pattern."""
+    alternation = "|".join(f"(?P<p{i}>{pattern})" for i, pattern in enumerate(QUOTA_ERROR_PATTERNS))
+    return re.compile(alternation, re.IGNORECASE)
 
-def is_quota_error(response):
+
+def find_quota_error(response, window=DEFAULT_ERROR_SCAN_WINDOW):
+    """
+    Scan the head and tail `window` characters of a response for quota errors.
+    Returns the matching pattern from QUOTA_ERROR_PATTERNS, or None.
+    """
+    if not response:
+        return None
+    if window and len(response) > 2 * window:
+        # Newline keeps ".*" patterns from matching across the gap
+        response = response[:window] + "\n" + response[-window:]
+    
+    match = _quota_error_matcher().search(response)
+    if not match:
+        return None
+    return QUOTA_ERROR_PATTERNS[int(match.lastgroup[1:])]
+
+
+def is_quota_error(response, window=DEFAULT_ERROR_SCAN_WINDOW):
     """Check if response contains quota-related error."""
-    response_lower = response.lower()
-    for pattern in QUOTA_ERROR_PATTERNS:
-        if re.search(pattern, response_lower, re.IGNORECASE):
-            return True
-    return False
+    return find_quota_error(response, window) is not None
 
 
 def parse_model_usage(stats_output):
@@ -140,15 +155,79 @@ def parse_model_usage(stats_output):
     return usage
 
 
+def usage_from_buckets(buckets):
+    """
+    Convert quota buckets into {model_id: remaining_percent} (the lowest bucket
+    per model; a bucket whose resetTime has passed counts as full).
+    """
+    from datetime import datetime, timezone
+    import account_selector  # Only needed after a quota error
+    
+    now = datetime.now(timezone.utc)
+    usage = {}
+    for bucket in buckets:
+        model_id = bucket.get("modelId")
+        fraction = bucket.get("remainingFraction")
+        if not model_id or fraction is None:
+            continue
+        reset_at = account_selector.parse_reset_time(bucket.get("resetTime"))
+        if reset_at and reset_at <= now:
+            fraction = 1.0
+        usage[model_id] = min(usage.get(model_id, 100.0), fraction * 100)
+    return usage
+
+
+def load_model_usage(config, account):
+    """
+    Remaining quota per model of `account` for the strategy check after a quota error.
+    A cached snapshot (younger than cache_minutes) that already calls for a switch
+    is used as is. Otherwise the quota is refreshed within QUOTA_REFRESH_TIMEOUT,
+    since the error may be newer than the snapshot; if that fails, the cached
+    snapshot is used. Returns (model_usage, source); model_usage is None without data.
+    """
+    import profile_cache  # Only needed after a quota error
+    
+    cached = None
+    if account:
+        with hook_trace.span("cache"):
+            cache = profile_cache.load_quota_snapshot(account, config["auto_switch"]["cache_minutes"])
+        if cache:
+            cached = usage_from_buckets(cache.get("buckets", []))
+            if cached and should_switch_by_strategy(config, cached):
+                return cached, "cache"
+    
+    error = "no active account"
+    if account:
+        try:
+            import quota_api_client
+            session = quota_api_client.make_pooled_session(1)
+            try:
+                with hook_trace.span("refresh"):
+                    result = quota_api_client.fetch_account_quota(
+                        session, account, timeout=QUOTA_REFRESH_TIMEOUT,
+                        cache_minutes=config["auto_switch"]["cache_minutes"])
+            finally:
+                session.close()
+        except ImportError as e:
+            result = {"ok": False, "error": str(e)}
+        if result["ok"] and result["buckets"]:
+            return usage_from_buckets(result["buckets"]), "refresh"
+        error = result["error"] or "no quota buckets"
+    
+    if cached:
+        return cached, f"cache (refresh failed: {error})"
+    return None, f"none ({error})"
+
+
 def should_switch_by_strategy(config, model_usage=None):
     """
     Determine if we should switch based on strategy.
+    model_usage is {model_id: remaining_percent} (load_model_usage()).
     Returns True if switch is needed.
     """
-    auto_switch = config.get("auto_switch", {})
-    strategy = auto_switch.get("strategy", "gemini3-first")
-    threshold = auto_switch.get("threshold", 5)
-    model_pattern = auto_switch.get("model_pattern", "gemini-3.*")
+    auto_switch = config["auto_switch"]
+    strategy = auto_switch["strategy"]
+    threshold = auto_switch["threshold"]  # Fraction; model_usage is in percent
     
     # If no model usage data, rely on error detection alone
     if not model_usage:
@@ -156,182 +235,247 @@ def should_switch_by_strategy(config, model_usage=None):
     
     if strategy == "conservative":
         # Switch only when ALL models are below threshold
-        all_exhausted = all(usage <= threshold for usage in model_usage.values())
+        all_exhausted = all(usage / 100 <= threshold for usage in model_usage.values())
         return all_exhausted
     
-    elif strategy == "gemini3-first":
-        # Switch when any Gemini 3.x model is below threshold
-        pattern = re.compile(model_pattern, re.IGNORECASE)
+    elif strategy in ("gemini3-first", "custom", "predictive"):
+        # predictive watches the same models as gemini3-first; its projection is the pre-check's job
+        # Switch when any model matching the strategy's pattern is below threshold
+        match = config_snapshot.strategy_matcher(auto_switch)
+        if match is None:
+            return True  # Fallback if no pattern set or invalid regex
         for model, usage in model_usage.items():
-            if pattern.match(model) and usage <= threshold:
+            if match(model) and usage / 100 <= threshold:
                 return True
         return False
-        
-    elif strategy == "custom":
-        # Switch when the custom matched model is below threshold
-        custom_pattern_str = auto_switch.get("custom_model_pattern", "")
-        if not custom_pattern_str:
-            return True # Fallback if no pattern set
-            
-        try:
-            pattern = re.compile(custom_pattern_str, re.IGNORECASE)
-            for model, usage in model_usage.items():
-                if pattern.match(model) and usage <= threshold:
-                    return True
-            return False
-        except re.error:
-            # Fallback if invalid regex
-            return True
     
     # Default: switch on any error
     return True
 
 
 def switch_to_next():
-    """Call gchange next to switch account."""
+    """
+    Switch to the next account in-process (auth_switch).
+    Returns the new account email, or None if the switch failed.
+    """
     try:
-        result = subprocess.run(
-            ["python", str(GEMINI_DIR / "gemini_cli_auth_manager.py"), "next"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        # Extract new account from output
-        output = result.stdout + result.stderr
-        match = re.search(r'Switched to (\S+)', output)
-        if match:
-            return match.group(1)
-        return "next account"
+        import auth_switch
+        result = auth_switch.switch_next()
     except Exception as e:
         log(f"[Auth Manager] Switch failed: {e}")
         return None
+    
+    if not result["ok"] or not result["switched"]:
+        log(f"[Auth Manager] Switch failed: {result['error']} {result['detail']}".rstrip())
+        return None
+    
+    for warning in result["warnings"]:
+        log(f"[Auth Manager] Warning: {warning}")
+    if result["token_cache_cleared"]:
+        log("[Cache] Cleared token cache.")
+    return result["account"]
+
+
+def parse_context(raw_input):
+    """
+    Parse the hook context (str or bytes), materializing only prompt_response
+    (capped to the error scan window). Returns None if the input is not valid JSON.
+    """
+    import io
+    try:
+        import hook_input
+    except ImportError:
+        try:
+            return json.loads(raw_input)
+        except:
+            return None
+    
+    window = load_config()["auto_switch"]["error_scan_window"]
+    stream = io.BytesIO(raw_input) if isinstance(raw_input, bytes) else io.StringIO(raw_input)
+    try:
+        return hook_input.read_context(stream, ("prompt_response",), max_chars=window or None)
+    except ValueError:
+        return None
+
+
+def trigger_restart(target_pid, hook_pid=None):
+    """
+    Launch restart_helper.py detached to restart the Gemini CLI process.
+    The helper starts as soon as `hook_pid` (the hook process whose output the
+    CLI must read first; this process when run in-process) has exited.
+    """
+    import subprocess  # Only needed on the (rare) restart path
+    
+    try:
+        # Launch restart helper detached
+        restart_script = GEMINI_DIR / "restart_helper.py"
+        if not restart_script.exists():
+            # Maybe still in source dir?
+            script_dir = Path(__file__).parent
+            restart_script = script_dir / "restart_helper.py"
+            
+        if restart_script.exists():
+            log(f"[Auto-Restart] Triggering restart for PID {target_pid}...")
+            
+            cmd = [sys.executable, str(restart_script), "--pid", str(target_pid),
+                   "--after-pid", str(hook_pid or os.getpid()), "--delay", "3"]
+            
+            if sys.platform == "win32":
+                # Use subprocess.Popen with creationflags instead of os.system
+                # DETACHED_PROCESS = 0x00000008, creates process without console
+                subprocess.Popen(
+                    cmd,
+                    creationflags=0x00000008,
+                    close_fds=True
+                )
+            else:
+                subprocess.Popen(
+                    cmd,
+                    start_new_session=True,
+                    close_fds=True
+                )
+        else:
+            log(f"[Auto-Restart] Helper script not found: {restart_script}")
+            
+    except Exception as restart_err:
+        log(f"[Auto-Restart] Failed to trigger: {restart_err}")
+
+
+def run_hook(context, parent_pid=None, hook_pid=None, endpoint=None):
+    """
+    Run the AfterAgent check for one hook context and return the hook output dict.
+    Called in-process by main() or by the quota daemon, which passes the PID of
+    the CLI process that ran the hook as parent_pid, the PID of the hook
+    process that forwarded the request as hook_pid and the CLI's
+    CODE_ASSIST_ENDPOINT as endpoint (default: this process's environment).
+    """
+    if context is None:
+        # No valid input, pass through
+        return {}
+    
+    response = context.get("prompt_response", "")
+    
+    # Load config
+    with hook_trace.span("config"):
+        config = load_config()
+    auto_switch = config["auto_switch"]
+    
+    # Check if auto-switch is enabled
+    if not auto_switch["enabled"]:
+        return {}
+    
+    # Check for quota error
+    with hook_trace.span("scan"):
+        matched_pattern = find_quota_error(response, auto_switch["error_scan_window"])
+    hook_trace.annotate(quota_error=matched_pattern)
+    if not matched_pattern:
+        # No error, reset retry count and clear error state
+        reset_retry_count()
+        clear_error_state()  # Clear state for BeforeAgent
+        return {}
+    
+    # Quota error detected - IMMEDIATELY write error state
+    # This ensures BeforeAgent can pre-switch even if CLI crashes after this
+    current_retry = get_retry_count()
+    set_error_state(current_retry, matched_pattern)  # Write state BEFORE any other processing
+    log(f"[Auth Manager] Quota error detected (pattern: {matched_pattern!r})")
+    
+    max_retries = auto_switch["max_retries"]
+    
+    if current_retry >= max_retries:
+        log(f"⚠️ [Auth Manager] Max retries ({max_retries}) reached. All accounts may be exhausted.")
+        reset_retry_count()
+        clear_error_state()  # Clear state since we've given up
+        return {}
+    
+    # Check if we should switch based on strategy, using the active account's real quota
+    import profile_cache
+    account = profile_cache.get_active_account()
+    model_usage, source = load_model_usage(config, account)
+    hook_trace.annotate(quota_source=source)
+    if not should_switch_by_strategy(config, model_usage):
+        log(f"[Auth Manager] Quota of {account} is above the threshold for strategy "
+            f"{auto_switch['strategy']} ({source}); not switching.")
+        # No switch, no retry: the turn ends with the error shown. The error
+        # state is cleared too, so the next prompt's pre-check does not switch
+        # on an error the quota check just dismissed.
+        clear_error_state()
+        hook_trace.annotate(switched=False, skipped="quota_ok")
+        return {}
+    
+    with hook_trace.span("switch"):
+        new_account = switch_to_next()
+    hook_trace.annotate(switched=bool(new_account), account=new_account)
+    
+    if not new_account:
+        log("⚠️ [Auth Manager] Failed to switch account.")
+        return {}
+    
+    set_retry_count(current_retry + 1)
+    
+    # Build message based on language
+    lang = config["language"]
+    if lang == "cn":
+        msg = f"🔄 配额已耗尽，已自动切换到账号：{new_account}。正在重试请求... ({current_retry + 1}/{max_retries})"
+    else:
+        msg = f"🔄 Quota exhausted. Switched to: {new_account}. Retrying... ({current_retry + 1}/{max_retries})"
+    
+    # Log to stderr (visible in debug console)
+    log(f"⚠️ [Auth Manager] {msg}")
+    
+    # --- AUTO-RESTART LOGIC ---
+    if auto_switch["auto_restart"]:
+        import auth_proxy
+        if auth_proxy.serving_cli(endpoint):
+            # The retried request already goes out with the new account
+            log("[Auto-Restart] CLI is served by the auth proxy, no restart needed")
+        else:
+            # Target is the CLI process that ran this hook
+            trigger_restart(parent_pid or os.getppid(), hook_pid)
+    # --------------------------
+    
+    # Output JSON with retry decision
+    # For AfterAgent, use "decision": "retry" to trigger retry
+    return {
+        "decision": "retry",
+        "systemMessage": msg
+    }
+
+
+def forward_to_daemon(raw_input):
+    """Hand the context to the quota daemon if it is running; None means run in-process."""
+    try:
+        from quota_daemon import request_hook  # Socket client: json/os/socket only
+    except ImportError:
+        return None
+    return request_hook("auto_switch", raw_input)
 
 
 def main():
     """Main hook entry point."""
     try:
-        # Read context from stdin
+        started = time.perf_counter()
         try:
-            context = json.load(sys.stdin)
+            # Read context from stdin (as is: the daemon or parse_context() extracts the fields)
+            raw_input = sys.stdin.buffer.read()
         except:
-            # No valid input, pass through
-            print("{}")
-            sys.exit(0)
-        
-        response = context.get("prompt_response", "")
-        
-        # Load config
-        config = load_config()
-        auto_switch = config.get("auto_switch", {})
-        
-        # Check if auto-switch is enabled
-        if not auto_switch.get("enabled", True):
-            print("{}")
-            sys.exit(0)
+            raw_input = b""
+        read = time.perf_counter()
         
-        # Check for quota error
-        if not is_quota_error(response):
-            # No error, reset retry count and clear error state
-            reset_retry_count()
-            clear_error_state()  # Clear state for BeforeAgent
-            print("{}")
-            sys.exit(0)
+        # A running daemon answers before anything else is imported (it traces the run itself)
+        result = forward_to_daemon(raw_input)
+        if result is None:
+            forwarded = time.perf_counter()
+            _import_in_process()
+            hook_trace.begin("auto_switch", started=_STARTED, phases={
+                "read_input": (read - started) * 1000,
+                "daemon": (forwarded - read) * 1000,
+            })
+            result = run_hook(parse_context(raw_input))
+            hook_trace.finish()
         
-        # Quota error detected - IMMEDIATELY write error state
-        # This ensures BeforeAgent can pre-switch even if CLI crashes after this
-        current_retry = get_retry_count()
-        set_error_state(current_retry)  # Write state BEFORE any other processing
-        
-        max_retries = auto_switch.get("max_retries", 3)
-        
-        if current_retry >= max_retries:
-            log(f"⚠️ [Auth Manager] Max retries ({max_retries}) reached. All accounts may be exhausted.")
-            reset_retry_count()
-            clear_error_state()  # Clear state since we've given up
-            print("{}")
-            sys.exit(0)
-        
-        # Check if we should switch based on strategy
-        if should_switch_by_strategy(config):
-            new_account = switch_to_next()
-            
-            if new_account:
-                set_retry_count(current_retry + 1)
-                
-                # Build message based on language
-                lang = config.get("language", "en")
-                if lang == "cn":
-                    msg = f"🔄 配额已耗尽，已自动切换到账号：{new_account}。正在重试请求... ({current_retry + 1}/{max_retries})"
-                else:
-                    msg = f"🔄 Quota exhausted. Switched to: {new_account}. Retrying... ({current_retry + 1}/{max_retries})"
-                
-                # Log to stderr (visible in debug console)
-                log(f"⚠️ [Auth Manager] {msg}")
-                
-                # Delete token cache to force reload
-                cache_file = GEMINI_DIR / "mcp-oauth-tokens-v2.json"
-                if cache_file.exists():
-                    try:
-                        cache_file.unlink()
-                        log("[Cache] Cleared token cache.")
-                    except OSError as e:
-                        log(f"[Cache] Warning: Failed to clear cache: {e}")
-
-                # Output JSON with retry decision
-                # For AfterAgent, use "decision": "retry" to trigger retry
-                result = {
-                    "decision": "retry",
-                    "systemMessage": msg
-                }
-                print(json.dumps(result))
-                
-                # --- AUTO-RESTART LOGIC ---
-                if auto_switch.get("auto_restart", False):
-                    try:
-                        # Determine current PID (likely python script itself)
-                        target_pid = os.getppid()
-                        
-                        # Launch restart helper detached
-                        restart_script = GEMINI_DIR / "restart_helper.py"
-                        if not restart_script.exists():
-                            # Maybe still in source dir?
-                            script_dir = Path(__file__).parent
-                            restart_script = script_dir / "restart_helper.py"
-                            
-                        if restart_script.exists():
-                            log(f"[Auto-Restart] Triggering restart for PID {target_pid}...")
-                            
-                            cmd = [sys.executable, str(restart_script), "--pid", str(target_pid), "--delay", "3"]
-                            
-                            if sys.platform == "win32":
-                                # Use subprocess.Popen with creationflags instead of os.system
-                                # DETACHED_PROCESS = 0x00000008, creates process without console
-                                subprocess.Popen(
-                                    [sys.executable, str(restart_script), "--pid", str(target_pid), "--delay", "3"],
-                                    creationflags=0x00000008,
-                                    close_fds=True
-                                )
-                            else:
-                                subprocess.Popen(
-                                    [sys.executable, str(restart_script), "--pid", str(target_pid), "--delay", "3"],
-                                    start_new_session=True,
-                                    close_fds=True
-                                )
-                        else:
-                            log(f"[Auto-Restart] Helper script not found: {restart_script}")
-                            
-                    except Exception as restart_err:
-                        log(f"[Auto-Restart] Failed to trigger: {restart_err}")
-                # --------------------------
-
-                sys.exit(0)  # Use exit(0) for successful hook execution
-            else:
-                log("⚠️ [Auth Manager] Failed to switch account.")
-                print("{}")
-                sys.exit(0)
-        else:
-            print("{}")
-            sys.exit(0)
+        print(json.dumps(result) if result else "{}")
+        sys.exit(0)  # Use exit(0) for successful hook execution
     
     except Exception as e:
         # Catch any unexpected errors to prevent hook failure
@@ -342,4 +486,5 @@ def main():
 
 if __name__ == "__main__":
     main()
-
+else:
+    _import_in_process()
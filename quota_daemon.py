@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Gemini CLI Quota Daemon
+Long-lived local service that answers BeforeAgent/AfterAgent hook requests over a
+Unix socket, so each prompt no longer cold-starts Python, re-imports requests and
+re-parses config/cache files.
+
+The daemon keeps the hook modules imported: parsed config, compiled strategy
+regexes, quota buckets and the requests.Session stay warm between prompts.
+A background thread keeps the access tokens of all pooled accounts fresh
+(token_scheduler; lead time from auto_switch.token_refresh_minutes, 0 = off).
+With tracing on (hook_trace), each request is traced as "<hook> (daemon)".
+Hooks call request_hook(); when the daemon is not running (or on platforms
+without AF_UNIX) they fall back to the normal in-process path.
+
+Usage:
+    python quota_daemon.py start     # Start in background
+    python quota_daemon.py stop      # Stop running daemon
+    python quota_daemon.py status    # Show daemon status
+    python quota_daemon.py serve     # Run in foreground
+"""
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+# --- Configuration ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+SOCKET_FILE = GEMINI_DIR / "quota_daemon.sock"
+LOG_FILE = GEMINI_DIR / "quota_daemon.log"
+
+CONNECT_TIMEOUT = 0.2   # Seconds; an absent daemon must not slow down the hook
+REQUEST_TIMEOUT = 15    # Seconds; quota refresh + switch can take a while
+START_TIMEOUT = 5       # Seconds to wait for a freshly started daemon
+
+
+# --- Client (stdlib only, imported by the hooks) ---
+def _send(header, body=b"", timeout=REQUEST_TIMEOUT):
+    """
+    Send one request to the daemon.
+    Returns (sent, reply): sent is False if the daemon could not be reached,
+    reply is the decoded JSON reply or None.
+    """
+    if not hasattr(socket, "AF_UNIX") or not SOCKET_FILE.exists():
+        return False, None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(str(SOCKET_FILE))
+        except OSError:
+            return False, None
+
+        try:
+            sock.settimeout(timeout)
+            sock.sendall(json.dumps(header).encode("utf-8") + b"\n" + body)
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return True, json.loads(b"".join(chunks).decode("utf-8"))
+        except (OSError, ValueError):
+            return True, None
+    finally:
+        sock.close()
+
+
+def request_hook(hook, raw_input):
+    """
+    Forward raw hook stdin (str or bytes) to the daemon.
+    Returns the hook output dict, or None if the daemon is not running and the
+    caller should run the hook in-process.
+    """
+    if isinstance(raw_input, str):
+        raw_input = raw_input.encode("utf-8", errors="replace")
+    sent, reply = _send(
+        {"op": "hook", "hook": hook, "ppid": os.getppid(), "pid": os.getpid(),
+         "endpoint": os.environ.get("CODE_ASSIST_ENDPOINT", "")},
+        raw_input,
+    )
+    if not sent:
+        return None
+
+    if not reply or "output" not in reply:
+        # The daemon accepted the request but failed mid-way. Do not re-run the
+        # hook in-process: the daemon may already have switched accounts.
+        print("[quota-daemon] No reply from daemon, skipping hook", file=sys.stderr)
+        return {}
+
+    if reply.get("stderr"):
+        sys.stderr.write(reply["stderr"])
+    return reply["output"]
+
+
+def ping():
+    """Return daemon status dict, or None if not running."""
+    sent, reply = _send({"op": "ping"}, timeout=2)
+    return reply if sent else None
+
+
+# --- Server ---
+def _import_hooks():
+    """Import the hook modules (installed to ~/.gemini/hooks, or side by side in the source tree)."""
+    hooks_dir = Path(__file__).resolve().parent / "hooks"
+    if hooks_dir.is_dir() and str(hooks_dir) not in sys.path:
+        sys.path.insert(0, str(hooks_dir))
+
+    import quota_pre_check
+    import quota_auto_switch
+    return {"pre_check": quota_pre_check, "auto_switch": quota_auto_switch}
+
+
+def _start_token_scheduler(stop_event):
+    """Run the pool token scheduler on a daemon thread (unless disabled in config)."""
+    import threading
+    import auth_switch
+    import token_scheduler
+
+    lead_minutes = auth_switch.load_auto_switch_config()["token_refresh_minutes"]
+    if not lead_minutes or lead_minutes <= 0:
+        return None
+
+    def log_results(results):
+        # sys.__stderr__ (the daemon log): sys.stderr may be redirected into a hook reply
+        for r in results:
+            status = "refreshed" if r["ok"] else f"failed ({r['error']})"
+            print(f"[quota-daemon] Token {status}: {r['account']}", file=sys.__stderr__, flush=True)
+
+    scheduler = token_scheduler.TokenScheduler(lead_minutes)
+    thread = threading.Thread(target=scheduler.run_forever, args=(stop_event, log_results),
+                              name="token-scheduler", daemon=True)
+    thread.start()
+    return thread
+
+
+def serve():
+    """Run the daemon in the foreground until stopped."""
+    import contextlib
+    import io
+    import signal
+    import socketserver
+    import threading
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("[quota-daemon] Unix sockets are not supported on this platform.", file=sys.stderr)
+        return 1
+
+    if SOCKET_FILE.exists():
+        if ping():
+            print("[quota-daemon] Already running.", file=sys.stderr)
+            return 0
+        # Left over from a crashed daemon
+        SOCKET_FILE.unlink()
+
+    hooks = _import_hooks()
+    import hook_trace
+
+    # Warm up: parse config and import requests before the first prompt arrives
+    hooks["pre_check"].load_config()
+    hooks["auto_switch"].load_config()
+    try:
+        hooks["pre_check"].get_http_session()
+    except ImportError:
+        pass
+    
+    stop_event = threading.Event()
+    _start_token_scheduler(stop_event)
+
+    class HookRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                header = json.loads(self.rfile.readline().decode("utf-8") or "{}")
+            except ValueError:
+                return
+            reply = self.server.dispatch(header, self.rfile.read())
+            self.wfile.write(json.dumps(reply, ensure_ascii=False).encode("utf-8"))
+
+    class QuotaDaemon(socketserver.UnixStreamServer):
+        # Requests are handled one at a time: hook state files are not shared
+        # safely between threads, and prompts rarely arrive concurrently.
+        started = time.time()
+        served = 0
+
+        def dispatch(self, header, body):
+            op = header.get("op")
+            if op == "ping":
+                return {
+                    "ok": True,
+                    "pid": os.getpid(),
+                    "uptime": round(time.time() - self.started, 1),
+                    "requests": self.served,
+                }
+            if op == "shutdown":
+                threading.Thread(target=self.shutdown, daemon=True).start()
+                return {"ok": True}
+            if op != "hook" or header.get("hook") not in hooks:
+                return {"error": f"unknown request: {op}"}
+
+            module = hooks[header["hook"]]
+            stderr = io.StringIO()
+            hook_trace.begin(header["hook"], daemon=True)
+            with contextlib.redirect_stderr(stderr):
+                try:
+                    context = module.parse_context(body.decode("utf-8", errors="replace"))
+                    output = module.run_hook(context, parent_pid=header.get("ppid"), hook_pid=header.get("pid"),
+                                             endpoint=header.get("endpoint", ""))
+                except Exception as e:
+                    print(f"[quota-daemon] Hook {header['hook']} failed: {e}", file=sys.stderr)
+                    output = {}
+            hook_trace.finish()
+            self.served += 1
+            return {"output": output, "stderr": stderr.getvalue()}
+
+    old_umask = os.umask(0o077)  # Socket is private to the current user
+    try:
+        server = QuotaDaemon(str(SOCKET_FILE), HookRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    def _stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    print(f"[quota-daemon] Listening on {SOCKET_FILE} (PID {os.getpid()})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        stop_event.set()
+        server.server_close()
+        try:
+            SOCKET_FILE.unlink()
+        except OSError:
+            pass
+        print("[quota-daemon] Stopped.", file=sys.stderr)
+    return 0
+
+
+def start_daemon():
+    """Start the daemon detached; returns the ping status dict or None on failure."""
+    import subprocess
+
+    status = ping()
+    if status:
+        return status
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    GEMINI_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LOG_FILE, "a", encoding="utf-8") as log_f:
+        subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "serve"],
+            stdin=subprocess.DEVNULL,
+            stdout=log_f,
+            stderr=log_f,
+            start_new_session=True,
+            close_fds=True,
+        )
+
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.1)
+        status = ping()
+        if status:
+            return status
+    return None
+
+
+def stop_daemon():
+    """Ask a running daemon to shut down; returns True if one was running."""
+    sent, reply = _send({"op": "shutdown"}, timeout=2)
+    return bool(sent and reply and reply.get("ok"))
+
+
+def main():
+    command = sys.argv[1].lower() if len(sys.argv) > 1 else "status"
+
+    if command == "serve":
+        sys.exit(serve())
+    elif command == "start":
+        status = start_daemon()
+        if status:
+            print(f"[OK] Quota daemon running (PID {status['pid']})")
+        else:
+            print(f"[Error] Failed to start quota daemon. See {LOG_FILE}")
+            sys.exit(1)
+    elif command == "stop":
+        if stop_daemon():
+            print("[OK] Quota daemon stopped.")
+        else:
+            print("[Info] Quota daemon is not running.")
+    elif command == "status":
+        status = ping()
+        if status:
+            print(f"[OK] Quota daemon running (PID {status['pid']}, "
+                  f"uptime {status['uptime']}s, {status['requests']} requests served)")
+        else:
+            print("[Info] Quota daemon is not running.")
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
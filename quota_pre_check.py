@@ -4,38 +4,71 @@ BeforeAgent Hook: 配额预检测
 在每次请求前检查配额状态，如果低于阈值则自动切换账号
 
 优化特性：
-1. 缓存机制：避免每次请求都调用 API（默认 5 分钟缓存）
-2. 会话级检测：检测到新会话时强制刷新缓存
-3. 策略支持：支持 "conservative" (耗尽所有) 和 "gemini3-first" (耗尽指定系列)
+1. 缓存机制：避免每次请求都调用 API（默认 3 分钟缓存）
+2. 按账号缓存：配额快照按账号保存在 auth_profiles/<email>/ 下，切换账号或新会话时复用未过期数据
+3. 策略支持：支持 "conservative" (耗尽所有)、"gemini3-first" (耗尽指定系列) 和 "predictive" (按消耗速度预测，下次刷新前将耗尽即切换)
 4. 清晰的切换提示：通过 systemMessage 通知用户
+5. 常驻进程：quota_daemon 运行时，请求直接转发给守护进程处理（配置/缓存/HTTP 会话常驻内存）
+6. 单飞刷新 + 后台刷新：同一账号同时只有一个会话调用 API；max_stale_minutes > 0 时过期缓存先用，后台进程刷新
+7. Token 续期：即将过期的 access_token 在调用 API 前直接用 refresh_token 换新，401 时刷新并重试一次
+8. 耗时追踪：auto_switch.trace 开启后各阶段耗时写入 hook_trace.jsonl（gchange stats 查看）
+9. 认证代理：CLI 经 auth_proxy 访问 API 时，切换在下一个请求即生效，无需重启
+10. 负载均衡：rotation 为 "balanced" 且 CLI 经认证代理运行时，按会话或按请求以配额加权方式重新选号
 
 API 说明:
-- loadCodeAssist: 获取 cloudaicompanionProject ID
+- loadCodeAssist: 获取 cloudaicompanionProject ID（按账号缓存，403/404 时失效重取）
 - retrieveUserQuota: 获取各模型配额剩余百分比
 """
 import json
 import os
 import sys
-import subprocess
-import re
+import time
+
+_STARTED = time.perf_counter()  # Start of the hook script, for the "import" trace phase
+
 from pathlib import Path
 from datetime import datetime, timedelta
 
-# API Endpoints (from Gemini CLI source code)
-CODE_ASSIST_ENDPOINT = "https://cloudcode-pa.googleapis.com"
+# API Endpoints (from Gemini CLI source code; CODE_ASSIST_ENDPOINT env redirects, e.g. to benchmark.py's mock)
+CODE_ASSIST_ENDPOINT = os.environ.get("CODE_ASSIST_ENDPOINT", "https://cloudcode-pa.googleapis.com")
 CODE_ASSIST_API_VERSION = "v1internal"
 
 GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
 OAUTH_CREDS_FILE = GEMINI_DIR / "oauth_creds.json"
-AUTH_CONFIG_FILE = GEMINI_DIR / "auth_config.json"
-QUOTA_CACHE_FILE = GEMINI_DIR / "quota_cache.json"
 
-# Default configuration
-DEFAULT_THRESHOLD = 0.10  # 10% remaining triggers switch
-DEFAULT_MODELS_TO_CHECK = ["gemini-3-pro-preview", "gemini-2.5-pro"]
-DEFAULT_CACHE_MINUTES = 3  # Cache quota check for 3 minutes
-DEFAULT_STRATEGY = "gemini3-first"
-DEFAULT_PATTERN = "gemini-3.*"
+# Single-flight refresh: one session per account fetches, the others wait for its snapshot
+REFRESH_LEASE_SECONDS = 30   # Upper bound of one refresh (loadCodeAssist + retrieveUserQuota)
+REFRESH_WAIT_SECONDS = 3     # How long other sessions wait for the fresh snapshot
+REFRESH_POLL_SECONDS = 0.1
+
+BALANCE_SESSIONS_KEPT = 32   # Recent session IDs remembered by per-session balancing
+
+import hook_path
+hook_path.add_shared_modules()
+
+
+def _import_in_process():
+    """
+    Import the modules of the in-process path. Deferred so that a prompt the
+    quota daemon answers loads none of them (see main()); importing this
+    module from elsewhere (the daemon) loads them right away.
+    """
+    global account_selector, auth_proxy, config_snapshot, hook_trace
+    global oauth_refresh, profile_cache, state_store, CODE_ASSIST_ENDPOINT
+    import account_selector
+    import auth_proxy
+    import config_snapshot
+    import hook_trace
+    import oauth_refresh
+    import profile_cache
+    import state_store
+
+    # The CLI may be pointed at the auth proxy; our per-account calls go straight upstream
+    CODE_ASSIST_ENDPOINT = auth_proxy.direct_endpoint(CODE_ASSIST_ENDPOINT)
+
+
+# HTTP session reused across requests when the quota daemon keeps this module loaded
+_http_session = None
 
 
 def log(message, level="INFO"):
@@ -45,47 +78,22 @@ def log(message, level="INFO"):
 
 
 def load_config():
-    """Load configuration from auth_config.json."""
-    config = {
-        "threshold": DEFAULT_THRESHOLD,
-        "models_to_check": DEFAULT_MODELS_TO_CHECK,
-        "enabled": True,
-        "cache_minutes": DEFAULT_CACHE_MINUTES,
-        "strategy": DEFAULT_STRATEGY,
-        "model_pattern": DEFAULT_PATTERN,
-    }
-    
-    if AUTH_CONFIG_FILE.exists():
-        try:
-            with open(AUTH_CONFIG_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                auto_switch = data.get("auto_switch", {})
-                config["threshold"] = auto_switch.get("threshold", DEFAULT_THRESHOLD * 100) / 100
-                config["enabled"] = auto_switch.get("enabled", True)
-                config["models_to_check"] = auto_switch.get("models_to_check", DEFAULT_MODELS_TO_CHECK)
-                config["cache_minutes"] = auto_switch.get("cache_minutes", DEFAULT_CACHE_MINUTES)
-                config["strategy"] = auto_switch.get("strategy", DEFAULT_STRATEGY)
-                config["model_pattern"] = auto_switch.get("model_pattern", DEFAULT_PATTERN) # pattern for gemini3-first
-        except:
-            pass
-    
-    return config
-
-
-def load_cache():
-    """Load cached quota information."""
-    if not QUOTA_CACHE_FILE.exists():
-        return None
-    
+    """
+    Return the auto_switch section of the config snapshot (config_snapshot):
+    validated, defaults filled in, threshold as a fraction, patterns as matchers.
+    """
+    return config_snapshot.load()["auto_switch"]
+
+
+def load_cache(account, cache_minutes):
+    """Load cached quota information for an account if younger than cache_minutes."""
     try:
-        with open(QUOTA_CACHE_FILE, 'r', encoding='utf-8') as f:
-            cache = json.load(f)
+        cache = profile_cache.load_quota_snapshot(account)
+        if not cache:
+            return None
         
         # Check if cache is expired
-        cache_time = datetime.fromisoformat(cache.get("timestamp", "2000-01-01T00:00:00"))
-        cache_minutes = cache.get("cache_minutes", DEFAULT_CACHE_MINUTES)
-        
-        if datetime.now() - cache_time > timedelta(minutes=cache_minutes):
+        if profile_cache.snapshot_age(cache) > timedelta(minutes=cache_minutes):
             log(f"Cache expired (>{cache_minutes}min old)", "DEBUG")
             return None
         
@@ -95,55 +103,81 @@ def load_cache():
         return None
 
 
-def save_cache(buckets, session_id, cache_minutes):
-    """Save quota information to cache."""
+def save_cache(account, buckets, cache_minutes):
+    """Save quota information to the account's cache."""
     try:
-        cache = {
-            "timestamp": datetime.now().isoformat(),
-            "session_id": session_id,
-            "buckets": buckets,
-            "cache_minutes": cache_minutes,
-        }
-        with open(QUOTA_CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, indent=2)
+        profile_cache.save_quota_snapshot(account, buckets, cache_minutes)
     except Exception as e:
         log(f"Failed to save cache: {e}", "DEBUG")
 
 
-def load_oauth_token():
-    """Load OAuth access token from credentials file."""
-    if not OAUTH_CREDS_FILE.exists():
+def oauth_creds_file(account=None):
+    """Return the credentials file of `account` (the live file if not given)."""
+    return profile_cache.credentials_file(account) if account else OAUTH_CREDS_FILE
+
+
+def load_oauth_token(account=None):
+    """
+    Load the OAuth access token of `account` (the live one if not given),
+    refreshing it first when it is about to expire.
+    """
+    creds_file = oauth_creds_file(account)
+    if not creds_file.exists():
         return None
-    
+    return oauth_refresh.get_access_token(creds_file)
+
+
+def refresh_oauth_token(account, rejected_token):
+    """Refresh a token the API rejected (401); returns the new token or None."""
     try:
-        with open(OAUTH_CREDS_FILE, 'r', encoding='utf-8') as f:
-            creds = json.load(f)
-        return creds.get("access_token")
-    except:
+        creds = oauth_refresh.refresh_credentials(oauth_creds_file(account), rejected_token=rejected_token)
+    except oauth_refresh.TokenRefreshError as e:
+        log(f"OAuth token refresh failed: {e}", "WARN")
         return None
+    log("OAuth token refreshed after 401", "INFO")
+    return creds.get("access_token")
+
+
+def get_http_session():
+    """Return a shared requests.Session (imported lazily, reused for keep-alive)."""
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+    return _http_session
 
 
 def call_api(endpoint, access_token, payload):
-    """Make an API call using requests."""
+    """
+    Make an API call using requests.
+    Returns (result, status_code); result is None on failure.
+    """
     try:
-        import requests
-        
         url = f"{CODE_ASSIST_ENDPOINT}/{CODE_ASSIST_API_VERSION}:{endpoint}"
         headers = {
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json",
         }
         
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        with hook_trace.span(endpoint):
+            response = get_http_session().post(url, headers=headers, json=payload, timeout=10)
         response.raise_for_status()
-        return response.json()
+        return response.json(), response.status_code
     except Exception as e:
         log(f"API call failed: {e}", "ERROR")
-        return None
+        response = getattr(e, "response", None)
+        return None, getattr(response, "status_code", None)
 
 
-def get_project_id(access_token):
-    """Get cloudaicompanionProject ID via loadCodeAssist API."""
+def get_project_id(access_token, account):
+    """
+    Get cloudaicompanionProject ID, from the profile cache or via loadCodeAssist API.
+    Returns (project_id, from_cache, status_code).
+    """
+    info = profile_cache.load_project_info(account)
+    if info:
+        return info["project"], True, None
+    
     payload = {
         "metadata": {
             "ideType": "GEMINI_CLI",
@@ -152,57 +186,191 @@ def get_project_id(access_token):
         }
     }
     
-    result = call_api("loadCodeAssist", access_token, payload)
-    if result:
-        return result.get("cloudaicompanionProject")
-    return None
+    result, status = call_api("loadCodeAssist", access_token, payload)
+    if not result:
+        return None, False, status
+    
+    project_id = result.get("cloudaicompanionProject")
+    if project_id:
+        try:
+            profile_cache.save_project_info(account, project_id, result.get("currentTier"))
+        except OSError as e:
+            log(f"Failed to cache project ID: {e}", "DEBUG")
+    return project_id, False, status
 
 
 def get_quota_info(access_token, project_id):
-    """Get quota information via retrieveUserQuota API."""
+    """
+    Get quota information via retrieveUserQuota API.
+    Returns (result, status_code).
+    """
     payload = {"project": project_id}
     return call_api("retrieveUserQuota", access_token, payload)
 
 
-def check_quota(config, session_id):
+def _query_quota(access_token, account):
+    """
+    Resolve the project and query its quota.
+    Returns (project_id, quota_result, status_code) of the last call made.
+    """
+    project_id, from_cache, status = get_project_id(access_token, account)
+    if not project_id:
+        return None, None, status
+    
+    quota_result, status = get_quota_info(access_token, project_id)
+    if status in (403, 404) and from_cache:
+        # Cached project no longer valid for this account: re-resolve once
+        log(f"Cached project ID rejected ({status}), refreshing via loadCodeAssist", "INFO")
+        profile_cache.invalidate_project_info(account)
+        project_id, _, status = get_project_id(access_token, account)
+        if project_id:
+            quota_result, status = get_quota_info(access_token, project_id)
+    return project_id, quota_result, status
+
+
+def fetch_quota(account, cache_minutes):
+    """
+    Fetch fresh quota buckets from the API and save them to the account's cache.
+    Returns (buckets, reason); buckets is None on failure.
+    """
+    with hook_trace.span("token"):
+        access_token = load_oauth_token(account)
+    if not access_token:
+        log("No OAuth token found", "WARN")
+        return None, "No token"
+    
+    project_id, quota_result, status = _query_quota(access_token, account)
+    if status == 401:
+        # Token revoked or expired early: refresh it in-process and retry once
+        with hook_trace.span("token"):
+            access_token = refresh_oauth_token(account, access_token)
+        if access_token:
+            project_id, quota_result, status = _query_quota(access_token, account)
+    
+    if not project_id:
+        log("Could not get project ID", "WARN")
+        return None, "No project ID"
+    
+    if not quota_result or "buckets" not in quota_result:
+        log("Could not get quota info", "WARN")
+        return None, "Api Failed"
+    
+    buckets = quota_result["buckets"]
+    save_cache(account, buckets, cache_minutes)
+    return buckets, "Fetched"
+
+
+def refresh_lease_name(account):
+    return f"quota_refresh:{account or ''}"
+
+
+def start_background_refresh(account, cache_minutes):
+    """
+    Refresh an account's quota in a detached process (`--refresh`).
+    The refresh lease is taken here and handed to the child, so concurrent
+    sessions spawn at most one refresher. Returns True if one was started.
     """
-    Check quota status based on strategy.
+    lease = refresh_lease_name(account)
+    owner = f"background:{os.getpid()}:{time.time()}"
+    if state_store.acquire_lease(lease, REFRESH_LEASE_SECONDS, owner=owner) is False:
+        return False  # Another session is already refreshing (None: no store, refresh unleased)
+    
+    import subprocess  # Only needed when the cache is stale
+    
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--refresh", account or "", str(cache_minutes), owner]
+    try:
+        if sys.platform == "win32":
+            # DETACHED_PROCESS = 0x00000008, creates process without console
+            subprocess.Popen(cmd, creationflags=0x00000008, close_fds=True,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            subprocess.Popen(cmd, start_new_session=True, close_fds=True,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        log(f"Failed to start background refresh: {e}", "WARN")
+        state_store.release_lease(lease, owner=owner)
+        return False
+    return True
+
+
+def run_background_refresh(args):
+    """Entry point of the detached refresher: quota_pre_check.py --refresh <account> <cache_minutes> <lease owner>."""
+    account = args[0] or None
+    cache_minutes = float(args[1])
+    owner = args[2]
+    try:
+        fetch_quota(account, cache_minutes)
+    finally:
+        state_store.release_lease(refresh_lease_name(account), owner=owner)
+
+
+def refresh_quota(account, cache_minutes):
+    """
+    Refresh an account's quota, at most once at a time across all sessions.
+    The session holding the refresh lease fetches; the others wait briefly for
+    its snapshot and otherwise fall back to the previous one.
+    Returns (buckets, reason); buckets is None if nothing usable is available.
+    """
+    lease = refresh_lease_name(account)
+    leased = state_store.acquire_lease(lease, REFRESH_LEASE_SECONDS)
+    if leased is None:
+        # State store unavailable: no session can coordinate, so just fetch
+        hook_trace.annotate(cache="miss")
+        return fetch_quota(account, cache_minutes)
+    if leased:
+        hook_trace.annotate(cache="miss")
+        try:
+            return fetch_quota(account, cache_minutes)
+        finally:
+            state_store.release_lease(lease)
+    
+    log("Quota refresh in progress in another session, waiting for it", "DEBUG")
+    hook_trace.annotate(cache="shared")
+    deadline = time.monotonic() + REFRESH_WAIT_SECONDS
+    with hook_trace.span("refresh_wait"):
+        while time.monotonic() < deadline:
+            time.sleep(REFRESH_POLL_SECONDS)
+            cache = profile_cache.load_quota_snapshot(account, cache_minutes)
+            if cache:
+                return cache.get("buckets", []), "Shared refresh"
+    
+    previous = profile_cache.load_quota_snapshot(account)
+    if previous:
+        log("Shared refresh not finished, using previous quota snapshot", "DEBUG")
+        return previous.get("buckets", []), "Previous snapshot"
+    return None, "Refresh in progress"
+
+
+def check_quota(config, account):
+    """
+    Check quota status of an account based on strategy.
     Returns (buckets, should_switch, reason)
     """
     cache_minutes = config["cache_minutes"]
     
-    # Try loading from cache first
-    cache = load_cache()
+    # Try loading from the account's cache first (shared across sessions)
+    with hook_trace.span("cache"):
+        cache = load_cache(account, cache_minutes)
     if cache:
-        # Check if session changed (new session = force refresh)
-        if cache.get("session_id") == session_id:
-            log(f"Using cached quota (expires in {cache_minutes}min)", "DEBUG")
+        log(f"Using cached quota for {account or 'current account'} (cache: {cache_minutes}min)", "DEBUG")
+        hook_trace.annotate(cache="hit")
+        buckets = cache.get("buckets", [])
+    
+    if not cache and config["max_stale_minutes"] > 0:
+        # Stale-while-revalidate: decide on a recent snapshot, refresh for the next prompt
+        with hook_trace.span("cache"):
+            cache = profile_cache.load_quota_snapshot(account, config["max_stale_minutes"])
+        if cache:
+            hook_trace.annotate(cache="stale")
+            started = start_background_refresh(account, cache_minutes)
+            log(f"Using stale quota for {account or 'current account'} "
+                f"({'refreshing in background' if started else 'refresh already running'})", "DEBUG")
             buckets = cache.get("buckets", [])
-        else:
-            log("New session detected, refreshing quota", "INFO")
-            cache = None
     
     if not cache:
-        # Need to fetch fresh data
-        access_token = load_oauth_token()
-        if not access_token:
-            log("No OAuth token found", "WARN")
-            return None, False, "No token"
-        
-        project_id = get_project_id(access_token)
-        if not project_id:
-            log("Could not get project ID", "WARN")
-            return None, False, "No project ID"
-        
-        quota_result = get_quota_info(access_token, project_id)
-        if not quota_result or "buckets" not in quota_result:
-            log("Could not get quota info", "WARN")
-            return None, False, "Api Failed"
-        
-        buckets = quota_result["buckets"]
-        
-        # Save to cache
-        save_cache(buckets, session_id, cache_minutes)
+        buckets, reason = refresh_quota(account, cache_minutes)
+        if buckets is None:
+            return None, False, reason
     
     # --- Strategy Check ---
     threshold = config["threshold"]
@@ -215,17 +383,17 @@ def check_quota(config, session_id):
         target_buckets = [b for b in buckets if b.get("remainingFraction") is not None]
         log("Strategy: conservative (checking ALL models)", "DEBUG")
     
-    elif strategy == "gemini3-first":
-        # Check buckets matching pattern
-        pattern = config["model_pattern"]
-        try:
-            regex = re.compile(pattern)
+    else:
+        # Check buckets matching the strategy's pattern (custom_model_pattern for "custom")
+        pattern = config["custom_model_pattern" if strategy == "custom" else "model_pattern"]
+        match = config_snapshot.strategy_matcher(config)
+        if match:
             target_buckets = [
                 b for b in buckets 
-                if b.get("modelId") and regex.match(b["modelId"]) and b.get("remainingFraction") is not None
+                if b.get("modelId") and match(b["modelId"]) and b.get("remainingFraction") is not None
             ]
-            log(f"Strategy: gemini3-first (pattern: {pattern})", "DEBUG")
-        except:
+            log(f"Strategy: {strategy} (pattern: {pattern})", "DEBUG")
+        else:
             log(f"Invalid regex: {pattern}", "WARN")
             target_buckets = []
     
@@ -248,11 +416,19 @@ def check_quota(config, session_id):
     for bucket in target_buckets:
         remaining = bucket.get("remainingFraction", 1.0)
         model_id = bucket.get("modelId", "unknown")
+        detail = f"{model_id}: {remaining * 100:.1f}%"
+        
+        if strategy == "predictive":
+            # Switch if the bucket will be below threshold by the next refresh
+            projected, rate = account_selector.projected_fraction(account, bucket, config["cache_minutes"])
+            if rate:
+                detail += f" -> {projected * 100:.1f}% in {config['cache_minutes']}min"
+            remaining = projected
         
         if remaining > threshold:
             all_low = False
         else:
-            low_details.append(f"{model_id}: {remaining * 100:.1f}%")
+            low_details.append(detail)
             
     if all_low:
         return buckets, True, ", ".join(low_details)
@@ -261,74 +437,129 @@ def check_quota(config, session_id):
 
 
 def switch_account():
-    """Call gchange next to switch account."""
+    """
+    Switch to the next account in-process (auth_switch).
+    Returns the new account email, or None if the switch failed.
+    """
     try:
-        result = subprocess.run(
-            ["gchange", "next"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode == 0:
-            log("Account switched successfully", "INFO")
-            # Clear cache after switch to force fresh check
-            if QUOTA_CACHE_FILE.exists():
-                QUOTA_CACHE_FILE.unlink()
-            return True
-        else:
-            log(f"Account switch failed: {result.stderr}", "ERROR")
-            return False
+        import auth_switch
+        result = auth_switch.switch_next()
     except Exception as e:
-        log(f"Failed to call gchange: {e}", "ERROR")
-        return False
+        log(f"Account switch failed: {e}", "ERROR")
+        return None
+    
+    if result["ok"] and result["switched"]:
+        log(f"Account switched to {result['account']}", "INFO")
+        # Quota cache is per account: the new account's snapshot stays valid
+        return result["account"]
+    
+    log(f"Account switch failed: {result['error']} {result['detail']}".rstrip(), "ERROR")
+    return None
 
 
-def main():
-    """Main entry point for BeforeAgent hook."""
+def rebalance(config, context):
+    """
+    Balanced rotation: re-pick the serving account by quota weight, once per
+    session (new session_id) or before every prompt (auto_switch.balance_scope).
+    Returns the account switched to, or None if the active account stays.
+    """
+    import auth_switch
+    
+    session = context.get("session_id")
+    per_session = config["balance_scope"] == "session"
+    if per_session:
+        state = state_store.get(account_selector.BALANCE_STATE_KEY) or {}
+        if session and session in state.get("sessions", []):
+            return None
+    
     try:
-        # Read context from stdin
-        raw_input = sys.stdin.read()
-        context = json.loads(raw_input) if raw_input.strip() else {}
-    except:
-        context = {}
+        result = auth_switch.switch_balanced(config)
+    except Exception as e:
+        log(f"Balancing failed: {e}", "ERROR")
+        return None
     
-    session_id = context.get("session_id", "unknown")
+    if per_session and session:
+        # One transaction: switch_balanced (and other sessions) update the same state
+        def remember(state):
+            state = state or {}
+            state["sessions"] = (state.get("sessions", []) + [session])[-BALANCE_SESSIONS_KEPT:]
+            return state
+        state_store.update(account_selector.BALANCE_STATE_KEY, remember)
     
+    if not result["ok"]:
+        log(f"Balancing skipped: {result['error']} {result['detail']}".rstrip(), "WARN")
+        return None
+    if not result["switched"]:
+        log(f"Balanced: staying on {result['account']} (weight {result['weight']:.3f})", "DEBUG")
+        return None
+    log(f"Balanced: serving {result['account']} (weight {result['weight']:.3f})", "INFO")
+    return result["account"]
+
+
+def parse_context(raw_input):
+    """Parse the hook context JSON, tolerating empty or invalid input."""
+    try:
+        return json.loads(raw_input) if raw_input.strip() else {}
+    except:
+        return {}
+
+
+def run_hook(context, parent_pid=None, hook_pid=None, endpoint=None):
+    """
+    Run the pre-check for one hook context and return the hook output dict.
+    Called in-process by main() or by the quota daemon (parent_pid/hook_pid
+    are only used by the AfterAgent hook's auto-restart; endpoint is the CLI's
+    CODE_ASSIST_ENDPOINT, default: this process's environment).
+    """
     # Load configuration
-    config = load_config()
+    with hook_trace.span("config"):
+        config = load_config()
     
     if not config["enabled"]:
         log("Quota pre-check disabled", "INFO")
-        print("{}")
-        sys.exit(0)
+        return {}
+    
+    # Balancing re-picks the account between requests: only the auth proxy applies that without a restart
+    if config["rotation"] == "balanced" and auth_proxy.serving_cli(endpoint):
+        with hook_trace.span("balance"):
+            balanced = rebalance(config, context)
+        hook_trace.annotate(balanced=balanced)
     
     # Check quota
-    buckets, should_switch, reason = check_quota(config, session_id)
+    buckets, should_switch, reason = check_quota(config, profile_cache.get_active_account())
     
     # Prepare output
     output = {}
     
     if not buckets:
         log(f"Quota check skipped: {reason}", "WARN")
-        print(json.dumps(output, ensure_ascii=False))
-        sys.exit(0)
+        return output
     
     if not should_switch:
         threshold_pct = config["threshold"] * 100
         log(f"Quota OK (threshold: {threshold_pct:.0f}%). Strategy: {config['strategy']}", "INFO")
-        print(json.dumps(output, ensure_ascii=False))
-        sys.exit(0)
+        return output
     
     # Low quota detected - switch account
     log(f"Low quota detected ({reason}). Switching...", "WARN")
     
-    if switch_account():
+    with hook_trace.span("switch"):
+        new_account = switch_account()
+    hook_trace.annotate(switched=bool(new_account), account=new_account)
+    if new_account and auth_proxy.serving_cli(endpoint):
+        # The proxy signs the next request with the new account
+        output["systemMessage"] = (
+            f"⚡ **账号已自动切换** | Account Auto-Switched\n"
+            f"   检测到配额耗尽: {reason}\n"
+            f"   Detected exhausted quota, switched to {new_account}.\n"
+            f"   ✅ 已通过认证代理生效，无需重启 | Applied via auth proxy, no restart needed."
+        )
+    elif new_account:
         # Switch successful - notify user
         output["systemMessage"] = (
             f"⚡ **账号已自动切换** | Account Auto-Switched\n"
             f"   检测到配额耗尽: {reason}\n"
-            f"   Detected exhausted quota, switched to next account.\n"
+            f"   Detected exhausted quota, switched to {new_account}.\n"
             f"   ⚠️ **请重启 CLI 生效** | Please restart CLI to apply changes."
         )
     else:
@@ -339,9 +570,50 @@ def main():
             f"   自动切换失败，请手动运行: gchange next"
         )
     
+    return output
+
+
+def forward_to_daemon(raw_input):
+    """Hand the context to the quota daemon if it is running; None means run in-process."""
+    try:
+        from quota_daemon import request_hook  # Socket client: json/os/socket only
+    except ImportError:
+        return None
+    return request_hook("pre_check", raw_input)
+
+
+def main():
+    """Main entry point for BeforeAgent hook."""
+    if sys.argv[1:2] == ["--refresh"]:
+        _import_in_process()
+        run_background_refresh(sys.argv[2:])
+        return
+    
+    started = time.perf_counter()
+    try:
+        # Read context from stdin
+        raw_input = sys.stdin.read()
+    except:
+        raw_input = ""
+    read = time.perf_counter()
+    
+    # A running daemon answers before anything else is imported (it traces the run itself)
+    output = forward_to_daemon(raw_input)
+    if output is None:
+        forwarded = time.perf_counter()
+        _import_in_process()
+        hook_trace.begin("pre_check", started=_STARTED, phases={
+            "read_input": (read - started) * 1000,
+            "daemon": (forwarded - read) * 1000,
+        })
+        output = run_hook(parse_context(raw_input))
+        hook_trace.finish()
+    
     print(json.dumps(output, ensure_ascii=False))
     sys.exit(0)
 
 
 if __name__ == "__main__":
     main()
+else:
+    _import_in_process()
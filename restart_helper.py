@@ -2,6 +2,22 @@
 """
 Gemini CLI Restart Helper
 Terminates the parent Gemini CLI process and spawns a new instance in a new window.
+
+Restarts are driven by process exits instead of fixed sleeps:
+1. Wait until the hook process that launched the helper (--after-pid) has
+   exited, so its output reached the CLI (at most --delay seconds).
+2. Terminate the CLI (SIGTERM; taskkill /F on Windows) and wait for it to
+   exit, escalating to SIGKILL after --grace seconds.
+3. Start the new instance as soon as the old one is gone.
+
+Processes are watched with a pidfd (Linux 5.3+, Python 3.9+) or a process
+handle (Windows), opened before anything is signalled so a reused PID is
+never mistaken for the CLI; elsewhere (or when no handle can be opened) the
+PID is polled with backoff.
+
+The measured latency of each step is printed, stored in the state store
+(key "last_restart") and, with tracing on, recorded as a "restart" trace
+(see gchange stats).
 """
 import os
 import sys
@@ -9,55 +25,267 @@ import time
 import subprocess
 import argparse
 
-def restart_gemini(pid, delay):
+DEFAULT_DELAY = 3.0   # Upper bound for the hook process to exit
+DEFAULT_GRACE = 5.0   # SIGTERM -> SIGKILL escalation
+KILL_WAIT = 2.0       # How long to wait for the process to disappear after SIGKILL
+POLL_MIN = 0.005      # Fallback polling interval, doubled up to POLL_MAX
+POLL_MAX = 0.1
+
+_SYNCHRONIZE = 0x00100000  # Windows access right for WaitForSingleObject
+_QUERY_LIMITED_INFORMATION = 0x1000  # Windows access right for GetExitCodeProcess
+_STILL_ACTIVE = 259
+_WAIT_OBJECT_0 = 0
+
+
+class ProcessWatch:
     """
-    1. Wait for `delay` seconds.
-    2. Kill process `pid`.
-    3. Start new 'gemini' process in new window.
+    Handle on another process that can be waited on for exit.
+    method is "pidfd", "handle" (Windows) or "poll" (kill(pid, 0), on Windows
+    the exit code or tasklist, with backoff).
     """
-    print(f"[Restart Helper] Waiting {delay}s before restart...", file=sys.stderr)
-    time.sleep(delay)
-    
-    # 1. Kill the old process
-    print(f"[Restart Helper] Terminating PID: {pid}...", file=sys.stderr)
-    try:
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.fd = None
+        self.handle = None
+        self.method = "poll"
+        self.gone = False
+        if sys.platform == "win32":
+            self._open_handle()
+        elif hasattr(os, "pidfd_open"):
+            try:
+                self.fd = os.pidfd_open(pid)
+                self.method = "pidfd"
+            except ProcessLookupError:
+                self.gone = True
+            except OSError:
+                pass  # Kernel without pidfd support: poll
+
+    def _open_handle(self):
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(_SYNCHRONIZE, False, self.pid)
+        if handle:
+            self.handle = handle
+            self.method = "handle"
+        elif kernel32.GetLastError() == 87:  # ERROR_INVALID_PARAMETER: no such process
+            self.gone = True
+
+    def alive(self):
+        """Return True if the process still runs (a zombie counts as exited)."""
+        if self.gone:
+            return False
+        if self.method != "poll":
+            return not self.wait(0)
         if sys.platform == "win32":
-            subprocess.run(["taskkill", "/F", "/PID", str(pid)], check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return _windows_alive(self.pid)
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return not _is_zombie(self.pid)
+
+    def wait(self, timeout):
+        """Block until the process exits or `timeout` seconds pass; returns True if it exited."""
+        if self.gone:
+            return True
+        if self.method == "pidfd":
+            import select
+            poller = select.poll()
+            poller.register(self.fd, select.POLLIN)
+            exited = bool(poller.poll(max(0, int(timeout * 1000))))
+        elif self.method == "handle":
+            import ctypes
+            result = ctypes.windll.kernel32.WaitForSingleObject(self.handle, max(0, int(timeout * 1000)))
+            exited = result == _WAIT_OBJECT_0
         else:
-            os.kill(pid, 15) # SIGTERM
-    except Exception as e:
-        print(f"[Restart Helper] Failed to kill process {pid}: {e}", file=sys.stderr)
-        # Continue anyway, eager to start new one
-        
-    # 2. Start new instance
+            deadline = time.monotonic() + timeout
+            interval = POLL_MIN
+            while self.alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, POLL_MAX)
+            exited = True
+        self.gone = exited
+        return exited
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.handle is not None:
+            import ctypes
+            ctypes.windll.kernel32.CloseHandle(self.handle)
+            self.handle = None
+
+
+def _windows_alive(pid):
+    """Poll check for a process no waitable handle could be opened for (Windows)."""
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenProcess(_QUERY_LIMITED_INFORMATION, False, pid)
+    if handle:
+        try:
+            code = ctypes.c_ulong()
+            if kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return code.value == _STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    elif kernel32.GetLastError() == 87:  # ERROR_INVALID_PARAMETER: no such process
+        return False
+    # Access denied (e.g. an elevated CLI): ask tasklist, which lists every process
+    try:
+        listing = subprocess.run(["tasklist", "/FI", f"PID eq {pid}", "/FO", "CSV", "/NH"],
+                                 capture_output=True, text=True, timeout=5).stdout
+    except (OSError, subprocess.SubprocessError):
+        return True  # Cannot tell: assume it runs
+    return f'"{pid}"' in listing
+
+
+def _is_zombie(pid):
+    """True if a process has exited but was not reaped yet (Linux /proc only)."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            # State follows the parenthesised command name, which may contain spaces
+            return f.read().rsplit(b")", 1)[1].split()[0] == b"Z"
+    except (OSError, IndexError):
+        return False
+
+
+def terminate(watch, grace):
+    """
+    Terminate the watched process and wait for it to exit.
+    Returns how it ended: "gone" (already exited), "terminated", "killed" or "alive".
+    """
+    if not watch.alive():
+        return "gone"
+
+    print(f"[Restart Helper] Terminating PID: {watch.pid}...", file=sys.stderr)
+    if sys.platform == "win32":
+        subprocess.run(["taskkill", "/F", "/PID", str(watch.pid)], check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return "killed" if watch.wait(KILL_WAIT) else "alive"
+
+    import signal
+    try:
+        os.kill(watch.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return "gone"
+    if watch.wait(grace):
+        return "terminated"
+
+    print(f"[Restart Helper] PID {watch.pid} still running after {grace:g}s, sending SIGKILL", file=sys.stderr)
+    try:
+        os.kill(watch.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        return "terminated"
+    return "killed" if watch.wait(KILL_WAIT) else "alive"
+
+
+def start_gemini():
+    """Start a new Gemini CLI instance (new console window on Windows)."""
     print(f"[Restart Helper] Starting new Gemini CLI...", file=sys.stderr)
+    if sys.platform == "win32":
+        # Start in new window securely without shell=True concatenation
+        # Prepare environment
+        env = os.environ.copy()
+        env["GEMINI_FORCE_FILE_STORAGE"] = "true"
+
+        # Use cmd.exe /c start to open a new terminal window
+        subprocess.Popen(
+            ["cmd.exe", "/c", "start", "gemini"],
+            env=env,
+            close_fds=True
+        )
+    else:
+        # Linux/Mac (placeholder, mostly for Windows user)
+        subprocess.Popen(["gemini"], start_new_session=True)
+
+
+def report(stats):
+    """Print the measured restart latency and keep it for gchange (best effort)."""
+    print(f"[Restart Helper] Restart took {stats['total_ms']:.0f} ms "
+          f"(hook exit {stats['hook_wait_ms']:.0f} ms, shutdown {stats['shutdown_ms']:.0f} ms "
+          f"[{stats['shutdown']}, {stats['watch']}], launch {stats['launch_ms']:.0f} ms)", file=sys.stderr)
     try:
-        if sys.platform == "win32":
-            # Start in new window securely without shell=True concatenation
-            # Prepare environment
-            env = os.environ.copy()
-            env["GEMINI_FORCE_FILE_STORAGE"] = "true"
-            
-            # Use cmd.exe /c start to open a new terminal window
-            subprocess.Popen(
-                ["cmd.exe", "/c", "start", "gemini"], 
-                env=env,
-                close_fds=True
-            )
+        import state_store
+        state_store.put("last_restart", dict(stats, ts=time.time()))
+    except ImportError:
+        pass
+    try:
+        import hook_trace
+    except ImportError:
+        return
+    phases = {phase: stats[f"{phase}_ms"] for phase in ("hook_wait", "shutdown", "launch")}
+    hook_trace.record("restart", stats["total_ms"], phases, shutdown=stats["shutdown"], watch=stats["watch"])
+
+
+def restart_gemini(pid, delay=DEFAULT_DELAY, after_pid=None, grace=DEFAULT_GRACE):
+    """
+    1. Wait for the hook process `after_pid` to exit (at most `delay` seconds;
+       without after_pid, sleep `delay` seconds).
+    2. Terminate process `pid` (SIGKILL after `grace` seconds) and wait for it to exit.
+    3. Start new 'gemini' process in new window.
+    Returns the measured latencies in milliseconds.
+    """
+    started = time.monotonic()
+    # Open both watches first: the PIDs are pinned before anything can exit and be reused
+    target = ProcessWatch(pid)
+    hook = ProcessWatch(after_pid) if after_pid else None
+    stats = {"pid": pid, "watch": target.method}
+    try:
+        if hook:
+            print(f"[Restart Helper] Waiting for hook PID {after_pid} to exit (max {delay:g}s)...", file=sys.stderr)
+            hook.wait(delay)
         else:
-            # Linux/Mac (placeholder, mostly for Windows user)
-            subprocess.Popen(["gemini"], start_new_session=True)
-            
+            print(f"[Restart Helper] Waiting {delay}s before restart...", file=sys.stderr)
+            time.sleep(delay)
+        stopping = time.monotonic()
+        stats["hook_wait_ms"] = (stopping - started) * 1000
+
+        # 1. Kill the old process
+        try:
+            stats["shutdown"] = terminate(target, grace)
+        except Exception as e:
+            print(f"[Restart Helper] Failed to kill process {pid}: {e}", file=sys.stderr)
+            stats["shutdown"] = "error"
+            # Continue anyway, eager to start new one
+        launching = time.monotonic()
+        stats["shutdown_ms"] = (launching - stopping) * 1000
+    finally:
+        target.close()
+        if hook:
+            hook.close()
+
+    # 2. Start new instance
+    try:
+        start_gemini()
     except Exception as e:
         print(f"[Restart Helper] Failed to start new instance: {e}", file=sys.stderr)
+    finished = time.monotonic()
+    stats["launch_ms"] = (finished - launching) * 1000
+    stats["total_ms"] = (finished - started) * 1000
+
+    report(stats)
+    return stats
+
 
 def main():
     parser = argparse.ArgumentParser(description="Restart Gemini CLI helper")
     parser.add_argument("--pid", type=int, required=True, help="PID of the process to kill")
-    parser.add_argument("--delay", type=float, default=3.0, help="Delay in seconds before killing")
+    parser.add_argument("--after-pid", type=int, default=None,
+                        help="PID of the hook process; the restart starts as soon as it exits")
+    parser.add_argument("--delay", type=float, default=DEFAULT_DELAY,
+                        help="Max wait for --after-pid in seconds (fixed delay without it)")
+    parser.add_argument("--grace", type=float, default=DEFAULT_GRACE,
+                        help="Seconds between SIGTERM and SIGKILL")
     args = parser.parse_args()
-    
-    restart_gemini(args.pid, args.delay)
+
+    restart_gemini(args.pid, args.delay, after_pid=args.after_pid, grace=args.grace)
 
 if __name__ == "__main__":
     # Detach from parent if possible (on Windows/Unix differently)
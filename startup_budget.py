@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Startup-time budget check for the hook and CLI entry points.
+
+Runs each entry point under `python -X importtime` against a throwaway
+~/.gemini sandbox (HOME is redirected, your real profiles are untouched) and
+fails with exit code 1 when:
+  - a module the path must not need is imported (e.g. requests on a cache hit)
+  - the import time of the entry point exceeds its budget
+
+Usage:
+    python startup_budget.py              # Check with default budgets
+    python startup_budget.py --scale 2    # Loosen all time budgets (slow machines)
+    python startup_budget.py --runs 5     # Median of N runs (default 3)
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+SOURCE_DIR = Path(__file__).resolve().parent
+
+# name, argv, stdin, modules that must not be imported, import budget (ms)
+SCENARIOS = [
+    {
+        "name": "BeforeAgent (cache hit)",
+        "argv": ["quota_pre_check.py"],
+        "stdin": json.dumps({"session_id": "budget-check"}),
+        "forbidden": ["requests", "urllib3", "subprocess", "http.client"],
+        "budget_ms": 25,
+    },
+    {
+        "name": "AfterAgent (no quota error)",
+        "argv": ["quota_auto_switch.py"],
+        "stdin": json.dumps({"prompt_response": "All done."}),
+        "forbidden": ["requests", "urllib3", "subprocess", "http.client"],
+        "budget_ms": 25,
+    },
+    {
+        "name": "gchange next",
+        "argv": ["gemini_cli_auth_manager.py", "next", "sequential"],
+        "stdin": "",
+        "forbidden": ["requests", "urllib3", "webbrowser", "http.server", "subprocess"],
+        "budget_ms": 30,
+    },
+]
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def build_sandbox(root):
+    """Create a minimal ~/.gemini with two accounts and a fresh quota cache."""
+    gemini_dir = Path(root) / ".gemini"
+    accounts = ["alpha@example.com", "beta@example.com"]
+    creds = {"access_token": "budget-check", "refresh_token": "x", "expiry_date": 0}
+
+    for account in accounts:
+        profile = gemini_dir / "auth_profiles" / account
+        profile.mkdir(parents=True)
+        (profile / "oauth_creds.json").write_text(json.dumps(creds), encoding="utf-8")
+        (profile / "quota_cache.json").write_text(json.dumps({
+            "timestamp": datetime.now().isoformat(),
+            "account": account,
+            "buckets": [{"modelId": "gemini-3-pro-preview", "remainingFraction": 0.9}],
+            "cache_minutes": 60,
+        }), encoding="utf-8")
+
+    (gemini_dir / "oauth_creds.json").write_text(json.dumps(creds), encoding="utf-8")
+    (gemini_dir / "google_accounts.json").write_text(
+        json.dumps({"active": accounts[0], "old": []}), encoding="utf-8")
+    (gemini_dir / "auth_config.json").write_text(json.dumps({
+        "language": "en",
+        "auto_switch": {"enabled": True, "strategy": "gemini3-first", "threshold": 5, "cache_minutes": 60},
+    }), encoding="utf-8")
+
+
+def parse_importtime(stderr):
+    """Return ({top_level_module: cumulative_us}, {all imported module names})."""
+    top_level = {}
+    imported = set()
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)), match.group(3), match.group(4)
+        imported.add(name)
+        if len(indent) == 1:
+            top_level[name] = top_level.get(name, 0) + cumulative
+    return top_level, imported
+
+
+def run_importtime(argv, stdin, env):
+    """Run a command under -X importtime; returns (returncode, top_level, imported)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + argv,
+        input=stdin, capture_output=True, text=True, cwd=str(SOURCE_DIR), env=env,
+    )
+    top_level, imported = parse_importtime(proc.stderr)
+    return proc.returncode, top_level, imported
+
+
+def check(runs=3, scale=1.0):
+    """Run all scenarios; returns True if every budget holds."""
+    ok = True
+    with tempfile.TemporaryDirectory(prefix="gchange-budget-") as home:
+        build_sandbox(home)
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+
+        # Modules imported by the bare interpreter are not charged to the entry points
+        _, baseline, _ = run_importtime(["-c", "pass"], "", env)
+
+        print(f"{'Scenario':<30} {'Import ms':>10} {'Budget':>8}  Result")
+        print("-" * 64)
+        for scenario in SCENARIOS:
+            argv = [str(SOURCE_DIR / scenario["argv"][0])] + scenario["argv"][1:]
+            run_importtime(argv, scenario["stdin"], env)  # Warm-up (writes .pyc)
+
+            samples = []
+            imported = set()
+            failures = []
+            for _ in range(runs):
+                returncode, top_level, run_imported = run_importtime(argv, scenario["stdin"], env)
+                if returncode != 0:
+                    failures.append(f"exit code {returncode}")
+                imported |= run_imported
+                samples.append(sum(us for name, us in top_level.items() if name not in baseline) / 1000)
+
+            samples.sort()
+            median_ms = samples[len(samples) // 2]
+            budget_ms = scenario["budget_ms"] * scale
+
+            leaked = [m for m in scenario["forbidden"] if m in imported]
+            if leaked:
+                failures.append(f"imports {', '.join(leaked)}")
+            if median_ms > budget_ms:
+                failures.append("over budget")
+
+            result = "OK" if not failures else "FAIL (" + "; ".join(sorted(set(failures))) + ")"
+            print(f"{scenario['name']:<30} {median_ms:>10.1f} {budget_ms:>8.0f}  {result}")
+            ok = ok and not failures
+    return ok
+
+
+def main():
+    args = sys.argv[1:]
+    runs, scale = 3, 1.0
+    try:
+        if "--runs" in args:
+            runs = max(1, int(args[args.index("--runs") + 1]))
+        if "--scale" in args:
+            scale = float(args[args.index("--scale") + 1])
+    except (IndexError, ValueError):
+        print(__doc__)
+        sys.exit(2)
+
+    sys.exit(0 if check(runs=runs, scale=scale) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+"""
+Transactional state store for Gemini CLI Auth Manager.
+
+All mutable state that used to live in scattered files is kept in one SQLite
+database in WAL mode (~/.gemini/auth_state.db):
+
+    kv               # Hook state: AfterAgent retry count, last quota error
+    quota_snapshots  # retrieveUserQuota buckets per account
+    quota_samples    # Time series of remainingFraction per account and model
+    exhaustion       # Exhaustion calendar: when each exhausted account/model bucket resets
+    project_info     # loadCodeAssist project + tier per account
+    profiles         # Sorted index of auth_profiles/ (see profile_cache.refresh_profile_index)
+    leases           # Cross-process single-flight locks (e.g. quota refresh)
+
+WAL lets concurrent CLI sessions read while one of them writes, and every
+write is a short transaction, so parallel hooks can no longer leave half
+written or clobbered state behind. The connection is opened once per process
+(and thread) and reused: a hook costs one open plus a few primary-key lookups.
+
+Files that other programs read or users edit stay where they are:
+google_accounts.json and oauth_creds.json (read by Gemini CLI itself) and
+auth_config.json (user configuration).
+
+Reads never raise: a locked or unreadable database behaves like an empty one.
+Writes return False on failure.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# --- Configuration Paths ---
+GEMINI_DIR = Path(os.path.expanduser("~/.gemini"))
+DB_FILE = GEMINI_DIR / "auth_state.db"
+PROFILES_DIR = GEMINI_DIR / "auth_profiles"
+
+# Files imported once when the database is created
+LEGACY_RETRY_FILE = GEMINI_DIR / ".auto_switch_retry_count"
+LEGACY_ERROR_STATE_FILE = GEMINI_DIR / ".last_quota_error"
+LEGACY_QUOTA_CACHE_FILE = GEMINI_DIR / "quota_cache.json"
+LEGACY_QUOTA_CACHE_NAME = "quota_cache.json"
+LEGACY_PROJECT_CACHE_NAME = "code_assist.json"
+
+SCHEMA_VERSION = 5
+SAMPLE_RETENTION_HOURS = 24  # Burn-rate history kept per account
+BUSY_TIMEOUT = 2.0  # Seconds to wait for another session's write to finish
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS kv (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS quota_snapshots (
+        account TEXT PRIMARY KEY,
+        timestamp TEXT NOT NULL,
+        buckets TEXT NOT NULL,
+        cache_minutes REAL
+    )""",
+    """CREATE TABLE IF NOT EXISTS project_info (
+        account TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        tier_id TEXT,
+        tier_name TEXT,
+        timestamp TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS quota_samples (
+        account TEXT NOT NULL,
+        model TEXT NOT NULL,
+        ts REAL NOT NULL,
+        fraction REAL NOT NULL,
+        PRIMARY KEY (account, model, ts)
+    )""",
+    """CREATE TABLE IF NOT EXISTS exhaustion (
+        account TEXT NOT NULL,
+        model TEXT NOT NULL,
+        reset_at REAL NOT NULL,
+        fraction REAL NOT NULL,
+        PRIMARY KEY (account, model)
+    )""",
+    "CREATE INDEX IF NOT EXISTS exhaustion_reset_at ON exhaustion (reset_at)",
+    """CREATE TABLE IF NOT EXISTS profiles (
+        position INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    )""",
+]
+
+# Snapshots of an unknown account (no google_accounts.json yet) use this key
+UNKNOWN_ACCOUNT = ""
+
+# One connection per process and thread (sqlite3 connections must not cross either)
+_local = threading.local()
+
+
+def _connect():
+    """Return this thread's connection, creating and migrating the database on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    GEMINI_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(DB_FILE), timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        with transaction(conn):
+            # Re-check under the write lock: another session may have migrated already
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                if version == 0:
+                    _import_legacy_files(conn)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+@contextmanager
+def transaction(conn=None):
+    """
+    Run a block as one write transaction (BEGIN IMMEDIATE), e.g. for
+    read-modify-write sequences. Yields the connection.
+    """
+    conn = conn or _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _read_legacy_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _import_legacy_files(conn):
+    """Carry state over from the per-file layout (files are left in place)."""
+    try:
+        retry_count = int(LEGACY_RETRY_FILE.read_text().strip())
+        _put(conn, "retry_count", retry_count)
+    except (OSError, ValueError):
+        pass
+
+    error_state = _read_legacy_json(LEGACY_ERROR_STATE_FILE)
+    if isinstance(error_state, dict):
+        _put(conn, "last_quota_error", error_state)
+
+    caches = [(UNKNOWN_ACCOUNT, LEGACY_QUOTA_CACHE_FILE)]
+    if PROFILES_DIR.exists():
+        for profile in PROFILES_DIR.iterdir():
+            if profile.is_dir():
+                caches.append((profile.name, profile / LEGACY_QUOTA_CACHE_NAME))
+                info = _read_legacy_json(profile / LEGACY_PROJECT_CACHE_NAME)
+                if isinstance(info, dict) and info.get("project"):
+                    tier = info.get("tier") or {}
+                    _put_project(conn, profile.name, info["project"], tier.get("id"),
+                                 tier.get("name"), info.get("timestamp", ""))
+
+    for account, path in caches:
+        cache = _read_legacy_json(path)
+        if isinstance(cache, dict) and cache.get("timestamp"):
+            _put_snapshot(conn, account, cache["timestamp"], cache.get("buckets", []),
+                          cache.get("cache_minutes"))
+
+
+# --- Key/value hook state ---
+def _put(conn, key, value):
+    conn.execute(
+        "INSERT OR REPLACE INTO kv (key, value, updated) VALUES (?, ?, ?)",
+        (key, json.dumps(value), time.time()),
+    )
+
+
+def get(key, default=None):
+    """Return the JSON value stored under key, or default."""
+    try:
+        row = _connect().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+    except (sqlite3.Error, OSError, ValueError):
+        return default
+
+
+def put(key, value):
+    """Store a JSON-serializable value under key."""
+    try:
+        _put(_connect(), key, value)
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def update(key, function):
+    """
+    Read-modify-write the value under key in one write transaction (BEGIN
+    IMMEDIATE), so concurrent sessions cannot lose each other's updates.
+    function gets the current value (None if missing) and returns the new
+    one, which is stored and returned. If the store is unavailable, function
+    is applied to None and nothing is stored.
+    """
+    try:
+        with transaction() as conn:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            try:
+                value = json.loads(row[0]) if row else None
+            except ValueError:
+                value = None
+            value = function(value)
+            _put(conn, key, value)
+        return value
+    except (sqlite3.Error, OSError):
+        return function(None)
+
+
+def delete(key):
+    """Remove key (no-op if missing)."""
+    try:
+        _connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+# --- Quota snapshots ---
+def _put_snapshot(conn, account, timestamp, buckets, cache_minutes):
+    conn.execute(
+        "INSERT OR REPLACE INTO quota_snapshots (account, timestamp, buckets, cache_minutes) "
+        "VALUES (?, ?, ?, ?)",
+        (account or UNKNOWN_ACCOUNT, timestamp, json.dumps(buckets), cache_minutes),
+    )
+
+
+def get_quota_snapshot(account):
+    """Return {timestamp, account, buckets, cache_minutes} for an account, or None."""
+    try:
+        row = _connect().execute(
+            "SELECT timestamp, buckets, cache_minutes FROM quota_snapshots WHERE account = ?",
+            (account or UNKNOWN_ACCOUNT,),
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "timestamp": row[0],
+            "account": account,
+            "buckets": json.loads(row[1]),
+            "cache_minutes": row[2],
+        }
+    except (sqlite3.Error, OSError, ValueError):
+        return None
+
+
+def put_quota_snapshot(account, timestamp, buckets, cache_minutes):
+    """
+    Store the quota snapshot of an account and append its buckets to the
+    account's sample history (entries older than SAMPLE_RETENTION_HOURS are pruned).
+    The account's exhaustion calendar entries are dropped.
+    """
+    now = time.time()
+    samples = [
+        (account, b["modelId"], now, float(b["remainingFraction"]))
+        for b in buckets
+        if b.get("modelId") and b.get("remainingFraction") is not None
+    ]
+    try:
+        with transaction() as conn:
+            _put_snapshot(conn, account, timestamp, buckets, cache_minutes)
+            # Fresh data supersedes the account's calendar entries (re-derived on next ranking)
+            conn.execute("DELETE FROM exhaustion WHERE account = ?", (account or UNKNOWN_ACCOUNT,))
+            if account and samples:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO quota_samples (account, model, ts, fraction) VALUES (?, ?, ?, ?)",
+                    samples,
+                )
+                conn.execute(
+                    "DELETE FROM quota_samples WHERE account = ? AND ts < ?",
+                    (account, now - SAMPLE_RETENTION_HOURS * 3600),
+                )
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def get_quota_samples(account, model, since=0.0):
+    """Return [(ts, fraction)] of an account's model bucket since a Unix time, oldest first."""
+    try:
+        return _connect().execute(
+            "SELECT ts, fraction FROM quota_samples WHERE account = ? AND model = ? AND ts >= ? ORDER BY ts",
+            (account, model, since),
+        ).fetchall()
+    except (sqlite3.Error, OSError):
+        return []
+
+
+# --- Exhaustion calendar ---
+def get_exhaustion_entries():
+    """Return all calendar entries as [(reset_at, account, model, fraction)], soonest first."""
+    try:
+        return _connect().execute(
+            "SELECT reset_at, account, model, fraction FROM exhaustion ORDER BY reset_at"
+        ).fetchall()
+    except (sqlite3.Error, OSError):
+        return []
+
+
+def put_exhaustion(account, entries):
+    """Replace the calendar entries of an account with [(model, reset_at, fraction)]."""
+    try:
+        with transaction() as conn:
+            conn.execute("DELETE FROM exhaustion WHERE account = ?", (account,))
+            conn.executemany(
+                "INSERT INTO exhaustion (account, model, reset_at, fraction) VALUES (?, ?, ?, ?)",
+                [(account, model, reset_at, fraction) for model, reset_at, fraction in entries],
+            )
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def delete_exhaustion(accounts=None):
+    """Drop the calendar entries of the given accounts (all entries if None)."""
+    try:
+        conn = _connect()
+        if accounts is None:
+            conn.execute("DELETE FROM exhaustion")
+        else:
+            conn.executemany("DELETE FROM exhaustion WHERE account = ?", [(a,) for a in accounts])
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+# --- Code Assist project per account ---
+def _put_project(conn, account, project, tier_id, tier_name, timestamp):
+    conn.execute(
+        "INSERT OR REPLACE INTO project_info (account, project, tier_id, tier_name, timestamp) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (account, project, tier_id, tier_name, timestamp),
+    )
+
+
+def get_project_info(account):
+    """Return {project, tier: {id, name}, timestamp} for an account, or None."""
+    try:
+        row = _connect().execute(
+            "SELECT project, tier_id, tier_name, timestamp FROM project_info WHERE account = ?",
+            (account,),
+        ).fetchone()
+    except (sqlite3.Error, OSError):
+        return None
+    if not row:
+        return None
+    return {
+        "project": row[0],
+        "tier": {"id": row[1] or "unknown", "name": row[2] or "unknown"},
+        "timestamp": row[3],
+    }
+
+
+def put_project_info(account, project, tier_id, tier_name, timestamp):
+    """Store the Code Assist project (and tier) of an account."""
+    try:
+        _put_project(_connect(), account, project, tier_id, tier_name, timestamp)
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def delete_project_info(account):
+    """Drop the cached project of an account."""
+    try:
+        _connect().execute("DELETE FROM project_info WHERE account = ?", (account,))
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def forget_account(account):
+    """Remove everything stored for an account (used when it leaves the pool)."""
+    try:
+        with transaction() as conn:
+            conn.execute("DELETE FROM quota_snapshots WHERE account = ?", (account,))
+            conn.execute("DELETE FROM project_info WHERE account = ?", (account,))
+            conn.execute("DELETE FROM quota_samples WHERE account = ?", (account,))
+            conn.execute("DELETE FROM exhaustion WHERE account = ?", (account,))
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+# --- Profile index ---
+PROFILE_INDEX_KEY = "profile_index"  # kv entry: {"stamp": ...} of the indexed auth_profiles/
+
+
+def get_profile_index_stamp():
+    """Return the directory stamp the profile index was built from, or None if never built."""
+    entry = get(PROFILE_INDEX_KEY)
+    return entry.get("stamp") if isinstance(entry, dict) else None
+
+
+def replace_profiles(names, stamp):
+    """Replace the profile index with `names` (sorted) built from a directory with `stamp`."""
+    try:
+        with transaction() as conn:
+            conn.execute("DELETE FROM profiles")
+            conn.executemany("INSERT INTO profiles (position, name) VALUES (?, ?)", enumerate(names))
+            _put(conn, PROFILE_INDEX_KEY, {"stamp": stamp})
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def get_profiles():
+    """Return all indexed profile names in order."""
+    try:
+        return [row[0] for row in _connect().execute("SELECT name FROM profiles ORDER BY position")]
+    except (sqlite3.Error, OSError):
+        return []
+
+
+def get_profile_count():
+    """Return the number of indexed profiles."""
+    try:
+        return _connect().execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+    except (sqlite3.Error, OSError):
+        return 0
+
+
+def get_profile_at(position):
+    """Return the profile name at a 0-based position, or None."""
+    try:
+        row = _connect().execute("SELECT name FROM profiles WHERE position = ?", (position,)).fetchone()
+        return row[0] if row else None
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def get_profile_position(name):
+    """Return the 0-based position of a profile, or None if not indexed."""
+    try:
+        row = _connect().execute("SELECT position FROM profiles WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def find_profiles(prefix="", contains="", limit=None):
+    """
+    Return indexed names starting with `prefix` (range scan on the name index)
+    and containing `contains`, in order.
+    """
+    query = "SELECT name FROM profiles WHERE name >= ? AND name < ?"
+    # U+10FFFF sorts after every character that can follow the prefix
+    params = [prefix, prefix + "\U0010ffff"]
+    if contains:
+        query += " AND instr(name, ?) > 0"
+        params.append(contains)
+    query += " ORDER BY position"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    try:
+        return [row[0] for row in _connect().execute(query, params)]
+    except (sqlite3.Error, OSError):
+        return []
+
+
+# --- Leases ---
+def _lease_owner():
+    return f"{os.getpid()}:{threading.get_ident()}"
+
+
+def acquire_lease(name, ttl, owner=None):
+    """
+    Try to take the lease `name` for ttl seconds.
+    Returns True if `owner` (default: this process and thread) now holds it,
+    False if another holder's lease is still valid, and None if the store is
+    unavailable (callers then go ahead without the lease: nobody else can
+    hold it either). Expired leases are taken over, so a crashed holder
+    blocks others for at most ttl seconds.
+    An explicit owner token lets the lease be handed to another process.
+    """
+    owner = owner or _lease_owner()
+    now = time.time()
+    try:
+        with transaction() as conn:
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[1] > now and row[0] != owner:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, owner, now + ttl),
+            )
+        return True
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def release_lease(name, owner=None):
+    """Release a lease held by `owner` (default: this process and thread; no-op otherwise)."""
+    try:
+        _connect().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner or _lease_owner()))
+        return True
+    except (sqlite3.Error, OSError):
+        return False
@@ -0,0 +1,57 @@
+"""
+Shared fixtures. Every module resolves ~/.gemini when it is imported, so HOME
+points at a scratch directory before any of them is loaded, and each test
+starts from an empty ~/.gemini.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+_HOME = tempfile.mkdtemp(prefix="gchange-tests-")
+os.environ["HOME"] = _HOME
+os.environ["USERPROFILE"] = _HOME
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+
+import config_snapshot
+import hook_trace
+import profile_cache
+import state_store
+
+
+def _reset_caches():
+    conn = getattr(state_store._local, "conn", None)
+    if conn is not None:
+        conn.close()
+        state_store._local.conn = None
+    profile_cache._memo.clear()
+    config_snapshot._memo.update(stamp=None, snapshot=None)
+
+
+@pytest.fixture(autouse=True)
+def gemini_dir(monkeypatch):
+    """An empty ~/.gemini for every test (tracing off)."""
+    monkeypatch.delenv(hook_trace.ENV_VAR, raising=False)
+    _reset_caches()
+    shutil.rmtree(state_store.GEMINI_DIR, ignore_errors=True)
+    state_store.GEMINI_DIR.mkdir(parents=True)
+    yield state_store.GEMINI_DIR
+    _reset_caches()
+
+
+@pytest.fixture
+def add_profile(gemini_dir):
+    """Create auth_profiles/<account> with the given credentials; returns its oauth_creds.json."""
+    def add(account, **creds):
+        profile = gemini_dir / "auth_profiles" / account
+        profile.mkdir(parents=True)
+        creds_file = profile / "oauth_creds.json"
+        creds.setdefault("access_token", f"token-{account}")
+        creds.setdefault("refresh_token", f"refresh-{account}")
+        creds_file.write_text(json.dumps(creds), encoding="utf-8")
+        return creds_file
+    return add
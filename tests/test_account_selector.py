@@ -0,0 +1,148 @@
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import account_selector
+import config_snapshot
+import profile_cache
+import state_store
+
+MODEL = "gemini-3-pro-preview"
+NOW = datetime(2026, 10, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _auto_switch(**overrides):
+    return config_snapshot.build({"auto_switch": overrides})["auto_switch"]
+
+
+def _snapshot(account, fraction, reset_in_hours=None):
+    bucket = {"modelId": MODEL, "remainingFraction": fraction}
+    if reset_in_hours is not None:
+        reset_at = NOW + timedelta(hours=reset_in_hours)
+        bucket["resetTime"] = reset_at.isoformat().replace("+00:00", "Z")
+    profile_cache.save_quota_snapshot(account, [bucket, {"modelId": "other-model", "remainingFraction": 1.0}])
+
+
+def _samples(account, points, model=MODEL):
+    conn = state_store._connect()
+    conn.executemany(
+        "INSERT INTO quota_samples (account, model, ts, fraction) VALUES (?, ?, ?, ?)",
+        [(account, model, ts, fraction) for ts, fraction in points],
+    )
+
+
+# --- rank_accounts ---
+def test_rank_accounts_orders_by_score_then_unknown():
+    _snapshot("b", 0.5)
+    _snapshot("c", 0.9)
+    _snapshot("e", 0.01, reset_in_hours=2)
+    _snapshot("f", 0.02, reset_in_hours=1)
+    _snapshot("g", 0.0, reset_in_hours=-1)  # Reset has passed: counts as full
+
+    candidates, exhausted = account_selector.rank_accounts(
+        ["a", "b", "c", "d", "e", "f", "g"], "a", _auto_switch(), now=NOW)
+    assert candidates == [("g", 1.0), ("c", 0.9), ("b", 0.5), ("d", None)]
+    assert [(account, score) for account, score, _ in exhausted] == [("f", 0.02), ("e", 0.01)]
+    assert exhausted[0][2] == NOW + timedelta(hours=1)
+
+
+def test_rank_accounts_starts_after_the_current_account():
+    for account in "abcd":
+        _snapshot(account, 0.5)
+    candidates, _ = account_selector.rank_accounts(list("abcd"), "c", _auto_switch(), now=NOW)
+    assert [account for account, _ in candidates] == ["d", "a", "b"]
+
+
+def test_exhausted_accounts_stay_blocked_until_their_reset():
+    _snapshot("e", 0.01, reset_in_hours=2)
+    account_selector.rank_accounts(["a", "e"], "a", _auto_switch(), now=NOW)
+    assert [entry[1] for entry in state_store.get_exhaustion_entries()] == ["e"]
+
+    # Blocked: its (now healthy looking) snapshot is not even read
+    state_store._connect().execute("UPDATE quota_snapshots SET buckets = '[]' WHERE account = 'e'")
+    _, exhausted = account_selector.rank_accounts(["a", "e"], "a", _auto_switch(), now=NOW + timedelta(hours=1))
+    assert [account for account, _, _ in exhausted] == ["e"]
+
+    candidates, exhausted = account_selector.rank_accounts(
+        ["a", "e"], "a", _auto_switch(), now=NOW + timedelta(hours=3))
+    assert candidates == [("e", None)] and exhausted == []
+    assert state_store.get_exhaustion_entries() == []
+
+
+def test_pattern_fallback_to_models_to_check():
+    profile_cache.save_quota_snapshot("b", [{"modelId": "gemini-2.5-pro", "remainingFraction": 0.4}])
+    auto_switch = _auto_switch(model_pattern="no-such-model.*")
+    candidates, _ = account_selector.rank_accounts(["a", "b"], "a", auto_switch, now=NOW)
+    assert candidates == [("b", 0.4)]
+
+
+# --- burn_rate ---
+def test_burn_rate_is_the_fitted_drain_per_minute():
+    t0 = NOW.timestamp() - 1800
+    _samples("a", [(t0, 0.9), (t0 + 600, 0.8), (t0 + 1200, 0.7)])
+    assert account_selector.burn_rate("a", MODEL, now=NOW.timestamp()) == pytest.approx(0.01)
+
+
+def test_burn_rate_only_uses_samples_since_the_last_refill():
+    t0 = NOW.timestamp() - 1800
+    _samples("a", [(t0, 0.2), (t0 + 300, 0.1), (t0 + 600, 1.0), (t0 + 1200, 0.94)])
+    assert account_selector.burn_rate("a", MODEL, now=NOW.timestamp()) == pytest.approx(0.006)
+
+
+@pytest.mark.parametrize("points, expected", [
+    ([], None),
+    ([(-600, 0.5)], None),
+    ([(-30, 0.5), (-1, 0.4)], None),                       # Less than BURN_RATE_MIN_SPAN_SECONDS
+    ([(-7200, 0.9), (-1, 0.4)], None),                     # Old sample outside the window
+    ([(-1200, 0.5), (-600, 0.5), (-1, 0.5)], 0.0),         # Not draining
+])
+def test_burn_rate_without_a_usable_trend(points, expected):
+    now = NOW.timestamp()
+    _samples("a", [(now + offset, fraction) for offset, fraction in points])
+    assert account_selector.burn_rate("a", MODEL, now=now) == expected
+
+
+# --- pick_balanced ---
+def test_balance_weight_prefers_headroom_that_resets_soon():
+    weights, _ = account_selector.balance_weights(["a", "b", "c"], _auto_switch(), now=NOW)
+    assert weights["a"] == weights["b"] == weights["c"]  # No cached quota: treated as full
+
+    _snapshot("a", 0.55, reset_in_hours=2)
+    _snapshot("b", 0.55)
+    _snapshot("c", 0.03, reset_in_hours=2)
+    weights, exhausted = account_selector.balance_weights(["a", "b", "c"], _auto_switch(), now=NOW)
+    assert weights == {"a": pytest.approx(0.5 / 2), "b": pytest.approx(0.5 / 24)}
+    assert [account for account, _, _ in exhausted] == ["c"]
+
+
+def test_smooth_picks_follow_the_weights():
+    _snapshot("a", 0.85)
+    _snapshot("b", 0.45)
+    _snapshot("c", 0.45)
+    picks = [account_selector.pick_balanced(["a", "b", "c"], _auto_switch(), now=NOW)[0] for _ in range(40)]
+    assert Counter(picks) == {"a": 20, "b": 10, "c": 10}
+    assert picks[:4] == ["a", "b", "c", "a"]  # Interleaved, not a burst of "a"
+    assert state_store.get(account_selector.BALANCE_STATE_KEY)["current"].keys() == {"a", "b", "c"}
+
+
+def test_pick_balanced_excludes_and_reports_exhaustion():
+    _snapshot("a", 0.9)
+    _snapshot("b", 0.01, reset_in_hours=1)
+    account, weight, exhausted = account_selector.pick_balanced(["a", "b"], _auto_switch(), exclude="b", now=NOW)
+    assert account == "a" and weight > 0
+    assert [entry[0] for entry in exhausted] == ["b"]
+
+    account, weight, _ = account_selector.pick_balanced(["a", "b"], _auto_switch(), exclude="a", now=NOW)
+    assert account is None and weight is None
+
+
+def test_random_picks_are_weighted():
+    _snapshot("a", 0.85)
+    _snapshot("b", 0.45)
+    auto_switch = _auto_switch(balance_algorithm="random")
+    rng = random.Random(7)
+    picks = Counter(account_selector.pick_balanced(["a", "b"], auto_switch, now=NOW, rng=rng)[0] for _ in range(3000))
+    assert picks["a"] / 3000 == pytest.approx(2 / 3, abs=0.05)
+    assert state_store.get(account_selector.BALANCE_STATE_KEY) is None  # Stateless
@@ -0,0 +1,121 @@
+import http.client
+import json
+import signal
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+import auth_proxy
+import auth_switch
+import profile_cache
+
+
+@pytest.fixture
+def upstream():
+    """A local Code Assist stand-in; yields (base URL, list of the requests it received)."""
+    seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            seen.append({"path": self.path, "auth": self.headers.get("Authorization"), "body": json.loads(body)})
+            payload = b'{"ok": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", seen
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def proxy(upstream, monkeypatch):
+    """The auth proxy serving on a free port (in a thread); yields (port, secret path prefix)."""
+    monkeypatch.setattr(signal, "signal", lambda signum, handler: None)  # Main thread only
+    thread = threading.Thread(target=auth_proxy.serve, kwargs={"port": 0, "upstream": upstream[0]}, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not auth_proxy.status():
+        assert time.monotonic() < deadline, "auth proxy did not start"
+        time.sleep(0.05)
+    state = auth_proxy.load_state()
+    yield state["port"], urlparse(state["url"]).path
+    auth_proxy.stop_proxy()
+    thread.join(5)
+
+
+def _post(port, path, payload, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("POST", path, json.dumps(payload), dict({"Authorization": "Bearer cli-token"}, **(headers or {})))
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def _raw_status(port, head):
+    """Send only a request head (no body) and return the response status code."""
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(head.encode("ascii"))
+        return int(sock.makefile("rb").readline().split()[1])
+
+
+def test_requests_follow_the_active_account(proxy, upstream, add_profile):
+    port, prefix = proxy
+    _, seen = upstream
+    for account in ("a@example.com", "b@example.com"):
+        add_profile(account)
+        profile_cache.save_project_info(account, f"project-{account[0]}")
+
+    auth_switch.switch_to("a@example.com")
+    status, _ = _post(port, f"{prefix}/v1internal:generateContent", {"project": "cli-project", "request": {}})
+    assert status == 200
+    assert seen[-1] == {"path": "/v1internal:generateContent", "auth": "Bearer token-a@example.com",
+                        "body": {"project": "project-a", "request": {}}}
+
+    # The next request after a switch goes out with the new account, no restart
+    auth_switch.switch_to("b@example.com")
+    _post(port, f"{prefix}/v1internal:generateContent", {"project": "cli-project", "request": {}})
+    assert seen[-1]["auth"] == "Bearer token-b@example.com"
+    assert seen[-1]["body"]["project"] == "project-b"
+
+    status, _ = _post(port, f"{prefix}/__gchange/status", {})
+    assert status == 404  # Control paths only answer their own method
+    assert auth_proxy.status()["account"] == "b@example.com"
+
+
+def test_request_without_authorization_is_not_signed(proxy, upstream, add_profile):
+    port, prefix = proxy
+    add_profile("a@example.com")
+    auth_switch.switch_to("a@example.com")
+    status, reply = _post(port, f"{prefix}/v1internal:generateContent", {}, headers={"Authorization": ""})
+    assert status == 401 and "Authorization" in reply["error"]["message"]
+    assert upstream[1] == []
+
+
+@pytest.mark.parametrize("host, path, length, expected", [
+    ("evil.example:8790", "{prefix}/v1internal:generateContent", 10 ** 9, 403),
+    ("127.0.0.1", "/v1internal:generateContent", 10 ** 9, 404),
+    ("127.0.0.1", "/not-the-secret{prefix}", 10 ** 9, 404),
+    ("localhost", "{prefix}/v1internal:generateContent", auth_proxy.MAX_BODY_SIZE + 1, 413),
+])
+def test_rejected_before_the_body_is_read(proxy, upstream, host, path, length, expected):
+    # The body is never sent: reading it first would block until the socket timeout
+    port, prefix = proxy
+    head = (f"POST {path.format(prefix=prefix)} HTTP/1.1\r\nHost: {host}\r\n"
+            f"Authorization: Bearer cli-token\r\nContent-Length: {length}\r\n\r\n")
+    assert _raw_status(port, head) == expected
+    assert upstream[1] == []
@@ -0,0 +1,157 @@
+import base64
+import json
+import os
+import sys
+
+import pytest
+
+import auth_switch
+import config_snapshot
+import profile_cache
+import state_store
+
+
+def _id_token(email):
+    payload = base64.urlsafe_b64encode(json.dumps({"email": email}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+AUTO_SWITCH = config_snapshot.build(None)["auto_switch"]
+
+
+def _profile_creds(account):
+    return json.loads((auth_switch.PROFILES_DIR / account / "oauth_creds.json").read_text())
+
+
+def _live_creds():
+    return json.loads(auth_switch.CREDS_FILE.read_text())
+
+
+@pytest.fixture
+def pool(add_profile):
+    add_profile("a@example.com")
+    add_profile("b@example.com")
+    result = auth_switch.switch_to("a@example.com", switch_mode="copy")
+    assert result["ok"] and result["switched"]
+    return result
+
+
+def test_install_records_the_live_file_hash(pool):
+    installed = state_store.get(auth_switch.INSTALLED_KEY)
+    assert installed["account"] == "a@example.com"
+    assert installed["sha256"] == auth_switch._digest(auth_switch.CREDS_FILE.read_bytes())
+    assert _live_creds()["access_token"] == "token-a@example.com"
+    assert json.loads(auth_switch.ACCOUNTS_JSON.read_text())["active"] == "a@example.com"
+
+
+def test_unchanged_credentials_are_not_written_back(pool):
+    profile_file = auth_switch.PROFILES_DIR / "a@example.com" / "oauth_creds.json"
+    before = profile_file.stat().st_mtime_ns
+    result = auth_switch.switch_to("b@example.com", switch_mode="copy")
+    assert result["ok"] and result["previous"] == "a@example.com"
+    assert result["written_back"] is False
+    assert profile_file.stat().st_mtime_ns == before
+    assert _live_creds()["access_token"] == "token-b@example.com"
+
+
+def test_refreshed_credentials_are_written_back(pool):
+    refreshed = dict(_live_creds(), access_token="refreshed-by-cli")
+    auth_switch.CREDS_FILE.write_text(json.dumps(refreshed))
+    result = auth_switch.switch_to("b@example.com", switch_mode="copy")
+    assert result["written_back"] is True
+    assert _profile_creds("a@example.com")["access_token"] == "refreshed-by-cli"
+
+    # Switching back installs the saved copy
+    auth_switch.switch_to("a@example.com", switch_mode="copy")
+    assert _live_creds()["access_token"] == "refreshed-by-cli"
+
+
+@pytest.mark.parametrize("other_login", [
+    {"access_token": "x", "refresh_token": "refresh-of-someone-else"},
+    {"access_token": "x", "refresh_token": "refresh-a@example.com", "id_token": _id_token("other@example.com")},
+])
+def test_credentials_of_another_login_are_not_written_back(pool, other_login):
+    auth_switch.CREDS_FILE.write_text(json.dumps(other_login))
+    result = auth_switch.switch_to("b@example.com", switch_mode="copy")
+    assert result["ok"] and result["written_back"] is False
+    assert any("another login" in w for w in result["warnings"])
+    assert _profile_creds("a@example.com")["access_token"] == "token-a@example.com"
+
+
+def test_same_login_by_id_token_email(pool):
+    refreshed = dict(_live_creds(), access_token="new", refresh_token="rotated",
+                     id_token=_id_token("A@example.com"))
+    auth_switch.CREDS_FILE.write_text(json.dumps(refreshed))
+    assert auth_switch.switch_to("b@example.com", switch_mode="copy")["written_back"] is True
+    assert _profile_creds("a@example.com")["refresh_token"] == "rotated"
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="file modes")
+def test_installed_file_keeps_the_profile_mode(add_profile):
+    os.chmod(add_profile("a@example.com"), 0o600)
+    auth_switch.switch_to("a@example.com", switch_mode="copy")
+    assert auth_switch.CREDS_FILE.stat().st_mode & 0o777 == 0o600
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="symlinks need privileges")
+def test_symlink_mode_never_copies_back(pool):
+    result = auth_switch.switch_to("b@example.com", switch_mode="symlink")
+    assert result["ok"] and auth_switch.CREDS_FILE.is_symlink()
+    # The CLI refreshes through the link, straight into the profile
+    auth_switch.CREDS_FILE.write_text(json.dumps({"access_token": "through-link", "refresh_token": "r"}))
+    result = auth_switch.switch_to("a@example.com", switch_mode="copy")
+    assert result["written_back"] is False
+    assert not auth_switch.CREDS_FILE.is_symlink()
+    assert _profile_creds("b@example.com")["access_token"] == "through-link"
+
+
+def test_ambiguous_target(add_profile):
+    for i in range(auth_switch.AMBIGUOUS_LIMIT + 2):
+        add_profile(f"user{i}@example.com")
+    add_profile("alice@example.com")
+    add_profile("alice.work@example.com")
+
+    result = auth_switch.switch_to("alice")
+    assert not result["ok"] and result["error"] == "ambiguous"
+    assert result["detail"].split(", ") == ["alice.work@example.com", "alice@example.com"]
+
+    result = auth_switch.switch_to("user")
+    assert result["error"] == "ambiguous"
+    assert len(result["detail"].split(", ")) == auth_switch.AMBIGUOUS_LIMIT
+    assert not auth_switch.CREDS_FILE.exists()
+
+
+def test_target_resolution(add_profile):
+    add_profile("alice@example.com")
+    add_profile("bob@example.com")
+    assert auth_switch.switch_to("bob")["account"] == "bob@example.com"
+    assert auth_switch.switch_to("1")["account"] == "alice@example.com"
+    assert auth_switch.switch_to("3")["error"] == "index_out_of_range"
+    assert auth_switch.switch_to("carol")["error"] == "not_found"
+    assert auth_switch.switch_to("alice@example.com")["switched"] is False
+
+
+def test_switch_next_picks_the_healthiest(add_profile):
+    for account in ("a@example.com", "b@example.com", "c@example.com"):
+        add_profile(account)
+    profile_cache.save_quota_snapshot("b@example.com", [{"modelId": "gemini-3-pro", "remainingFraction": 0.2}])
+    profile_cache.save_quota_snapshot("c@example.com", [{"modelId": "gemini-3-pro", "remainingFraction": 0.8}])
+    auth_switch.switch_to("a@example.com")
+
+    result = auth_switch.switch_next(auto_switch=AUTO_SWITCH)
+    assert result["ok"] and result["account"] == "c@example.com" and result["score"] == 0.8
+
+    result = auth_switch.switch_next(mode="sequential", auto_switch=AUTO_SWITCH)
+    assert result["account"] == "a@example.com" and result["mode"] == "sequential"
+
+
+def test_switch_next_errors(add_profile):
+    assert auth_switch.switch_next(auto_switch=AUTO_SWITCH)["error"] == "no_profiles"
+    add_profile("a@example.com")
+    auth_switch.switch_to("a@example.com")
+    assert auth_switch.switch_next(auto_switch=AUTO_SWITCH)["error"] == "single_account"
+
+    add_profile("b@example.com")
+    profile_cache.save_quota_snapshot("b@example.com", [{"modelId": "gemini-3-pro", "remainingFraction": 0.01}])
+    result = auth_switch.switch_next(auto_switch=AUTO_SWITCH)
+    assert result["error"] == "all_exhausted"
+    assert [account for account, _, _ in result["exhausted"]] == ["b@example.com"]
@@ -0,0 +1,124 @@
+import json
+import re
+
+import pytest
+
+import config_snapshot
+
+
+def test_defaults():
+    snapshot = config_snapshot.build(None)
+    auto_switch = snapshot["auto_switch"]
+    assert snapshot["warnings"] == []
+    assert snapshot["language"] == "en"
+    assert snapshot["oauth_client"] is None
+    assert auto_switch["threshold"] == config_snapshot.DEFAULT_AUTO_SWITCH["threshold"] / 100
+    assert auto_switch["model_matcher"] == ("prefix", "gemini-3")
+    assert auto_switch["custom_matcher"] is None
+
+
+DEFAULTS = config_snapshot.DEFAULT_AUTO_SWITCH
+
+
+@pytest.mark.parametrize("raw, warning, key, value", [
+    ([], "auth_config.json is not an object", "threshold", DEFAULTS["threshold"] / 100),
+    ({"language": "fr"}, "language: invalid value 'fr'", None, None),
+    ({"auto_switch": []}, "auto_switch is not an object", "strategy", DEFAULTS["strategy"]),
+    ({"auto_switch": {"threshold": "5"}}, "auto_switch.threshold: invalid value '5'", "threshold", DEFAULTS["threshold"] / 100),
+    ({"auto_switch": {"threshold": -1}}, "auto_switch.threshold: invalid value -1", "threshold", DEFAULTS["threshold"] / 100),
+    ({"auto_switch": {"threshold": 150}}, "auto_switch.threshold: 150 is above 100%", "threshold", 1.0),
+    ({"auto_switch": {"max_stale_minutes": 3}}, "auto_switch.max_stale_minutes: 3 is not above cache_minutes (3)", "max_stale_minutes", 0),
+    ({"auto_switch": {"cache_minutes": 10, "max_stale_minutes": 5}}, "auto_switch.max_stale_minutes: 5 is not above cache_minutes (10)", "max_stale_minutes", 0),
+    ({"auto_switch": {"max_retries": True}}, "auto_switch.max_retries: invalid value True", "max_retries", DEFAULTS["max_retries"]),
+    ({"auto_switch": {"strategy": "fastest"}}, "auto_switch.strategy: invalid value 'fastest'", "strategy", DEFAULTS["strategy"]),
+    ({"auto_switch": {"rotation": "random"}}, "auto_switch.rotation: invalid value 'random'", "rotation", DEFAULTS["rotation"]),
+    ({"auto_switch": {"models_to_check": [1]}}, "auto_switch.models_to_check: invalid value [1]", "models_to_check", DEFAULTS["models_to_check"]),
+    ({"auto_switch": {"model_pattern": "gemini-("}}, "auto_switch.model_pattern: invalid regex 'gemini-('", "model_matcher", None),
+])
+def test_invalid_values_warn_and_use_defaults(raw, warning, key, value):
+    snapshot = config_snapshot.build(raw)
+    assert len(snapshot["warnings"]) == 1
+    assert snapshot["warnings"][0].startswith(warning)
+    if key:
+        assert snapshot["auto_switch"][key] == value
+    else:
+        assert snapshot["language"] == "en"
+
+
+def test_valid_values_are_normalized():
+    snapshot = config_snapshot.build({
+        "language": "cn",
+        "oauth_client": {"client_id": "id", "client_secret": "secret"},
+        "auto_switch": {
+            "threshold": 20,
+            "cache_minutes": 5,
+            "max_stale_minutes": 30,
+            "max_retries": 2.0,
+            "enabled": 0,
+            "models_to_check": "a, b,,c",
+            "strategy": "custom",
+            "custom_model_pattern": "gemini-(2|3)-pro",
+            "extra_key": "kept",
+        },
+    })
+    auto_switch = snapshot["auto_switch"]
+    assert snapshot["warnings"] == []
+    assert snapshot["oauth_client"] == {"client_id": "id", "client_secret": "secret"}
+    assert auto_switch["threshold"] == 0.2
+    assert auto_switch["max_stale_minutes"] == 30
+    assert auto_switch["max_retries"] == 2 and isinstance(auto_switch["max_retries"], int)
+    assert auto_switch["enabled"] is False
+    assert auto_switch["models_to_check"] == ["a", "b", "c"]
+    assert auto_switch["custom_matcher"] == ("regex", "gemini-(2|3)-pro")
+    assert auto_switch["extra_key"] == "kept"
+
+
+@pytest.mark.parametrize("pattern, spec", [
+    ("", None),
+    (None, None),
+    (3, None),
+    ("gemini-3.*", ("prefix", "gemini-3")),
+    ("gemini-3", ("prefix", "gemini-3")),
+    ("Gemini-3.*", ("prefix", "Gemini-3")),
+    ("gemini-2.5.*", ("regex", "gemini-2.5.*")),
+    ("gemini-(2|3).*", ("regex", "gemini-(2|3).*")),
+    ("gemini-[", None),
+])
+def test_compile_spec(pattern, spec):
+    assert config_snapshot.compile_spec(pattern) == spec
+
+
+@pytest.mark.parametrize("pattern", ["gemini-3.*", "gemini-3", "Gemini-3.*", "gemini-(2|3).*", "gemini-2.5.*", ".*pro"])
+@pytest.mark.parametrize("model_id", ["gemini-3-pro-preview", "GEMINI-3-pro", "gemini-2.5-pro", "gemini-205", "x-gemini-3"])
+def test_matcher_agrees_with_re_match(pattern, model_id):
+    match = config_snapshot.matcher(config_snapshot.compile_spec(pattern))
+    assert bool(match(model_id)) == bool(re.match(pattern, model_id))
+
+
+@pytest.mark.parametrize("strategy, expected", [
+    ("conservative", None),
+    ("gemini3-first", True),
+    ("predictive", True),
+    ("custom", False),
+])
+def test_strategy_matcher(strategy, expected):
+    auto_switch = config_snapshot.build({"auto_switch": {
+        "strategy": strategy, "custom_model_pattern": "gemini-2.*"}})["auto_switch"]
+    match = config_snapshot.strategy_matcher(auto_switch)
+    if expected is None:
+        assert match is None
+    else:
+        assert bool(match("gemini-3-pro")) is expected
+
+
+def test_load_caches_until_the_file_changes(gemini_dir):
+    config_file = gemini_dir / "auth_config.json"
+    config_file.write_text(json.dumps({"auto_switch": {"threshold": 10}}), encoding="utf-8")
+    assert config_snapshot.load()["auto_switch"]["threshold"] == 0.1
+    assert config_snapshot.CACHE_FILE.exists()
+
+    config_snapshot._memo.update(stamp=None, snapshot=None)  # As in a new process: read the cache file
+    assert config_snapshot.load()["auto_switch"]["threshold"] == 0.1
+
+    config_file.write_text(json.dumps({"auto_switch": {"threshold": 5}}), encoding="utf-8")
+    assert config_snapshot.load()["auto_switch"]["threshold"] == 0.05
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+import fsutil
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="file modes and symlinks")
+
+
+def test_new_file_is_private(tmp_path):
+    path = tmp_path / "state.json"
+    fsutil.atomic_write(path, b"{}")
+    assert path.read_bytes() == b"{}"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path) == ["state.json"]  # No temp file left behind
+
+
+def test_existing_mode_is_kept_unless_given(tmp_path):
+    path = tmp_path / "creds.json"
+    path.write_bytes(b"old")
+    os.chmod(path, 0o640)
+    fsutil.atomic_write(path, b"new")
+    assert path.stat().st_mode & 0o777 == 0o640
+    fsutil.atomic_write(path, b"newer", mode=0o600)
+    assert path.stat().st_mode & 0o777 == 0o600
+
+
+def test_symlink_is_replaced_or_followed(tmp_path):
+    target = tmp_path / "profile.json"
+    target.write_bytes(b"profile")
+    link = tmp_path / "live.json"
+    link.symlink_to(target)
+
+    fsutil.atomic_write(link, b"through", follow_symlinks=True)
+    assert link.is_symlink() and target.read_bytes() == b"through"
+
+    fsutil.atomic_write(link, b"replaced")
+    assert not link.is_symlink() and link.read_bytes() == b"replaced"
+    assert target.read_bytes() == b"through"
+
+
+def test_failed_write_leaves_the_old_file(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_bytes(b"old")
+    with pytest.raises(TypeError):
+        fsutil.atomic_write(path, "not bytes")
+    assert path.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_file_stamp(tmp_path):
+    path = tmp_path / "auth_config.json"
+    assert fsutil.file_stamp(path) is None
+    path.write_bytes(b"{}")
+    assert fsutil.file_stamp(path)[1] == 2
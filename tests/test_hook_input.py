@@ -0,0 +1,64 @@
+import io
+import json
+
+import pytest
+
+import hook_input
+
+DOCUMENTS = [
+    {},
+    {"prompt_response": "plain"},
+    {"session_id": "s-1", "prompt_response": "quota \"exceeded\" \\ tab\t newline\n end"},
+    {"prompt_response": "unicode: é 中文 ✅ 😀  ", "other": [1, 2.5, -3e2, True, False, None]},
+    {"skip": {"nested": ["a", {"b": "c\"}]"}], "n": 1}, "prompt_response": "after nested"},
+    {"prompt_response": {"nested": ["x", "é", {"k": None}]}, "session_id": 12},
+    {"prompt_response": "", "session_id": None},
+    {"prompt_response": "x" * 5000 + "😀" + "y" * 5000},
+]
+FIELDS = ("prompt_response", "session_id")
+
+
+def _expected(document, fields=FIELDS):
+    return {field: document[field] for field in fields if field in document}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64 * 1024])
+@pytest.mark.parametrize("ascii_only", [True, False])
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_matches_json_loads(monkeypatch, document, ascii_only, chunk_size):
+    monkeypatch.setattr(hook_input, "CHUNK_SIZE", chunk_size)
+    raw = json.dumps(document, ensure_ascii=ascii_only, indent=1).encode("utf-8")
+    assert hook_input.read_context(io.BytesIO(raw), FIELDS) == _expected(json.loads(raw))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 64 * 1024])
+def test_text_stream(monkeypatch, chunk_size):
+    monkeypatch.setattr(hook_input, "CHUNK_SIZE", chunk_size)
+    document = {"prompt_response": "😀 \\\"", "session_id": "s"}
+    stream = io.StringIO(json.dumps(document, ensure_ascii=False))
+    assert hook_input.read_context(stream, FIELDS) == document
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64 * 1024])
+def test_long_strings_keep_head_and_tail(monkeypatch, chunk_size):
+    monkeypatch.setattr(hook_input, "CHUNK_SIZE", chunk_size)
+    text = "HEAD" + "\\u00e9" * 50 + "middle" + "é" * 50 + "TAIL"
+    decoded = json.loads(f'"{text}"')
+    raw = ('{"prompt_response": "%s"}' % text).encode("utf-8")
+    context = hook_input.read_context(io.BytesIO(raw), ("prompt_response",), max_chars=10)
+    assert context == {"prompt_response": decoded[:10] + "\n" + decoded[-10:]}
+
+    short = hook_input.read_context(io.BytesIO(raw), ("prompt_response",), max_chars=len(decoded))
+    assert short == {"prompt_response": decoded}
+
+
+@pytest.mark.parametrize("raw", [b"", b"   ", b"[1, 2]", b'"text"', b"{", b'{"a": 1,', b'{"a" 1}', b"nonsense"])
+def test_not_an_object(raw):
+    assert hook_input.read_context(io.BytesIO(raw), FIELDS) is None
+
+
+def test_drains_the_rest_once_fields_are_found():
+    raw = json.dumps({"session_id": "s", "prompt_response": "r", "tail": "z" * 10000}).encode("utf-8")
+    stream = io.BytesIO(raw)
+    assert hook_input.read_context(stream, FIELDS) == {"session_id": "s", "prompt_response": "r"}
+    assert stream.read() == b""
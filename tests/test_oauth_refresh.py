@@ -0,0 +1,100 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+import oauth_refresh
+import state_store
+
+
+@pytest.fixture
+def token_endpoint(monkeypatch):
+    """A local token endpoint; set .reply to (status, body) and read the grants it received."""
+    class Endpoint:
+        reply = (200, {"access_token": "fresh", "expires_in": 3599, "id_token": "new-id"})
+        grants = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode("ascii"))
+            Endpoint.grants.append({key: values[0] for key, values in form.items()})
+            status, body = Endpoint.reply
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    monkeypatch.setattr(oauth_refresh, "GOOGLE_TOKEN_URL", f"http://127.0.0.1:{server.server_address[1]}/token")
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    yield Endpoint
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def creds_file(add_profile):
+    return add_profile("a@example.com", access_token="stale", expiry_date=int(time.time() * 1000),
+                       scope="cloud-platform")
+
+
+def test_refresh_writes_the_new_token(token_endpoint, creds_file):
+    creds = oauth_refresh.refresh_credentials(creds_file)
+    assert creds == oauth_refresh.load_credentials(creds_file)
+    assert creds["access_token"] == "fresh" and creds["id_token"] == "new-id"
+    assert creds["refresh_token"] == "refresh-a@example.com" and creds["scope"] == "cloud-platform"
+    assert oauth_refresh.expires_in(creds) == pytest.approx(3599, abs=5)
+
+    grant = token_endpoint.grants[0]
+    assert grant["grant_type"] == "refresh_token" and grant["refresh_token"] == "refresh-a@example.com"
+    assert grant["client_id"] == oauth_refresh.DEFAULT_OAUTH_CLIENT["client_id"]
+    assert state_store.acquire_lease(f"token_refresh:{creds_file}", 1) is True  # Released
+
+
+def test_fresh_token_is_not_refreshed(token_endpoint, creds_file):
+    oauth_refresh.refresh_credentials(creds_file)
+    assert oauth_refresh.refresh_credentials(creds_file)["access_token"] == "fresh"
+    # After a 401 only the rejected token is replaced
+    assert oauth_refresh.refresh_credentials(creds_file, rejected_token="stale")["access_token"] == "fresh"
+    assert len(token_endpoint.grants) == 1
+
+
+@pytest.mark.parametrize("reply, error", [
+    ((400, {"error": "invalid_grant"}), "HTTP 400 (invalid_grant)"),
+    ((500, "oops"), "HTTP 500"),
+    ((200, {"token_type": "Bearer"}), "no access_token in token response"),
+])
+def test_failed_refresh_leaves_the_file(token_endpoint, creds_file, reply, error):
+    token_endpoint.reply = reply
+    before = creds_file.read_bytes()
+    with pytest.raises(oauth_refresh.TokenRefreshError, match=re.escape(error)):
+        oauth_refresh.refresh_credentials(creds_file)
+    assert creds_file.read_bytes() == before
+    # get_access_token falls back to the current token (the API's 401 then takes the retry path)
+    assert oauth_refresh.get_access_token(creds_file) == "stale"
+
+
+def test_refresh_errors_without_a_request(token_endpoint, add_profile, gemini_dir):
+    with pytest.raises(oauth_refresh.TokenRefreshError, match="cannot read"):
+        oauth_refresh.refresh_credentials(gemini_dir / "missing.json")
+    no_refresh_token = add_profile("b@example.com")
+    no_refresh_token.write_text(json.dumps({"access_token": ""}))
+    with pytest.raises(oauth_refresh.TokenRefreshError, match="no refresh_token"):
+        oauth_refresh.refresh_credentials(no_refresh_token)
+    assert token_endpoint.grants == []
+
+
+def test_unreachable_endpoint(monkeypatch, creds_file):
+    monkeypatch.setattr(oauth_refresh, "GOOGLE_TOKEN_URL", "http://127.0.0.1:9/token")
+    with pytest.raises(oauth_refresh.TokenRefreshError):
+        oauth_refresh.refresh_credentials(creds_file, timeout=2)
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+import quota_auto_switch
+import state_store
+
+
+def _run(response):
+    return quota_auto_switch.run_hook(quota_auto_switch.parse_context(json.dumps({"prompt_response": response})))
+
+
+@pytest.fixture
+def switched(monkeypatch):
+    """Replace the account switch; records every call."""
+    calls = []
+
+    def switch_to_next():
+        calls.append(True)
+        return "b@example.com"
+    monkeypatch.setattr(quota_auto_switch, "switch_to_next", switch_to_next)
+    return calls
+
+
+def test_quota_ok_does_not_switch_or_retry(monkeypatch, switched):
+    monkeypatch.setattr(quota_auto_switch, "load_model_usage",
+                        lambda config, account: ({"gemini-3-pro-preview": 80.0}, "refresh"))
+    assert _run("Error: 429 Too Many Requests") == {}
+    assert switched == []
+    assert state_store.get("last_quota_error") is None
+    assert state_store.get("retry_count") is None
+
+
+def test_exhausted_quota_switches_and_retries(monkeypatch, switched):
+    monkeypatch.setattr(quota_auto_switch, "load_model_usage",
+                        lambda config, account: ({"gemini-3-pro-preview": 1.0}, "cache"))
+    output = _run("Error: 429 Too Many Requests")
+    assert output["decision"] == "retry" and "b@example.com" in output["systemMessage"]
+    assert switched == [True]
+    assert state_store.get("last_quota_error")["pattern"] == "429"
+    assert state_store.get("retry_count") == 1
+
+    # A clean response ends the retry chain
+    assert _run("All done.") == {}
+    assert state_store.get("last_quota_error") is None
+    assert state_store.get("retry_count") is None
+
+
+@pytest.mark.parametrize("response, pattern", [
+    ("", None),
+    ("All done.", None),
+    ("Error: 429 Too Many Requests", r"429"),
+    ("got 403: quota exceeded", r"403.*quota"),
+    ("status: resource_exhausted", r"RESOURCE_EXHAUSTED"),  # Case-insensitive
+    ("quota exceeded (429)", r"Quota exceeded"),  # The earliest match wins
+    ("Usage limit reached for all Pro models", r"Usage limit reached"),
+    ("1. Keep trying  2. Stop", r"Keep trying.*Stop"),
+    ("PERMISSION_DENIED: VALIDATION_REQUIRED", r"PERMISSION_DENIED.*VALIDATION_REQUIRED"),
+])
+def test_find_quota_error(response, pattern):
+    assert quota_auto_switch.find_quota_error(response) == pattern
+
+
+def test_only_the_head_and_tail_are_scanned():
+    filler = "x" * 10000
+    assert quota_auto_switch.find_quota_error("429 " + filler, window=100) == r"429"
+    assert quota_auto_switch.find_quota_error(filler + " Quota exceeded", window=100) == r"Quota exceeded"
+    assert quota_auto_switch.find_quota_error(filler + " 429 " + filler, window=100) is None
+    assert quota_auto_switch.find_quota_error(filler + " 429 " + filler, window=0) == r"429"  # 0 scans everything
+    # ".*" patterns do not match across the skipped middle
+    assert quota_auto_switch.find_quota_error("403 " + filler + " quota", window=100) is None
@@ -0,0 +1,70 @@
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+import quota_auto_switch
+import quota_daemon
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix sockets")
+
+
+@pytest.fixture
+def daemon(gemini_dir, monkeypatch):
+    """The quota daemon serving in a thread (token scheduler off)."""
+    (gemini_dir / "auth_config.json").write_text(json.dumps({"auto_switch": {"token_refresh_minutes": 0}}))
+    monkeypatch.setattr(signal, "signal", lambda signum, handler: None)  # Main thread only
+    thread = threading.Thread(target=quota_daemon.serve, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not quota_daemon.ping():
+        assert time.monotonic() < deadline, "quota daemon did not start"
+        time.sleep(0.05)
+    yield
+    quota_daemon.stop_daemon()
+    thread.join(5)
+
+
+def test_no_daemon_means_in_process(gemini_dir):
+    assert quota_daemon.request_hook("auto_switch", b"{}") is None
+
+    # A socket file left behind by a crashed daemon
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(quota_daemon.SOCKET_FILE))
+    stale.close()
+    assert quota_daemon.request_hook("auto_switch", b"{}") is None
+
+
+def test_hook_request_is_dispatched(daemon, monkeypatch, capsys):
+    calls = []
+
+    def run_hook(context, parent_pid=None, hook_pid=None, endpoint=None):
+        calls.append((context, parent_pid, hook_pid, endpoint))
+        print("from the daemon", file=sys.stderr)
+        return {"decision": "retry"}
+    monkeypatch.setattr(quota_auto_switch, "run_hook", run_hook)
+    monkeypatch.setenv("CODE_ASSIST_ENDPOINT", "http://127.0.0.1:8790/secret")
+
+    raw = json.dumps({"prompt_response": "429", "session_id": "s"}).encode()
+    assert quota_daemon.request_hook("auto_switch", raw) == {"decision": "retry"}
+    assert calls == [({"prompt_response": "429"}, os.getppid(), os.getpid(),
+                      "http://127.0.0.1:8790/secret")]
+    assert "from the daemon" in capsys.readouterr().err  # Hook stderr is relayed to the caller
+    assert quota_daemon.ping()["requests"] == 1
+
+
+def test_failed_hook_is_not_rerun_in_process(daemon, monkeypatch, capsys):
+    def run_hook(context, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(quota_auto_switch, "run_hook", run_hook)
+
+    # The daemon may have switched before failing: the caller gets an empty output, not None
+    assert quota_daemon.request_hook("auto_switch", b"{}") == {}
+    assert "Hook auto_switch failed: boom" in capsys.readouterr().err
+    assert quota_daemon.request_hook("no_such_hook", b"{}") == {}
+    assert "No reply from daemon" in capsys.readouterr().err
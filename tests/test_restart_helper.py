@@ -0,0 +1,92 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+import restart_helper
+import state_store
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="POSIX signals")
+
+IGNORES_SIGTERM = ("import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+                   "print('ready', flush=True); time.sleep(30)")
+
+
+@pytest.fixture
+def spawn():
+    """Start Python children running the given code; they are killed and reaped afterwards."""
+    children = []
+
+    def start(code):
+        proc = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, text=True)
+        children.append(proc)
+        return proc
+    yield start
+    for proc in children:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+
+@pytest.fixture(params=["native", "poll"])
+def watch(request, monkeypatch):
+    """ProcessWatch as built on this platform, and forced to the polling fallback."""
+    if request.param == "poll":
+        monkeypatch.delattr(restart_helper.os, "pidfd_open", raising=False)
+    return restart_helper.ProcessWatch
+
+
+def test_wait_returns_when_the_process_exits(spawn, watch):
+    proc = spawn("import time; time.sleep(0.2)")
+    process = watch(proc.pid)
+    try:
+        started = time.monotonic()
+        assert process.wait(10) is True
+        assert time.monotonic() - started < 5  # Woken by the exit (an unreaped zombie counts)
+        assert not process.alive()
+    finally:
+        process.close()
+
+
+def test_wait_times_out_while_the_process_runs(spawn, watch):
+    proc = spawn("import time; time.sleep(30)")
+    process = watch(proc.pid)
+    try:
+        assert process.wait(0.1) is False
+        assert process.alive()
+    finally:
+        process.close()
+
+
+def test_terminate(spawn, watch):
+    proc = spawn("import time; time.sleep(30)")
+    process = watch(proc.pid)
+    try:
+        assert restart_helper.terminate(process, grace=5) == "terminated"
+        assert restart_helper.terminate(process, grace=5) == "gone"
+    finally:
+        process.close()
+
+
+def test_terminate_escalates_to_sigkill(spawn, watch):
+    proc = spawn(IGNORES_SIGTERM)
+    assert proc.stdout.readline() == "ready\n"
+    process = watch(proc.pid)
+    try:
+        assert restart_helper.terminate(process, grace=0.2) == "killed"
+    finally:
+        process.close()
+
+
+def test_restart_waits_for_the_hook_then_relaunches(spawn, monkeypatch):
+    launched = []
+    monkeypatch.setattr(restart_helper, "start_gemini", lambda: launched.append(time.monotonic()))
+    cli = spawn("import time; time.sleep(30)")
+    hook = spawn("import time; time.sleep(0.2)")
+
+    stats = restart_helper.restart_gemini(cli.pid, delay=10, after_pid=hook.pid, grace=5)
+    assert hook.poll() is not None and cli.poll() is not None  # Both gone before the launch
+    assert launched and stats["shutdown"] == "terminated"
+    assert stats["hook_wait_ms"] < 5000  # Not the full delay
+    assert state_store.get("last_restart")["pid"] == cli.pid
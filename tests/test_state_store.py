@@ -0,0 +1,162 @@
+import json
+import sqlite3
+
+import pytest
+
+import oauth_refresh
+import quota_pre_check
+import state_store
+# Tables of each schema version (the migration only ever adds tables)
+TABLES_BY_VERSION = {
+    1: {"kv", "quota_snapshots", "project_info"},
+    2: {"kv", "quota_snapshots", "project_info", "leases"},
+    3: {"kv", "quota_snapshots", "project_info", "leases", "quota_samples"},
+    4: {"kv", "quota_snapshots", "project_info", "leases", "quota_samples", "exhaustion"},
+}
+TABLES = TABLES_BY_VERSION[4] | {"profiles"}
+
+def _tables(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def _create_old_database(version):
+    conn = sqlite3.connect(str(state_store.DB_FILE), isolation_level=None)
+    tables = TABLES_BY_VERSION[version]
+    for statement in state_store.SCHEMA:
+        name = statement.split("EXISTS", 1)[1].split()[0]
+        if name in tables or (name == "exhaustion_reset_at" and "exhaustion" in tables):
+            conn.execute(statement)
+    conn.execute("INSERT INTO kv (key, value, updated) VALUES ('retry_count', '2', 0)")
+    conn.execute(
+        "INSERT INTO quota_snapshots (account, timestamp, buckets, cache_minutes) "
+        "VALUES ('a@example.com', '2026-01-01T00:00:00', '[]', 3)"
+    )
+    conn.execute(f"PRAGMA user_version = {version}")
+    conn.close()
+
+
+def test_new_database_imports_legacy_files():
+    state_store.LEGACY_RETRY_FILE.write_text("4")
+    state_store.LEGACY_ERROR_STATE_FILE.write_text(json.dumps({"account": "a@example.com"}))
+    profile = state_store.PROFILES_DIR / "a@example.com"
+    profile.mkdir(parents=True)
+    (profile / state_store.LEGACY_QUOTA_CACHE_NAME).write_text(json.dumps(
+        {"timestamp": "2026-01-01T00:00:00", "buckets": [{"modelId": "m"}], "cache_minutes": 3}))
+    (profile / state_store.LEGACY_PROJECT_CACHE_NAME).write_text(json.dumps(
+        {"project": "p-1", "tier": {"id": "free-tier"}, "timestamp": "2026-01-01T00:00:00"}))
+
+    assert state_store.get("retry_count") == 4
+    assert state_store.get("last_quota_error") == {"account": "a@example.com"}
+    assert state_store.get_quota_snapshot("a@example.com")["buckets"] == [{"modelId": "m"}]
+    assert state_store.get_project_info("a@example.com")["tier"] == {"id": "free-tier", "name": "unknown"}
+
+    conn = state_store._connect()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == state_store.SCHEMA_VERSION
+    assert _tables(conn) >= TABLES
+
+
+@pytest.mark.parametrize("version", sorted(TABLES_BY_VERSION))
+def test_migrates_old_database(version):
+    _create_old_database(version)
+    state_store.LEGACY_RETRY_FILE.write_text("9")  # Imported only into a new database
+
+    assert state_store.get("retry_count") == 2
+    conn = state_store._connect()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == state_store.SCHEMA_VERSION
+    assert _tables(conn) >= TABLES
+    assert state_store.get_quota_snapshot("a@example.com")["buckets"] == []
+
+    # Tables added by the migration are usable
+    assert state_store.put_quota_snapshot("a@example.com", "2026-01-02T00:00:00",
+                                          [{"modelId": "m", "remainingFraction": 0.5}], 3)
+    assert [f for _, f in state_store.get_quota_samples("a@example.com", "m")] == [0.5]
+    assert state_store.put_exhaustion("a@example.com", [("m", 1.0, 0.0)])
+    assert state_store.replace_profiles(["a@example.com"], [1, 2])
+    assert state_store.get_profiles() == ["a@example.com"]
+    assert state_store.acquire_lease("x", 30) is True
+
+
+def test_forget_account():
+    state_store.put_quota_snapshot("a@example.com", "2026-01-01T00:00:00", [], 3)
+    state_store.put_project_info("a@example.com", "p-1", None, None, "2026-01-01T00:00:00")
+    assert state_store.forget_account("a@example.com")
+    assert state_store.get_quota_snapshot("a@example.com") is None
+    assert state_store.get_project_info("a@example.com") is None
+
+
+def test_update_is_read_modify_write():
+    assert state_store.update("counter", lambda value: (value or 0) + 1) == 1
+    assert state_store.update("counter", lambda value: (value or 0) + 1) == 2
+    assert state_store.get("counter") == 2
+
+
+def test_lease_is_exclusive_until_released():
+    assert state_store.acquire_lease("refresh", 30, owner="a") is True
+    assert state_store.acquire_lease("refresh", 30, owner="a") is True  # Re-entrant for its owner
+    assert state_store.acquire_lease("refresh", 30, owner="b") is False
+
+    state_store.release_lease("refresh", owner="b")  # Not the holder: no-op
+    assert state_store.acquire_lease("refresh", 30, owner="b") is False
+
+    state_store.release_lease("refresh", owner="a")
+    assert state_store.acquire_lease("refresh", 30, owner="b") is True
+
+
+def test_expired_lease_is_taken_over(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(state_store.time, "time", lambda: now[0])
+    assert state_store.acquire_lease("refresh", 30, owner="crashed") is True
+    now[0] += 29
+    assert state_store.acquire_lease("refresh", 30, owner="b") is False
+    now[0] += 2
+    assert state_store.acquire_lease("refresh", 30, owner="b") is True
+    assert state_store.acquire_lease("refresh", 30, owner="crashed") is False
+
+
+@pytest.fixture
+def broken_store(monkeypatch):
+    def fail():
+        raise sqlite3.OperationalError("unable to open database file")
+    monkeypatch.setattr(state_store, "_connect", fail)
+
+
+def _must_not_wait(seconds):
+    raise AssertionError("waited for a lease nobody holds")
+
+
+def test_unavailable_store_reads_as_empty(broken_store):
+    assert state_store.get("retry_count", 0) == 0
+    assert state_store.put("retry_count", 1) is False
+    assert state_store.get_quota_snapshot("a@example.com") is None
+    assert state_store.update("counter", lambda value: (value or 0) + 1) == 1
+    assert state_store.acquire_lease("refresh", 30) is None
+
+
+def test_quota_refresh_without_store_fetches_directly(broken_store, monkeypatch):
+    calls = []
+    monkeypatch.setattr(quota_pre_check, "fetch_quota",
+                        lambda account, minutes: calls.append(account) or ([{"modelId": "m"}], "Fetched"))
+    monkeypatch.setattr(quota_pre_check.time, "sleep", _must_not_wait)
+    assert quota_pre_check.refresh_quota("a@example.com", 3) == ([{"modelId": "m"}], "Fetched")
+    assert calls == ["a@example.com"]
+
+
+def test_token_refresh_without_store_is_unleased(broken_store, monkeypatch, add_profile):
+    creds_file = add_profile("a@example.com", expiry_date=1)
+    monkeypatch.setattr(oauth_refresh.time, "sleep", _must_not_wait)
+    monkeypatch.setattr(oauth_refresh, "_request_token",
+                        lambda refresh_token, timeout: {"access_token": "new", "expires_in": 3600})
+    assert oauth_refresh.refresh_credentials(creds_file)["access_token"] == "new"
+    assert oauth_refresh.load_credentials(creds_file)["access_token"] == "new"
+
+
+def test_forced_refresh_accepts_token_from_lease_holder(monkeypatch, add_profile):
+    creds_file = add_profile("a@example.com", expiry_date=1)
+    assert state_store.acquire_lease(f"token_refresh:{creds_file}", 30, owner="other") is True
+
+    def other_session_refreshes(seconds):
+        creds_file.write_text('{"access_token": "fresh", "refresh_token": "r", "expiry_date": 1}')
+    monkeypatch.setattr(oauth_refresh.time, "sleep", other_session_refreshes)
+
+    creds = oauth_refresh.refresh_credentials(creds_file, skew=float("inf"))
+    assert creds["access_token"] == "fresh"
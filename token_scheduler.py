@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Token-freshness scheduler for the whole account pool.
+
+Standby profiles are only touched when they are switched to, so their access
+tokens are usually expired by then and the first request after a switch pays
+the refresh (or a 401). The scheduler keeps every pooled account hot:
+
+- an expiry-ordered queue (heap) of (refresh due time, account), where the due
+  time is expiry_date minus a lead time
+- due accounts are refreshed through oauth_refresh on a bounded thread pool,
+  and token endpoint requests are spaced by a rate limit
+- refreshed accounts are re-queued by their new expiry, failed ones retry
+  after RETRY_SECONDS
+
+Used by `gchange pool refresh` (one pass) and by the quota daemon (background
+thread, `token_refresh_minutes` lead time, 0 = off).
+"""
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import oauth_refresh
+import profile_cache
+
+DEFAULT_LEAD_MINUTES = 10    # Refresh this long before expiry_date
+DEFAULT_WORKERS = 4          # Concurrent token requests
+DEFAULT_RATE = 5.0           # Token requests per second across all workers
+RETRY_SECONDS = 300          # Next attempt after a failed refresh
+IDLE_SECONDS = 600           # Rescan interval when nothing is queued
+RESCAN_SECONDS = 300         # Pick up added/removed profiles at least this often
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TokenScheduler:
+    """Expiry-ordered refresh queue over the pooled accounts."""
+
+    def __init__(self, lead_minutes=DEFAULT_LEAD_MINUTES, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE):
+        self.lead = lead_minutes * 60
+        self.workers = max(1, workers)
+        self.limiter = RateLimiter(rate)
+        self.heap = []
+        self.unschedulable = []  # Accounts without credentials or refresh_token
+        self.loaded = 0.0
+
+    def due_time(self, account, now=None):
+        """When an account's token should be refreshed (Unix time); now if unknown."""
+        now = now if now is not None else time.time()
+        creds = oauth_refresh.load_credentials(profile_cache.credentials_file(account))
+        if not creds or not creds.get("refresh_token"):
+            return None  # Cannot be refreshed: not scheduled
+        remaining = oauth_refresh.expires_in(creds, now)
+        if remaining is None or not creds.get("access_token"):
+            return now
+        return now + remaining - self.lead
+
+    def load(self, accounts=None, now=None):
+        """(Re)build the queue from the credentials of the given accounts (default: whole pool)."""
+        now = now if now is not None else time.time()
+        if accounts is None:
+            accounts = profile_cache.list_profiles()
+        self.heap = []
+        self.unschedulable = []
+        for account in accounts:
+            due = self.due_time(account, now)
+            if due is None:
+                self.unschedulable.append(account)
+            else:
+                self.heap.append((due, account))
+        heapq.heapify(self.heap)
+        self.loaded = now
+
+    def next_due(self):
+        """Due time of the soonest refresh, or None if the queue is empty."""
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now=None):
+        """Remove and return the accounts whose refresh is due."""
+        now = now if now is not None else time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    def _refresh(self, account):
+        """Refresh one account; returns {account, ok, error, expires_in, elapsed}."""
+        started = time.monotonic()
+        result = {"account": account, "ok": False, "error": None, "expires_in": None, "elapsed": 0.0}
+        self.limiter.wait()
+        try:
+            creds = oauth_refresh.refresh_credentials(profile_cache.credentials_file(account), skew=self.lead)
+            result["ok"] = True
+            result["expires_in"] = oauth_refresh.expires_in(creds)
+        except oauth_refresh.TokenRefreshError as e:
+            result["error"] = str(e)
+        result["elapsed"] = time.monotonic() - started
+        return result
+
+    def run_once(self, now=None):
+        """Refresh every due account; re-queues them and returns their results in queue order."""
+        now = now if now is not None else time.time()
+        accounts = self.pop_due(now)
+        if not accounts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(accounts))) as pool:
+            results = list(pool.map(self._refresh, accounts))
+
+        done = time.time()
+        for r in results:
+            if r["ok"] and r["expires_in"] is not None:
+                due = done + r["expires_in"] - self.lead
+            else:
+                due = done + RETRY_SECONDS
+            heapq.heappush(self.heap, (max(due, done + 1), r["account"]))
+        return results
+
+    def run_forever(self, stop_event, on_results=None):
+        """Refresh tokens as they come due until stop_event is set (daemon thread)."""
+        while not stop_event.is_set():
+            now = time.time()
+            if not self.loaded or now - self.loaded >= RESCAN_SECONDS:
+                self.load(now=now)
+            results = self.run_once(now)
+            if results and on_results:
+                on_results(results)
+            next_due = self.next_due()
+            delay = IDLE_SECONDS if next_due is None else next_due - time.time()
+            stop_event.wait(max(1.0, min(delay, RESCAN_SECONDS)))
+
+
+def refresh_pool(accounts=None, lead_minutes=DEFAULT_LEAD_MINUTES, workers=DEFAULT_WORKERS,
+                 rate=DEFAULT_RATE, force=False):
+    """
+    One scheduler pass: refresh every account whose token expires within
+    lead_minutes (all of them if force). Returns (results, skipped) where
+    skipped is [(account, seconds until its refresh is due)]; accounts that
+    cannot be refreshed are reported as failed results.
+    """
+    scheduler = TokenScheduler(lead_minutes, workers, rate)
+    scheduler.load(accounts)
+    now = time.time()
+    if force:
+        scheduler.lead = float("inf")
+        scheduler.heap = [(now, account) for _, account in scheduler.heap]
+    results = scheduler.run_once(now)
+    results += [
+        {"account": account, "ok": False, "error": "no refresh_token", "expires_in": None, "elapsed": 0.0}
+        for account in scheduler.unschedulable
+    ]
+    refreshed = {r["account"] for r in results}
+    skipped = sorted((due - now, account) for due, account in scheduler.heap if account not in refreshed)
+    return results, [(account, wait) for wait, account in skipped]